@@ -11,9 +11,11 @@ from flask_batteries_included.config import (
     is_not_production_environment,
 )
 
-from dhos_encounters_api.blueprint_api import api_blueprint
+from dhos_encounters_api.blueprint_api import api_blueprint, publish
 from dhos_encounters_api.blueprint_development import development_blueprint
 from dhos_encounters_api.helpers.cli import add_cli_command
+from dhos_encounters_api.helpers.patient_count_cache import init_patient_count_cache
+from dhos_encounters_api.helpers.sql_instrumentation import init_sql_instrumentation
 
 
 def create_app(
@@ -39,6 +41,13 @@ def create_app(
 
     # Initialise k-b-i library to allow publishing to RabbitMQ.
     kombu_batteries_included.init()
+    publish.init_publish(app)
+
+    # Cache of patient counts per location.
+    init_patient_count_cache(app)
+
+    # Per-request SQL statement counts and timings, if enabled.
+    init_sql_instrumentation(app)
 
     # API blueprint registration
     app.register_blueprint(api_blueprint)
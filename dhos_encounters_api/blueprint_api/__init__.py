@@ -10,6 +10,7 @@ from flask_batteries_included.helpers.security.endpoint_security import (
     scopes_present,
 )
 
+from ..helpers.streaming import json_array_response
 from ..models.encounter import Encounter
 from ..models.score_system_history import ScoreSystemHistory
 from . import controller
@@ -49,6 +50,42 @@ def create_encounter(encounter_data: Dict) -> Response:
     return jsonify(controller.create_encounter(encounter_data))
 
 
+@api_blueprint.route("/dhos/v2/encounter", methods=["PUT"])
+@protected_route(scopes_present(required_scopes="write:send_encounter"))
+def upsert_encounter(encounter_data: Dict) -> Response:
+    """---
+    put:
+      summary: Create or update an encounter by EPR encounter ID
+      description: >-
+        Update the encounter with the `epr_encounter_id` in the request body that hasn't
+        been deleted, as PATCH /dhos/v1/encounter/{encounter_id} would, or create it if
+        there isn't one. Replaces creating the encounter and patching it when that fails
+        with 409 Conflict.
+      tags: [encounter]
+      requestBody:
+        description: An EPR encounter
+        required: true
+        content:
+          application/json:
+            schema:
+              $ref: '#/components/schemas/EncounterUpsertRequest'
+              x-body-name: encounter_data
+      responses:
+        '200':
+          description: The created or updated encounter
+          content:
+            application/json:
+              schema: EncounterResponse
+        default:
+          description: >-
+              Error, e.g. 400 Bad Request, 503 Service Unavailable
+          content:
+            application/json:
+              schema: Error
+    """
+    return jsonify(controller.upsert_encounter(encounter_data))
+
+
 @api_blueprint.route("/dhos/v1/encounter/<encounter_id>", methods=["GET"])
 @protected_route(scopes_present(required_scopes="read:send_encounter"))
 def get_encounter_by_uuid(
@@ -337,6 +374,50 @@ def merge_encounters(merge_data: Dict) -> Response:
     )
 
 
+@api_blueprint.route("/dhos/v1/encounter/merge/batch", methods=["POST"])
+@protected_route(scopes_present(required_scopes="write:send_encounter"))
+def merge_encounters_batch(merge_list: List[Dict]) -> Response:
+    """---
+    post:
+      summary: Apply several patient merges
+      description: >-
+        Applies each merge in the request body, in order, as POST /dhos/v1/encounter/merge
+        would. All of the merges are applied in a single transaction.
+      tags: [encounter]
+      requestBody:
+        description: List of merges
+        required: true
+        content:
+          application/json:
+            schema:
+              x-body-name: merge_list
+              type: array
+              minItems: 1
+              maxItems: 5000
+              items:
+                $ref: '#/components/schemas/EncounterMergeRequest'
+      responses:
+        '200':
+          description: Merge results
+          content:
+            application/json:
+              schema:
+                type: object
+                properties:
+                  total:
+                    type: integer
+                    description: Number of merged child encounters across all merges
+                    example: 4
+        default:
+          description: >-
+              Error, e.g. 400 Bad Request, 503 Service Unavailable
+          content:
+            application/json:
+              schema: Error
+    """
+    return jsonify(controller.merge_encounters_batch(merge_list))
+
+
 ## V2 Endpoints
 @api_blueprint.route("/dhos/v2/encounters", methods=["GET"])
 @protected_route(scopes_present(required_scopes="read:send_encounter"))
@@ -346,6 +427,7 @@ def get_encounters(
     show_deleted: bool = False,
     show_children: bool = False,
     expanded: bool = False,
+    stream: bool = False,
 ) -> Response:
     """
     ---
@@ -391,6 +473,13 @@ def get_encounters(
           schema:
             type: boolean
             default: false
+        - name: stream
+          in: query
+          required: false
+          description: Stream the response while encounters are fetched in batches, for large result sets
+          schema:
+            type: boolean
+            default: false
       responses:
         '200':
           description: A list of encounters
@@ -406,12 +495,194 @@ def get_encounters(
             application/json:
               schema: Error
     """
+    if stream:
+        return json_array_response(
+            controller.iter_encounters(
+                modified_since, compact, show_deleted, show_children, expanded
+            )
+        )
     results = controller.get_encounters(
         modified_since, compact, show_deleted, show_children, expanded
     )
     return jsonify(results)
 
 
+@api_blueprint.route("/dhos/v2/encounters", methods=["POST"])
+@protected_route(scopes_present(required_scopes="write:send_encounter"))
+def create_encounters(encounter_list: List[Dict]) -> Response:
+    """---
+    post:
+      summary: Create encounters
+      description: >-
+        Create a batch of encounters with the details in the request body. Either all of
+        the encounters are created or none are.
+      tags: [encounter]
+      requestBody:
+        description: List of encounters
+        required: true
+        content:
+          application/json:
+            schema:
+              x-body-name: encounter_list
+              type: array
+              minItems: 1
+              maxItems: 5000
+              items:
+                $ref: '#/components/schemas/EncounterRequestV2'
+      responses:
+        '200':
+          description: Encounters created
+          content:
+            application/json:
+              schema: EncounterBulkCreateResponse
+        default:
+          description: >-
+              Error, e.g. 400 Bad Request, 409 Conflict, 503 Service Unavailable
+          content:
+            application/json:
+              schema: Error
+    """
+    return jsonify(controller.create_encounters(encounter_list))
+
+
+@api_blueprint.route("/dhos/v2/encounters/upsert", methods=["POST"])
+@protected_route(scopes_present(required_scopes="write:send_encounter"))
+def upsert_encounters(encounter_list: List[Dict]) -> Response:
+    """---
+    post:
+      summary: Create or update encounters by EPR encounter ID
+      description: >-
+        Create or update a batch of EPR encounters, for bulk feeds such as the async adapter.
+        Each encounter in the request body updates the encounter with the same
+        `epr_encounter_id` that hasn't been deleted, or is created if there isn't one. Either
+        all of the changes are made or none are. Score system changes to existing encounters
+        are rejected, make them with PATCH /dhos/v1/encounter/{encounter_id}. No audit
+        messages are published.
+      tags: [encounter]
+      requestBody:
+        description: List of encounters
+        required: true
+        content:
+          application/json:
+            schema:
+              x-body-name: encounter_list
+              type: array
+              minItems: 1
+              maxItems: 5000
+              items:
+                $ref: '#/components/schemas/EncounterUpsertRequest'
+      responses:
+        '200':
+          description: Encounters created or updated
+          content:
+            application/json:
+              schema: EncounterBulkUpsertResponse
+        default:
+          description: >-
+              Error, e.g. 400 Bad Request, 409 Conflict, 503 Service Unavailable
+          content:
+            application/json:
+              schema: Error
+    """
+    return jsonify(controller.upsert_encounters(encounter_list))
+
+
+@api_blueprint.route("/dhos/v2/encounters/page", methods=["GET"])
+@protected_route(scopes_present(required_scopes="read:send_encounter"))
+def get_encounters_page(
+    modified_since: str,
+    page_size: int = controller.DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    compact: bool = False,
+    show_deleted: bool = False,
+    show_children: bool = False,
+    expanded: bool = False,
+) -> Response:
+    """
+    ---
+    get:
+      summary: Get a page of encounters by modified after date
+      description: >-
+        Get a page of the encounters which have been modified after the supplied date, oldest
+        modification first. Pass the `next` cursor from the response to get the following page.
+      tags: [encounter]
+      parameters:
+        - name: modified_since
+          in: query
+          required: true
+          description: Get encounters which have been modified after the specified date and time
+          schema:
+            type: string
+            example: '2020-12-30'
+        - name: page_size
+          in: query
+          required: false
+          description: Maximum number of encounters to return
+          schema:
+            type: integer
+            minimum: 1
+            maximum: 5000
+            default: 1000
+        - name: cursor
+          in: query
+          required: false
+          description: The `next` cursor returned with the previous page
+          schema:
+            type: string
+            example: 'WyIyMDIwLTEyLTMwVDAwOjAwOjAwLjAwMDAwMSIsICJhYmMiXQ'
+        - name: compact
+          in: query
+          required: false
+          description: Whether to make the response compact
+          schema:
+            type: boolean
+            default: false
+        - name: show_deleted
+          in: query
+          required: false
+          description: show deleted data in response
+          schema:
+            type: boolean
+            default: false
+        - name: show_children
+          in: query
+          required: false
+          description: show children data in response
+          schema:
+            type: boolean
+            default: false
+        - name: expanded
+          in: query
+          required: false
+          description: Whether to expand the indentifier
+          schema:
+            type: boolean
+            default: false
+      responses:
+        '200':
+          description: A page of encounters
+          content:
+            application/json:
+              schema: EncounterPageResponse
+        default:
+          description: Error, e.g. 400 Bad Request, 503 Service Unavailable
+          content:
+            application/json:
+              schema: Error
+    """
+    return jsonify(
+        controller.get_encounters_page(
+            modified_since,
+            page_size,
+            cursor,
+            compact,
+            show_deleted,
+            show_children,
+            expanded,
+        )
+    )
+
+
 @api_blueprint.route("/dhos/v2/encounter", methods=["GET"])
 @protected_route(scopes_present(required_scopes="read:send_encounter"))
 def get_encounters_by_filters(
@@ -562,8 +833,10 @@ def get_latest_encounter_by_patient_id(
             patient_id=patient_id, compact=compact, open_as_of=open_as_of
         )
     else:
-        encounters = controller.get_encounters_by_patient_or_epr_id(
-            patient_id=patient_id, compact=compact
+        encounters = list(
+            controller.get_latest_encounters_for_patients(
+                patient_ids=[patient_id], compact=compact
+            ).values()
         )
     if len(encounters) == 0:
         raise EntityNotFoundException(
@@ -626,18 +899,9 @@ def retrieve_latest_encounters_by_patient_ids(
             application/json:
               schema: Error
     """
-    response: Dict[str, Dict] = {}
-    for patient_id in patient_ids:
-        if open_as_of:
-            encounters = controller.get_open_encounters_for_patient(
-                patient_id=patient_id, compact=compact, open_as_of=open_as_of
-            )
-        else:
-            encounters = controller.get_encounters_by_patient_or_epr_id(
-                patient_id=patient_id, compact=compact
-            )
-        if len(encounters) > 0:
-            response[patient_id] = encounters[0]
+    response: Dict[str, Dict] = controller.get_latest_encounters_for_patients(
+        patient_ids=patient_ids, compact=compact, open_as_of=open_as_of
+    )
     return jsonify(response)
 
 
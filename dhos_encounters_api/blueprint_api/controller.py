@@ -1,8 +1,12 @@
-from typing import Any, Dict, List, Optional, Tuple
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
 
 import draymed
-from dictdiffer import diff
-from flask import g
+from flask import abort, g
+from flask_batteries_included.helpers import generate_uuid
 from flask_batteries_included.helpers.error_handler import (
     DuplicateResourceException,
     EntityNotFoundException,
@@ -12,18 +16,44 @@ from flask_batteries_included.helpers.security.jwt import current_jwt_user
 from flask_batteries_included.helpers.timestamp import parse_iso8601_to_datetime
 from flask_batteries_included.sqldb import db
 from she_logging import logger
-from sqlalchemy import and_, bindparam, case, cast, distinct, func, literal, or_, orm
+from sqlalchemy import (
+    JSON,
+    and_,
+    bindparam,
+    case,
+    cast,
+    distinct,
+    func,
+    or_,
+    orm,
+    tuple_,
+    update,
+)
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy.orm.query import Query
 
 from dhos_encounters_api.blueprint_api import publish
+from dhos_encounters_api.helpers.patient_count_cache import get_patient_count_cache
 from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
 from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
 
 LOCAL_ENCOUNTER = "Local Encounter"
 WARD_LOCATION_TYPE = draymed.codes.code_from_name("ward", category="location")
 HOSPITAL_LOCATION_TYPE = draymed.codes.code_from_name("hospital", category="location")
+STREAM_BATCH_SIZE = 500
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 5000
+MAX_BULK_CREATE_SIZE = 5000
+DATETIME_FIELDS = ("admitted_at", "discharged_at", "deleted_at")
 
 
 def create_encounter(encounter_data: Dict) -> Dict:
@@ -50,26 +80,114 @@ def create_encounter(encounter_data: Dict) -> Dict:
 
     encounter = Encounter.new(**encounter_data)
     try:
-        db.session.commit()
+        with publish.transaction():
+            _flush_and_reload(encounter)
+            Encounter.sync_latest_encounters([patient_uuid])
+            encounter_dict = encounter.to_dict()
+            publish.publish_encounter_update(encounter_dict)
     except IntegrityError as e:
         if "epr_encounter_id_deleted_at" in str(e):
             raise DuplicateResourceException(
                 f"An EPR encounter '{epr_encounter_id}' already exists"
             )
         raise
+    get_patient_count_cache().invalidate([encounter_dict["location_uuid"]])
+
+    return encounter_dict
+
+
+def upsert_encounter(encounter_data: Dict) -> Dict:
+    """
+    Creates the EPR encounter in the request body or, if there is an encounter with the
+    same epr_encounter_id that hasn't been deleted, updates that one as update_encounter
+    does. This replaces creating the encounter, getting the existing one when that fails
+    as a duplicate and then patching it: the existing encounter is found (and locked) by
+    the same INSERT ... ON CONFLICT statement that would have created it.
+    """
+    if not encounter_data.get("epr_encounter_id", None):
+        raise UnprocessibleEntityException("EPR encounter ID not given")
+    if not encounter_data.get("patient_uuid", None):
+        raise UnprocessibleEntityException("Patient UUID not given")
+    if encounter_data.get("spo2_scale", None) not in [None, 1] and not g.jwt_claims.get(
+        "can_edit_ews", False
+    ):
+        raise PermissionError(
+            f"Cannot create encounter with spo2_scale set to {encounter_data['spo2_scale']}"
+        )
+
+    encounter, created = Encounter.upsert(**encounter_data)
+    if not created:
+        updatable = Encounter.schema()["updatable"]
+        return update_encounter(
+            encounter.uuid,
+            {
+                # Parsed, so that unchanged timestamps compare equal.
+                k: _parse_datetime(v) if k in DATETIME_FIELDS else v
+                for k, v in encounter_data.items()
+                if k in updatable
+            },
+        )
 
-    encounter_dict = encounter.to_dict()
-    publish.publish_encounter_update(encounter_dict)
+    with publish.transaction():
+        _flush_and_reload(encounter)
+        Encounter.sync_latest_encounters([encounter_data["patient_uuid"]])
+        encounter_dict = encounter.to_dict()
+        publish.publish_encounter_update(encounter_dict)
+    get_patient_count_cache().invalidate([encounter_dict["location_uuid"]])
 
     return encounter_dict
 
 
+def _flush_and_reload(encounter: Encounter) -> None:
+    """
+    Flushes the session and expires its objects as a commit would, so that dicts built
+    before the commit (to publish with it) hold the values as stored in the database.
+    The encounter is then reloaded with both its histories in a single query.
+    """
+    db.session.flush()
+    # Read before expiring, or reading it would reload the encounter.
+    encounter_uuid = encounter.uuid
+    db.session.expire_all()
+    db.session.query(Encounter).options(
+        joinedload(Encounter.score_system_history),
+        joinedload(Encounter.location_history),
+    ).filter(Encounter.uuid == encounter_uuid).one()
+
+
+def _get_encounter_for_update(
+    encounter_id: str, encounter_data: Dict
+) -> Tuple[Encounter, Optional[Encounter]]:
+    """
+    Loads an encounter to update, and everything the update reads, in a single query:
+    its open_encounter_by_location row, its score system history if that is going to be
+    appended to, and the parent encounter named by child_of_encounter_uuid. The parent
+    (if it exists) is returned too, because the session only holds weak references and
+    it has to stay there until Encounter.update() looks it up.
+    """
+    options = [joinedload(Encounter.open_encounter)]
+    if "score_system" in encounter_data or "spo2_scale" in encounter_data:
+        options.append(joinedload(Encounter.score_system_history))
+    parent_uuid: Optional[str] = encounter_data.get("child_of_encounter_uuid")
+    uuids = {encounter_id, parent_uuid} - {None}
+
+    encounters: List[Encounter] = (
+        db.session.query(Encounter)
+        .options(*options)
+        .filter(Encounter.uuid.in_(uuids))
+        .all()
+    )
+    by_uuid = {e.uuid: e for e in encounters}
+    if encounter_id not in by_uuid:
+        abort(404)
+    return by_uuid[encounter_id], by_uuid.get(parent_uuid) if parent_uuid else None
+
+
 def get_encounter(encounter_id: str, show_deleted: bool = None) -> Dict:
     encounter: Encounter = (
         db.session.query(Encounter)
         .options(
-            joinedload("score_system_history"),
-            joinedload("location_history"),
+            selectinload(Encounter.score_system_history),
+            selectinload(Encounter.location_history),
         )
         .get_or_404(encounter_id)
     )
@@ -81,36 +199,69 @@ def get_encounter(encounter_id: str, show_deleted: bool = None) -> Dict:
 
 def get_child_encounters(parent_encounter: str, show_deleted: bool = None) -> List[str]:
     """
-    Example of generated SQL:
+    Returns the uuids of all descendants of an encounter, see `get_child_encounters_bulk`.
+    """
+    return get_child_encounters_bulk([parent_encounter], show_deleted=show_deleted)[
+        parent_encounter
+    ]
 
-        WITH RECURSIVE combined(uuid) AS
-        (SELECT CAST(%(param_1)s AS VARCHAR(36)) AS uuid UNION ALL SELECT child.uuid AS child_uuid
-        FROM encounter AS child JOIN combined AS parent ON parent.uuid = child.parent_uuid AND child.deleted_at IS NULL)
-         SELECT combined.uuid AS combined_uuid
-        FROM combined
-        WHERE combined.uuid != %(param_1)s
+
+def get_child_encounters_bulk(
+    parent_encounters: List[str], show_deleted: Optional[bool] = None
+) -> Dict[str, List[str]]:
     """
+    Finds the descendants of many encounters with a single query on the encounter_closure table.
 
-    param_parent = literal(parent_encounter)
-    rec = db.session.query(cast(param_parent, Encounter.uuid.type).label("uuid")).cte(
-        recursive=True, name="combined"
-    )
-    parent_alias = orm.aliased(rec, name="parent")
-    child_alias = orm.aliased(Encounter, name="child")
+    Returns a dict mapping each of the given encounter uuids to the uuids of its
+    child encounters at any depth, nearest descendants first. Unless show_deleted is
+    set, deleted encounters and anything below them are left out.
 
-    join_condition = parent_alias.c.uuid == child_alias.parent_uuid
-    if show_deleted is not True:
-        join_condition = and_(join_condition, child_alias.deleted_at == None)
+    Example of generated SQL:
 
-    combined = rec.union_all(
-        db.session.query(child_alias.uuid).join(parent_alias, join_condition)
+        SELECT encounter_closure.ancestor_uuid, encounter_closure.descendant_uuid
+        FROM encounter_closure JOIN encounter ON encounter.uuid = encounter_closure.descendant_uuid
+        WHERE encounter_closure.ancestor_uuid IN (__[POSTCOMPILE_parent_uuids])
+        AND encounter.deleted_at IS NULL AND NOT (EXISTS (SELECT *
+        FROM encounter_closure AS path JOIN encounter AS path_encounter ON path_encounter.uuid = path.ancestor_uuid
+        WHERE path.descendant_uuid = encounter_closure.descendant_uuid
+        AND path.depth < encounter_closure.depth AND path_encounter.deleted_at IS NOT NULL))
+        ORDER BY encounter_closure.depth
+    """
+    results: Dict[str, List[str]] = {uuid: [] for uuid in parent_encounters}
+    if not results:
+        return results
+
+    query = db.session.query(
+        EncounterClosure.ancestor_uuid, EncounterClosure.descendant_uuid
+    ).filter(
+        EncounterClosure.ancestor_uuid.in_(bindparam("parent_uuids", expanding=True))
     )
-    query = db.session.query(combined).filter(combined.c.uuid != param_parent)
-    results = [uuid for (uuid,) in query.all()]
+    if show_deleted is not True:
+        # Exclude deleted descendants and those below a deleted encounter.
+        path = orm.aliased(EncounterClosure, name="path")
+        path_encounter = orm.aliased(Encounter, name="path_encounter")
+        deleted_on_path = (
+            db.session.query(path)
+            .join(path_encounter, path_encounter.uuid == path.ancestor_uuid)
+            .filter(
+                path.descendant_uuid == EncounterClosure.descendant_uuid,
+                path.depth < EncounterClosure.depth,
+                path_encounter.deleted_at.isnot(None),
+            )
+            .exists()
+        )
+        query = query.join(
+            Encounter, Encounter.uuid == EncounterClosure.descendant_uuid
+        ).filter(Encounter.deleted_at.is_(None), ~deleted_on_path)
+
+    query = query.order_by(EncounterClosure.depth).params(parent_uuids=list(results))
+    for ancestor_uuid, descendant_uuid in query.all():
+        results[ancestor_uuid].append(descendant_uuid)
+
     logger.debug(
-        "Found %d child encounters for encounter %s",
+        "Found %d child encounters for %d encounters",
+        sum(len(children) for children in results.values()),
         len(results),
-        parent_encounter,
     )
     return results
 
@@ -121,13 +272,7 @@ def get_open_local_encounters_for_patient(patient_id: str) -> List[str]:
     Does not get child encounter records
     """
     query = (
-        Encounter.query.filter(Encounter.patient_uuid == patient_id)
-        .filter(Encounter.parent_uuid.is_(None))
-        .filter(Encounter.discharged_at.is_(None))
-        .filter(Encounter.deleted_at.is_(None))
-        .filter(
-            or_(Encounter.epr_encounter_id.is_(None), Encounter.epr_encounter_id == "")
-        )
+        _build_open_local_encounters_query([patient_id])
         .order_by(Encounter.admitted_at.desc())
         .with_entities(Encounter.uuid)
     )
@@ -140,8 +285,236 @@ def get_open_local_encounters_for_patient(patient_id: str) -> List[str]:
     return results
 
 
+def _build_open_local_encounters_query(patient_ids: List[str]) -> orm.Query:
+    return (
+        Encounter.query.filter(Encounter.patient_uuid.in_(patient_ids))
+        .filter(Encounter.parent_uuid.is_(None))
+        .filter(Encounter.discharged_at.is_(None))
+        .filter(Encounter.deleted_at.is_(None))
+        .filter(
+            or_(Encounter.epr_encounter_id.is_(None), Encounter.epr_encounter_id == "")
+        )
+    )
+
+
+def create_encounters(encounter_list: List[Dict]) -> Dict:
+    """
+    Creates a batch of encounters in a single transaction: either all of them are created or none.
+
+    Applies the same checks as create_encounter, with the duplicate local encounter check done for
+    every patient in one query. Local encounters earlier in the batch count as existing for later ones.
+    The encounters are inserted with one multi-row INSERT per table and the encounter update
+    messages are published together once the transaction has committed.
+
+    :return: The number of encounters created and their UUIDs, in request order
+    """
+    if len(encounter_list) > MAX_BULK_CREATE_SIZE:
+        raise ValueError(
+            f"Cannot create more than {MAX_BULK_CREATE_SIZE} encounters in one request"
+        )
+
+    can_edit_ews = g.jwt_claims.get("can_edit_ews", False)
+    for encounter_data in encounter_list:
+        if not encounter_data.get("patient_uuid", None):
+            raise UnprocessibleEntityException(f"Patient UUID not given")
+        if encounter_data.get("spo2_scale", None) not in [None, 1] and not can_edit_ews:
+            raise PermissionError(
+                f"Cannot create encounter with spo2_scale set to {encounter_data['spo2_scale']}"
+            )
+
+    local_patient_ids = {
+        encounter_data["patient_uuid"]
+        for encounter_data in encounter_list
+        if not encounter_data.get("epr_encounter_id", None)
+    }
+    open_local_encounters: Dict[str, str] = {}
+    if local_patient_ids:
+        open_local_encounters = dict(
+            _build_open_local_encounters_query(list(local_patient_ids)).with_entities(
+                Encounter.patient_uuid, Encounter.uuid
+            )
+        )
+
+    encounters: List[Encounter] = []
+    for encounter_data in encounter_list:
+        patient_uuid = encounter_data["patient_uuid"]
+        is_local = not encounter_data.get("epr_encounter_id", None)
+        if is_local and patient_uuid in open_local_encounters:
+            raise DuplicateResourceException(
+                f"A local encounter '{open_local_encounters[patient_uuid]}' already exists"
+            )
+
+        # Assigning the primary key up front lets the ORM batch the INSERTs.
+        encounter = Encounter.new(uuid=generate_uuid(), **encounter_data)
+        if is_local and encounter.is_open:
+            open_local_encounters[patient_uuid] = encounter.uuid
+        encounters.append(encounter)
+
+    # Read before committing, the commit expires the encounters.
+    uuids = [encounter.uuid for encounter in encounters]
+    location_uuids = {encounter.location_uuid for encounter in encounters}
+    try:
+        with publish.transaction():
+            db.session.flush()
+            Encounter.sync_latest_encounters(
+                encounter_data["patient_uuid"] for encounter_data in encounter_list
+            )
+            publish.publish_encounter_updates(uuids)
+    except IntegrityError as e:
+        if "epr_encounter_id_deleted_at" in str(e):
+            raise DuplicateResourceException(
+                "An EPR encounter in the batch already exists"
+            )
+        raise
+    get_patient_count_cache().invalidate(location_uuids)
+
+    return {"created": len(uuids), "uuids": uuids}
+
+
+def upsert_encounters(encounter_list: List[Dict]) -> Dict:
+    """
+    Creates or updates a batch of EPR encounters in a single transaction, for bulk feeds
+    such as dhos-async-adapter. Each encounter is matched by epr_encounter_id to an
+    encounter that hasn't been deleted: if there is one its updatable fields are
+    updated, otherwise the encounter is created. Later items in the batch apply on top
+    of earlier ones with the same epr_encounter_id.
+
+    All existing and parent encounters are loaded in one query and the changes are
+    written in one flush, except that the changes are also flushed before an encounter
+    is moved in the encounter tree if an earlier one in the batch was. No audit
+    messages are published; a single batch of encounter update messages is, for the
+    encounters that were created or actually changed. Score system changes to existing
+    encounters must be made with update_encounter, which publishes the messages they
+    need.
+
+    :return: The numbers of encounters created and updated, and the UUIDs of all of them
+        in request order
+    """
+    if len(encounter_list) > MAX_BULK_CREATE_SIZE:
+        raise ValueError(
+            f"Cannot upsert more than {MAX_BULK_CREATE_SIZE} encounters in one request"
+        )
+    can_edit_ews = g.jwt_claims.get("can_edit_ews", False)
+    for encounter_data in encounter_list:
+        if not encounter_data.get("epr_encounter_id", None):
+            raise UnprocessibleEntityException("EPR encounter ID not given")
+        if not encounter_data.get("patient_uuid", None):
+            raise UnprocessibleEntityException("Patient UUID not given")
+        if encounter_data.get("spo2_scale", None) not in [None, 1] and not can_edit_ews:
+            raise PermissionError(
+                f"Cannot create encounter with spo2_scale set to {encounter_data['spo2_scale']}"
+            )
+
+    epr_encounter_ids = {e["epr_encounter_id"] for e in encounter_list}
+    parent_uuids = {
+        e["child_of_encounter_uuid"]
+        for e in encounter_list
+        if e.get("child_of_encounter_uuid")
+    }
+    # Parents are kept referenced so that Encounter.update() finds them in the session.
+    loaded: List[Encounter] = (
+        db.session.query(Encounter)
+        .options(joinedload(Encounter.open_encounter))
+        .filter(
+            or_(
+                and_(
+                    Encounter.epr_encounter_id.in_(epr_encounter_ids),
+                    Encounter.deleted_at.is_(None),
+                ),
+                Encounter.uuid.in_(parent_uuids),
+            )
+        )
+        .all()
+    )
+    existing: Dict[str, Encounter] = {
+        encounter.epr_encounter_id: encounter
+        for encounter in loaded
+        if encounter.epr_encounter_id in epr_encounter_ids
+        and encounter.deleted_at is None
+    }
+
+    updatable = Encounter.schema()["updatable"]
+    uuids: List[str] = []
+    created: Set[str] = set()
+    changed: Set[str] = set()
+    location_uuids: Set[Optional[str]] = set()
+    latest_patient_uuids: Set[str] = set()
+    # Whether encounter_closure rows added for the batch are waiting to be flushed.
+    closure_pending = False
+    try:
+        with db.session.no_autoflush:
+            for encounter_data in encounter_list:
+                encounter = existing.get(encounter_data["epr_encounter_id"])
+                parent_uuid = encounter_data.get("child_of_encounter_uuid")
+                if parent_uuid and (
+                    encounter is None or parent_uuid != encounter.parent_uuid
+                ):
+                    # The closure rows are found and deleted with queries, which must
+                    # see the rows added for earlier encounters in the batch.
+                    if closure_pending:
+                        db.session.flush()
+                    closure_pending = True
+                if encounter is None:
+                    encounter = Encounter.new(uuid=generate_uuid(), **encounter_data)
+                    existing[encounter.epr_encounter_id] = encounter
+                    created.add(encounter.uuid)
+                    latest_patient_uuids.add(encounter.patient_uuid)
+                else:
+                    is_new = encounter.uuid in created
+                    if not is_new:
+                        _check_no_score_system_change(encounter, encounter_data)
+                        location_uuids.add(encounter.location_uuid)
+                    encounter.update(
+                        **{
+                            # Parsed, so that unchanged timestamps compare equal.
+                            k: _parse_datetime(v) if k in DATETIME_FIELDS else v
+                            for k, v in encounter_data.items()
+                            if k in updatable
+                        }
+                    )
+                    changes = {} if is_new else encounter.pending_changes()
+                    if changes:
+                        changed.add(encounter.uuid)
+                    if any(f in changes for f in Encounter.LATEST_ENCOUNTER_FIELDS):
+                        latest_patient_uuids.add(encounter.patient_uuid)
+                uuids.append(encounter.uuid)
+                location_uuids.add(encounter.location_uuid)
+
+        # Request order, without repeats.
+        notify = list(dict.fromkeys(u for u in uuids if u in created or u in changed))
+        with publish.transaction():
+            db.session.flush()
+            Encounter.sync_latest_encounters(latest_patient_uuids)
+            publish.publish_encounter_updates(notify)
+    except IntegrityError as e:
+        if "epr_encounter_id_deleted_at" in str(e):
+            raise DuplicateResourceException(
+                "An EPR encounter in the batch was created by another request"
+            )
+        raise
+    get_patient_count_cache().invalidate(location_uuids)
+
+    return {"created": len(created), "updated": len(changed), "uuids": uuids}
+
+
+def _parse_datetime(value: Any) -> Any:
+    if isinstance(value, str) and value:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return value
+
+
+def _check_no_score_system_change(encounter: Encounter, encounter_data: Dict) -> None:
+    for field in ("score_system", "spo2_scale"):
+        value = encounter_data.get(field)
+        if value is not None and value != getattr(encounter, field):
+            raise UnprocessibleEntityException(
+                f"Cannot change {field} of encounter '{encounter.uuid}' in a batch, "
+                f"use PATCH /dhos/v1/encounter/{encounter.uuid}"
+            )
+
+
 def update_encounter(encounter_id: str, encounter_data: Dict) -> Dict:
-    encounter = Encounter.query.get_or_404(encounter_id)
+    encounter, _parent = _get_encounter_for_update(encounter_id, encounter_data)
     epr_encounter_id = (
         encounter.epr_encounter_id if encounter.epr_encounter_id else LOCAL_ENCOUNTER
     )
@@ -153,77 +526,83 @@ def update_encounter(encounter_id: str, encounter_data: Dict) -> Dict:
         (previous_spo2_scale != new_spo2_scale and new_spo2_scale)
         or (previous_score_system != new_score_system and new_score_system)
     ):
-        publish.publish_audit_event(
-            event_type="ews_change_failure",
-            event_data={
-                "clinician_id": current_jwt_user(),
-                "encounter_id": encounter.uuid,
-                "epr_encounter_id": epr_encounter_id,
-                "previous_spo2_scale": previous_spo2_scale,
-                "previous_score_system": previous_score_system,
-                "new_spo2_scale": new_spo2_scale,
-                "new_score_system": new_score_system,
-            },
-        )
+        with publish.transaction():
+            publish.publish_audit_event(
+                event_type="ews_change_failure",
+                event_data={
+                    "clinician_id": current_jwt_user(),
+                    "encounter_id": encounter.uuid,
+                    "epr_encounter_id": epr_encounter_id,
+                    "previous_spo2_scale": previous_spo2_scale,
+                    "previous_score_system": previous_score_system,
+                    "new_spo2_scale": new_spo2_scale,
+                    "new_score_system": new_score_system,
+                },
+            )
         raise PermissionError("User does not have permission to change EWS")
 
-    initial_encounter_dict = encounter.to_dict()
-    encounter.update(**encounter_data)
-    db.session.commit()
-    if (new_spo2_scale and new_spo2_scale != previous_spo2_scale) or (
-        new_score_system and new_score_system != previous_score_system
-    ):
-
-        publish.publish_audit_event(
-            event_type="score_system_changed",
-            event_data={
-                "clinician_id": current_jwt_user(),
-                "encounter_id": encounter.uuid,
-                "epr_encounter_id": epr_encounter_id,
-                "previous_score_system": previous_score_system,
-                "previous_spo2_scale": previous_spo2_scale,
-                "new_score_system": new_score_system,
-                "new_spo2_scale": new_spo2_scale,
-                "modified_by": encounter.modified_by,
-                "modified": encounter.modified,
-            },
-        )
-        publish.publish_score_system_change(encounter.to_dict(expanded=True))
-
-    encounter_dict = encounter.to_dict()
+    previous_location_uuid = encounter.location_uuid
+    # Without autoflush the attribute history holds every change made by the update.
+    with db.session.no_autoflush:
+        encounter.update(**encounter_data)
+        changes = encounter.pending_changes()
+    with publish.transaction():
+        _flush_and_reload(encounter)
+        if any(field in changes for field in Encounter.LATEST_ENCOUNTER_FIELDS):
+            Encounter.sync_latest_encounters([encounter.patient_uuid])
+        if (new_spo2_scale and new_spo2_scale != previous_spo2_scale) or (
+            new_score_system and new_score_system != previous_score_system
+        ):
 
-    if encounter_has_changed(initial_encounter_dict, encounter_dict):
-        publish.publish_encounter_update(encounter_dict)
-        if encounter.modified_by != "dhos-async-adapter":
-            modifications = list(diff(initial_encounter_dict, encounter_dict))
             publish.publish_audit_event(
-                event_type="encounter_modified",
+                event_type="score_system_changed",
                 event_data={
                     "clinician_id": current_jwt_user(),
                     "encounter_id": encounter.uuid,
-                    "modifications": modifications,
+                    "epr_encounter_id": epr_encounter_id,
+                    "previous_score_system": previous_score_system,
+                    "previous_spo2_scale": previous_spo2_scale,
+                    "new_score_system": new_score_system,
+                    "new_spo2_scale": new_spo2_scale,
+                    "modified_by": encounter.modified_by,
+                    "modified": encounter.modified,
                 },
             )
+            publish.publish_score_system_change(encounter.to_dict(expanded=True))
+
+        encounter_dict = encounter.to_dict()
+        modifications = encounter.modifications(changes, encounter_dict)
+
+        if modifications:
+            publish.publish_encounter_update(encounter_dict)
+            if encounter.modified_by != "dhos-async-adapter":
+                publish.publish_audit_event(
+                    event_type="encounter_modified",
+                    event_data={
+                        "clinician_id": current_jwt_user(),
+                        "encounter_id": encounter.uuid,
+                        "modifications": modifications,
+                    },
+                )
+    get_patient_count_cache().invalidate(
+        [previous_location_uuid, encounter_dict["location_uuid"]]
+    )
 
     return encounter_dict
 
 
-def encounter_has_changed(initial_encounter: Dict, encounter_updated: Dict) -> bool:
-    has_changed = False
-    for field in Encounter.schema()["updatable"]:
-        if initial_encounter.get(field) != encounter_updated.get(field):
-            has_changed = True
-            return has_changed
-    return has_changed
-
-
 def remove_from_encounter(encounter_id: str, details_to_delete: Dict) -> Dict:
     encounter = Encounter.query.get_or_404(encounter_id)
+    previous_location_uuid = encounter.location_uuid
     encounter.remove(**details_to_delete)
-    db.session.commit()
-
-    encounter_dict = encounter.to_dict()
-    publish.publish_encounter_update(encounter_dict)
+    with publish.transaction():
+        _flush_and_reload(encounter)
+        Encounter.sync_latest_encounters([encounter.patient_uuid])
+        encounter_dict = encounter.to_dict()
+        publish.publish_encounter_update(encounter_dict)
+    get_patient_count_cache().invalidate(
+        [previous_location_uuid, encounter_dict["location_uuid"]]
+    )
     return encounter_dict
 
 
@@ -250,48 +629,121 @@ def merge_encounters(
 
     Returns a count of updated encounters
     """
-    updated = 0
+    location_uuids = _merge_patient_encounters(
+        child_record_uuid=child_record_uuid,
+        parent_record_uuid=parent_record_uuid,
+        parent_patient_uuid=parent_patient_uuid,
+        message_uuid=message_uuid,
+    )
+    db.session.commit()
+    get_patient_count_cache().invalidate(set(location_uuids))
 
-    encounter: Encounter
-    for encounter in Encounter.query.filter(
-        Encounter.patient_record_uuid == child_record_uuid
-    ).all():
-        old_history: List = encounter.merge_history  # type:ignore
-        encounter.merge_history = old_history + [
-            {
-                "record_uuid": encounter.patient_record_uuid,
-                "patient_uuid": encounter.patient_uuid,
-                "message_uuid": message_uuid,
-            }
-        ]
-        encounter.patient_uuid = parent_patient_uuid
-        encounter.patient_record_uuid = parent_record_uuid
-        db.session.add(encounter)
-        extra = {
-            "child_record_uuid": child_record_uuid,
-            "parent_record_uuid": parent_record_uuid,
-            "parent_patient_uuid": parent_patient_uuid,
-            "message_uuid": message_uuid,
-        }
-        if encounter.epr_encounter_id:
+    return {"total": len(location_uuids)}
+
+
+def merge_encounters_batch(merges: List[Dict]) -> Dict:
+    """
+    Applies several patient merges, in order, in a single transaction.
+    A merge may move encounters that an earlier merge in the batch moved.
+
+    Returns a count of updated encounters across all merges
+    """
+    for merge in merges:
+        if merge["child_record_uuid"] == merge["parent_record_uuid"]:
+            raise ValueError(f"Cannot merge identical patient records")
+
+    location_uuids: List[str] = []
+    for merge in merges:
+        location_uuids += _merge_patient_encounters(
+            child_record_uuid=merge["child_record_uuid"],
+            parent_record_uuid=merge["parent_record_uuid"],
+            parent_patient_uuid=merge["parent_patient_uuid"],
+            message_uuid=merge["message_uuid"],
+        )
+    db.session.commit()
+    get_patient_count_cache().invalidate(set(location_uuids))
+
+    return {"total": len(location_uuids)}
+
+
+def _merge_patient_encounters(
+    child_record_uuid: str,
+    parent_record_uuid: str,
+    parent_patient_uuid: str,
+    message_uuid: str,
+) -> List[str]:
+    """
+    Moves all encounters for the child record with one UPDATE, appending the old patient and
+    record to merge_history in the database. Returns the location of each merged encounter.
+    """
+    # merge_history may be NULL or a JSON null on older rows.
+    merge_history = cast(Encounter.merge_history, JSONB)
+    previous_merge_history = case(
+        [(func.jsonb_typeof(merge_history) == "array", merge_history)],
+        else_=func.jsonb_build_array(),
+    )
+    merge_history_entry = func.jsonb_build_object(
+        "record_uuid",
+        Encounter.patient_record_uuid,
+        "patient_uuid",
+        Encounter.patient_uuid,
+        "message_uuid",
+        message_uuid,
+    )
+    merged = db.session.execute(
+        update(Encounter.__table__)
+        .where(Encounter.patient_record_uuid == child_record_uuid)
+        .values(
+            patient_uuid=parent_patient_uuid,
+            patient_record_uuid=parent_record_uuid,
+            merge_history=cast(
+                previous_merge_history.op("||")(
+                    func.jsonb_build_array(merge_history_entry)
+                ),
+                JSON,
+            ),
+        )
+        .returning(Encounter.uuid, Encounter.epr_encounter_id, Encounter.location_uuid)
+    ).all()
+    if not merged:
+        return []
+
+    merged_uuids = [encounter_uuid for encounter_uuid, _, _ in merged]
+    db.session.execute(
+        update(OpenEncounterByLocation.__table__)
+        .where(OpenEncounterByLocation.encounter_uuid.in_(merged_uuids))
+        .values(patient_uuid=parent_patient_uuid)
+    )
+    # The patients whose latest encounter was moved need a new one.
+    moved_from = db.session.query(LatestEncounterByPatient.patient_uuid).filter(
+        LatestEncounterByPatient.encounter_uuid.in_(merged_uuids)
+    )
+    Encounter.sync_latest_encounters(
+        [parent_patient_uuid, *(patient_uuid for (patient_uuid,) in moved_from)]
+    )
+
+    extra = {
+        "child_record_uuid": child_record_uuid,
+        "parent_record_uuid": parent_record_uuid,
+        "parent_patient_uuid": parent_patient_uuid,
+        "message_uuid": message_uuid,
+    }
+    for encounter_uuid, epr_encounter_id, _ in merged:
+        if epr_encounter_id:
             logger.info(
                 "Merged encounter %s(%s)",
-                encounter.epr_encounter_id,
-                encounter.uuid,
+                epr_encounter_id,
+                encounter_uuid,
                 extra=extra,
             )
         else:
             logger.info(
                 "Merged local encounter (%s)",
-                encounter.uuid,
+                encounter_uuid,
                 extra=extra,
             )
 
-        updated += 1
-
-    db.session.commit()
-
-    return {"total": updated}
+    return [location_uuid for _, _, location_uuid in merged]
 
 
 def get_open_encounters_for_locations(
@@ -308,12 +760,18 @@ def get_open_encounters_for_locations(
     :param compact: Return a shorter structure
     :return: An array of encounters
     """
+    # Currently open encounters are found through the open_encounter_by_location projection
     query = _build_latest_encounter_query(
-        search_field=Encounter.location_uuid,
+        search_field=Encounter.location_uuid
+        if open_as_of is not None
+        else OpenEncounterByLocation.location_uuid,
         values=location_ids,
         open_as_of=open_as_of,
         compact=compact,
+        join_open_encounter=open_as_of is None,
     )
+    if compact:
+        return _compact_results(query)
 
     return [encounter.to_dict(compact=compact) for encounter in query.all()]
 
@@ -333,8 +791,10 @@ def get_open_encounters_for_patients(
     :return: An array of encounters
     """
     query = _build_latest_encounter_query(
-        Encounter.patient_uuid, patient_ids, open_as_of
+        Encounter.patient_uuid, patient_ids, open_as_of, compact=bool(compact)
     )
+    if compact:
+        return _compact_results(query, expanded=bool(expanded))
 
     return [
         encounter.to_dict(compact=compact, expanded=expanded)
@@ -347,22 +807,108 @@ def retrieve_patient_count_for_locations(
 ) -> Dict[str, int]:
     """
     Returns a dict of location: patient count for all of the given locations that have at least one patient.
+    Counts of currently open encounters (no open_as_of) are served from the patient count cache
+    where possible, only the locations missing from the cache are counted in the database.
     :param location_ids: A list of locations to be returned.
     :param open_as_of:
     :return:
     """
-    query = (
-        _build_encounter_query([(Encounter.location_uuid, location_ids)], open_as_of)
-        .with_entities(
-            Encounter.location_uuid, func.count(distinct(Encounter.patient_uuid))
+    if open_as_of is not None:
+        return _count_patients_for_locations(location_ids, open_as_of)
+
+    cache = get_patient_count_cache()
+    counts: Dict[str, int] = cache.get_many(location_ids)
+    missing = [uuid for uuid in set(location_ids) if uuid not in counts]
+    if missing:
+        found = _count_patients_for_locations(missing, open_as_of=None)
+        # Cache the empty locations too, they are the most common.
+        fetched = {uuid: found.get(uuid, 0) for uuid in missing}
+        cache.set_many(fetched)
+        counts.update(fetched)
+
+    return {uuid: count for uuid, count in counts.items() if count}
+
+
+def _count_patients_for_locations(
+    location_ids: List[str], open_as_of: Optional[str]
+) -> Dict[str, int]:
+    if open_as_of is None:
+        query = (
+            db.session.query(
+                OpenEncounterByLocation.location_uuid,
+                func.count(distinct(OpenEncounterByLocation.patient_uuid)),
+            )
+            .filter(OpenEncounterByLocation.location_uuid.in_(location_ids))
+            .group_by(OpenEncounterByLocation.location_uuid)
+        )
+    else:
+        query = (
+            _build_encounter_query(
+                [(Encounter.location_uuid, location_ids)], open_as_of
+            )
+            .with_entities(
+                Encounter.location_uuid, func.count(distinct(Encounter.patient_uuid))
+            )
+            .group_by(Encounter.location_uuid)
         )
-        .group_by(Encounter.location_uuid)
-    )
     return {
         location_uuid: patient_count for (location_uuid, patient_count) in query.all()
     }
 
 
+def get_latest_encounters_for_patients(
+    patient_ids: List[str],
+    open_as_of: Optional[str] = None,
+    compact: bool = False,
+) -> Dict[str, Dict]:
+    """
+    Return a dict of patient uuid: latest encounter for each of the given patients.
+
+    Patients with no matching encounter are omitted. Without open_as_of discharged
+    encounters are included but open encounters are preferred, and the encounters are
+    read from the latest_encounter_by_patient projection. Runs a fixed number of
+    queries regardless of how many patients are requested.
+
+    :param patient_ids: The uuids of the relevant patients
+    :param open_as_of: Latest date that an encounter can still be considered open
+    :param compact: Return a shorter structure
+    :return: A dict of patient uuid to encounter
+    """
+    if not patient_ids:
+        return {}
+
+    if open_as_of is None:
+        # Primary key reads of the latest_encounter_by_patient projection
+        query = Encounter.query.join(
+            LatestEncounterByPatient,
+            LatestEncounterByPatient.encounter_uuid == Encounter.uuid,
+        ).filter(LatestEncounterByPatient.patient_uuid.in_(patient_ids))
+        if not compact:
+            query = query.options(
+                selectinload(Encounter.score_system_history),
+                selectinload(Encounter.location_history),
+            )
+    else:
+        query = _build_latest_encounter_query(
+            search_field=Encounter.patient_uuid,
+            values=patient_ids,
+            open_as_of=open_as_of,
+            compact=compact,
+        )
+    if compact:
+        result = _compact_results(query)
+    else:
+        result = [encounter.to_dict() for encounter in query.all()]
+
+    if compact is not True:
+        _add_child_encounter_uuids(result)
+
+    logger.debug(
+        "Found latest encounters for %d of %d patients", len(result), len(patient_ids)
+    )
+    return {encounter["patient_uuid"]: encounter for encounter in result}
+
+
 def get_encounters_by_patient_or_epr_id(
     patient_id: str = None,
     epr_encounter_id: str = None,
@@ -404,6 +950,11 @@ def get_encounters_by_patient_or_epr_id(
         Encounter.admitted_at.desc(),
         Encounter.created.desc(),
     )
+    if compact is not True:
+        query = query.options(
+            selectinload(Encounter.score_system_history),
+            selectinload(Encounter.location_history),
+        )
 
     result = [
         encounter.to_dict(compact=compact, expanded=expanded)
@@ -412,10 +963,7 @@ def get_encounters_by_patient_or_epr_id(
 
     logger.debug("Found %d encounters", len(result))
     if compact is not True:
-        for encounter in result:
-            encounter["child_encounter_uuids"] = get_child_encounters(
-                encounter["uuid"], show_deleted=True
-            )
+        _add_child_encounter_uuids(result)
     return result
 
 
@@ -428,14 +976,22 @@ def get_open_encounters_for_patient(
         [patient_id], open_as_of=open_as_of, compact=compact, expanded=expanded
     )
     if compact is not True:
-        for encounter in result:
-            encounter["child_encounter_uuids"] = get_child_encounters(
-                encounter["uuid"], show_deleted=True
-            )
+        _add_child_encounter_uuids(result)
 
     return result
 
 
+def _add_child_encounter_uuids(encounters: List[Dict]) -> None:
+    """
+    Sets child_encounter_uuids (including deleted children) on each of the encounter dicts
+    """
+    child_encounters = get_child_encounters_bulk(
+        [encounter["uuid"] for encounter in encounters], show_deleted=True
+    )
+    for encounter in encounters:
+        encounter["child_encounter_uuids"] = child_encounters[encounter["uuid"]]
+
+
 def _build_latest_encounter_query(
     search_field: Any,
     values: List[str],
@@ -443,6 +999,8 @@ def _build_latest_encounter_query(
     show_children: bool = False,
     show_deleted: bool = False,
     compact: bool = False,
+    show_discharged: bool = False,
+    join_open_encounter: bool = False,
 ) -> orm.Query:
     """
     Returns a Query that will find only the latest matching encounter for each patient.
@@ -452,20 +1010,27 @@ def _build_latest_encounter_query(
     :param open_as_of:
     :param show_children:
     :param show_deleted:
+    :param compact: Don't eager load the history relationships
+    :param show_discharged: Include discharged encounters (open encounters still sort first)
+    :param join_open_encounter: Join the open_encounter_by_location projection, so that
+        search_field may be one of its columns
     :return:
     """
     base_query = Encounter.query.distinct(Encounter.patient_uuid)
+    if join_open_encounter:
+        base_query = base_query.join(Encounter.open_encounter)
     if not compact:
         base_query = base_query.options(
-            joinedload("score_system_history"),
-            joinedload("location_history"),
+            selectinload(Encounter.score_system_history),
+            selectinload(Encounter.location_history),
         )
 
     query = _build_encounter_query(
         [(search_field, values)],
         open_as_of,
-        show_deleted,
-        show_children,
+        show_discharged=show_discharged,
+        show_children=show_children,
+        show_deleted=show_deleted,
         base_query=base_query,
     ).order_by(
         Encounter.patient_uuid,
@@ -539,8 +1104,129 @@ def get_encounters(
     show_children: bool = False,
     expanded: bool = False,
 ) -> List[Dict]:
+    query: Query = _build_modified_since_query(
+        modified_since, show_deleted, show_children
+    ).order_by(Encounter.modified.desc())
+    if compact:
+        return _compact_results(query, expanded=expanded)
+
+    query = query.options(
+        selectinload(Encounter.score_system_history),
+        selectinload(Encounter.location_history),
+    )
+    return [enc.to_dict(compact=compact, expanded=expanded) for enc in query]
+
+
+def _compact_results(query: Query, expanded: bool = False) -> List[Dict]:
+    """
+    Returns compact encounter dicts for a query, selecting only the columns they need
+    and building the dicts straight from the rows rather than loading Encounter objects.
+    """
+    return [
+        Encounter.compact_dict(row, expanded=expanded)
+        for row in query.with_entities(*Encounter.compact_columns(expanded)).all()
+    ]
+
+
+def iter_encounters(
+    modified_since: str,
+    compact: bool = False,
+    show_deleted: bool = False,
+    show_children: bool = False,
+    expanded: bool = False,
+) -> Iterator[Dict]:
+    """
+    Same results as `get_encounters` but fetched from the database in batches of
+    STREAM_BATCH_SIZE, so that only one batch is held in memory at a time.
+    """
+    query: Query = _build_modified_since_query(
+        modified_since, show_deleted, show_children
+    ).order_by(Encounter.modified.desc())
+    if compact is False:
+        query = query.options(
+            selectinload(Encounter.score_system_history),
+            selectinload(Encounter.location_history),
+        )
+
+    for encounter in query.yield_per(STREAM_BATCH_SIZE):
+        yield encounter.to_dict(compact=compact, expanded=expanded)
+
+
+def get_encounters_page(
+    modified_since: str,
+    page_size: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    compact: bool = False,
+    show_deleted: bool = False,
+    show_children: bool = False,
+    expanded: bool = False,
+) -> Dict[str, Any]:
+    """
+    Returns one page of the encounters modified after modified_since, in ascending
+    (modified, uuid) order, along with a cursor for the following page.
+
+    Paging is by keyset so each page costs the same however far through the results it is,
+    and encounters modified while paging through are picked up on a later page.
+
+    :param modified_since: Only encounters modified after this time are returned
+    :param page_size: Maximum number of encounters in the page
+    :param cursor: The `next` value from the previous page, if any
+    :return: A dict with the encounters as `results` and the `next` cursor, which is
+        None when there are no more encounters.
+    """
+    if not 1 <= page_size <= MAX_PAGE_SIZE:
+        raise ValueError(f"page_size must be between 1 and {MAX_PAGE_SIZE}")
+
+    query: Query = _build_modified_since_query(
+        modified_since, show_deleted, show_children
+    )
+    if cursor is not None:
+        last_modified, last_uuid = _decode_cursor(cursor)
+        query = query.filter(
+            tuple_(Encounter.modified, Encounter.uuid) > (last_modified, last_uuid)
+        )
+    if compact is False:
+        query = query.options(
+            selectinload(Encounter.score_system_history),
+            selectinload(Encounter.location_history),
+        )
+
+    encounters: List[Encounter] = (
+        query.order_by(Encounter.modified, Encounter.uuid).limit(page_size + 1).all()
+    )
+    next_cursor: Optional[str] = None
+    if len(encounters) > page_size:
+        encounters = encounters[:page_size]
+        next_cursor = _encode_cursor(encounters[-1])
+
+    return {
+        "results": [
+            enc.to_dict(compact=compact, expanded=expanded) for enc in encounters
+        ],
+        "next": next_cursor,
+    }
+
+
+def _encode_cursor(encounter: Encounter) -> str:
+    position = json.dumps([encounter.modified.isoformat(), encounter.uuid])
+    return base64.urlsafe_b64encode(position.encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        modified, uuid = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(modified), uuid
+    except (binascii.Error, TypeError, ValueError):
+        raise ValueError("Invalid cursor")
+
+
+def _build_modified_since_query(
+    modified_since: str,
+    show_deleted: bool = False,
+    show_children: bool = False,
+) -> Query:
     conditions: List = [Encounter.modified > modified_since]
-    options: List = []
 
     if show_deleted is False:
         conditions.append(Encounter.deleted_at.is_(None))
@@ -548,15 +1234,4 @@ def get_encounters(
     if show_children is False:
         conditions.append(Encounter.parent_uuid.is_(None))
 
-    if compact is False:
-        options.append(joinedload(Encounter.score_system_history))
-        options.append(joinedload(Encounter.location_history))
-
-    query: Query = (
-        db.session.query(Encounter)
-        .filter(*conditions)
-        .options(*options)
-        .order_by(Encounter.modified.desc())
-    )
-
-    return [enc.to_dict(compact=compact, expanded=expanded) for enc in query]
+    return db.session.query(Encounter).filter(*conditions)
@@ -1,14 +1,414 @@
+"""
+Messages published to RabbitMQ.
+
+MESSAGE_PUBLISH_MODE selects how messages are sent:
+  - "direct" (default): sent from the request, once the changes that produced them
+    have been committed
+  - "outbox": written to the outbox_message table in the same transaction as those
+    changes, and sent later by the relay (`flask relay-outbox`), so a message is never
+    lost or sent for a change that was rolled back and broker latency is kept out of
+    the request.
+  - "async": handed to a background thread once the changes have been committed. The
+    thread keeps one broker connection open, so the request does not wait for the
+    broker, but messages still queued when the process is killed are lost.
+Messages sent by the relay or the background thread are published to the
+kombu_batteries_included exchange, with its settings, under the request ID of the
+request that published them.
+"""
+import atexit
+import json
+import queue
+import threading
+import time
 import uuid
-from typing import Any, Dict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
 import kombu_batteries_included
+from environs import Env
+from flask import Flask, current_app
+from flask_batteries_included.sqldb import db
+from kombu import Connection, Producer
+from kombu.exceptions import OperationalError
+from kombu_batteries_included import config as kbi_config
+from kombu_batteries_included import infra as kbi_infra
 from she_logging import logger
+from she_logging.request_id import current_request_id, reset_request_id, set_request_id
+
+from dhos_encounters_api.models.outbox_message import OutboxMessage
+
+EXTENSION_NAME = "message_publish_mode"
+ASYNC_PUBLISHER_EXTENSION_NAME = "async_publisher"
+PUBLISH_MODES = ("direct", "outbox", "async")
+DEFAULT_RELAY_BATCH_SIZE = 100
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_QUEUE_TIMEOUT = 1.0
+DEFAULT_CLOSE_TIMEOUT = 10.0
+DEFAULT_PUBLISH_ATTEMPTS = 5
+MAX_RETRY_INTERVAL = 30.0
+
+# Notifications that only name what has changed, so repeats can be collapsed into one.
+COALESCED_ROUTING_KEYS = ("dhos.DM000007",)
+
+# (routing key, JSON encoded body, correlation id)
+Message = Tuple[str, str, Optional[str]]
+
+# Key in db.session.info for the direct sends waiting for a transaction() to commit.
+_PENDING_MESSAGES = "pending_messages"
+
+
+def init_publish(app: Flask, mode: Optional[str] = None) -> None:
+    env = Env()
+    if mode is None:
+        mode = env.str("MESSAGE_PUBLISH_MODE", "direct")
+    if mode not in PUBLISH_MODES:
+        raise ValueError(f"Unknown MESSAGE_PUBLISH_MODE '{mode}'")
+    if mode == "async":
+        publisher = AsyncPublisher(
+            maxsize=env.int("MESSAGE_QUEUE_SIZE", DEFAULT_QUEUE_SIZE),
+            timeout=env.float("MESSAGE_QUEUE_TIMEOUT", DEFAULT_QUEUE_TIMEOUT),
+            coalesce_interval=env.float("MESSAGE_COALESCE_INTERVAL", 0),
+            max_attempts=env.int("MESSAGE_PUBLISH_ATTEMPTS", DEFAULT_PUBLISH_ATTEMPTS),
+        )
+        publisher.start()
+        atexit.register(publisher.close)
+        app.extensions[ASYNC_PUBLISHER_EXTENSION_NAME] = publisher
+    app.extensions[EXTENSION_NAME] = mode
+    app.logger.info("Publishing messages in %s mode", mode)
+
+
+def _publish_mode() -> str:
+    return current_app.extensions.get(EXTENSION_NAME, "direct")
+
+
+@contextmanager
+def transaction() -> Iterator[None]:
+    """
+    Commits the session at the end of the block, together with the messages published
+    inside it: in outbox mode they are part of the same transaction, otherwise they are
+    sent once the commit has succeeded. If the block or the commit fails nothing is sent.
+    """
+    pending: List[Callable[[], None]] = []
+    db.session.info[_PENDING_MESSAGES] = pending
+    try:
+        yield
+        db.session.commit()
+    finally:
+        del db.session.info[_PENDING_MESSAGES]
+    for send in pending:
+        send()
+
+
+def _send_after_commit(send: Callable[[], None]) -> None:
+    pending: Optional[List] = db.session.info.get(_PENDING_MESSAGES)
+    if pending is not None:
+        pending.append(send)
+    else:
+        send()
+
+
+def _publish(routing_key: str, body: Any) -> None:
+    mode = _publish_mode()
+    if mode == "outbox":
+        db.session.add(
+            OutboxMessage(
+                routing_key=routing_key,
+                body=_encode(body),
+                correlation_id=current_request_id(),
+            )
+        )
+    elif mode == "async":
+        _send_after_commit(
+            partial(
+                _async_publisher().put,
+                (routing_key, _encode(body), current_request_id()),
+            )
+        )
+    else:
+        _send_after_commit(
+            partial(
+                kombu_batteries_included.publish_message,
+                routing_key=routing_key,
+                body=body,
+            )
+        )
+
+
+def _encode(body: Any) -> str:
+    """
+    Encodes a message body to be sent later. Datetimes are converted the same way
+    kombu_batteries_included does, so the decoded body is sent unchanged.
+    """
+
+    def convert(o: Any) -> str:
+        if isinstance(o, datetime):
+            if o.tzinfo is None:
+                o = o.replace(tzinfo=timezone.utc)
+            return o.isoformat(timespec="milliseconds")
+        raise TypeError(f"Cannot encode {type(o)} to JSON")
+
+    return json.dumps(body, default=convert)
+
+
+def _can_send() -> bool:
+    if kbi_config.RABBITMQ_DISABLED:
+        logger.debug("Skipping RabbitMQ message publish due to config")
+        return False
+    if not kbi_config.INITIALISED:
+        raise ValueError("kombu-batteries-included has not been initialised")
+    return True
+
+
+def _send_message(
+    producer: Producer, message: Message, retry_policy: Optional[Dict] = None
+) -> None:
+    """
+    Publishes an encoded message the way kombu_batteries_included.publish_message
+    does, under the request ID it was published with.
+    """
+    routing_key, body, correlation_id = message
+    token = set_request_id(correlation_id) if correlation_id is not None else None
+    try:
+        logger.debug("Publishing %s message", routing_key, extra={"message_body": body})
+        producer.publish(
+            body=body,
+            exchange=kbi_infra.TASK_EXCHANGE_NAME,
+            routing_key=routing_key,
+            content_type="application/text",
+            compression=kbi_config.RABBITMQ_COMPRESSION,
+            retry=True,
+            retry_policy=retry_policy,
+            timestamp=int(time.time()),
+            correlation_id=current_request_id(),
+        )
+    finally:
+        if token is not None:
+            reset_request_id(token)
+
+
+def _send_messages(messages: Sequence[Message]) -> None:
+    """Sends messages in order over a single broker connection."""
+    if not _can_send():
+        return
+    with Connection(kombu_batteries_included.get_connection_string()) as conn:
+        producer: Producer = Producer(conn)
+        for message in messages:
+            _send_message(producer, message)
+
+
+def _coalesce(messages: Sequence[Message]) -> List[Message]:
+    """
+    Drops coalesced messages that are repeated later in the list, keeping the last of
+    each, so that the notification still follows every change it stands for.
+    """
+    last = {m[:2]: i for i, m in enumerate(messages) if m[0] in COALESCED_ROUTING_KEYS}
+    return [
+        m
+        for i, m in enumerate(messages)
+        if m[0] not in COALESCED_ROUTING_KEYS or last[m[:2]] == i
+    ]
+
+
+class AsyncPublisher:
+    """
+    Sends messages from a bounded in-process queue on a background thread, which holds
+    one broker connection open between messages.
+
+    When the queue is full put() waits up to `timeout` seconds for space, then sends the
+    message itself over a new connection, so a slow broker slows requests down rather
+    than messages being dropped. close() sends the messages still queued.
+
+    A message that fails is tried up to `max_attempts` times, reconnecting after a
+    broker error and waiting twice as long before each retry, starting from
+    `retry_interval` seconds. A message that still fails is logged with its body and
+    dropped, so it does not hold up the messages queued behind it.
+
+    If `coalesce_interval` is set, encounter update (DM000007) messages are held for that
+    many seconds and any identical message queued in the meantime is dropped, so an
+    encounter changed several times in quick succession is notified once, after the
+    last change. Held messages may be sent after other messages queued later.
+    """
+
+    _STOP = None
+
+    def __init__(
+        self,
+        maxsize: int = DEFAULT_QUEUE_SIZE,
+        timeout: float = DEFAULT_QUEUE_TIMEOUT,
+        coalesce_interval: float = 0,
+        retry_interval: float = 1.0,
+        max_attempts: int = DEFAULT_PUBLISH_ATTEMPTS,
+    ) -> None:
+        self.queue: "queue.Queue[Optional[Message]]" = queue.Queue(maxsize=maxsize)
+        self.timeout = timeout
+        self.coalesce_interval = coalesce_interval
+        self.retry_interval = retry_interval
+        self.max_attempts = max_attempts
+        self._thread: Optional[threading.Thread] = None
+        # Held messages and when to send them, by (routing key, body). Every message
+        # is held for the same interval, so they are due in insertion order.
+        self._held: Dict[Tuple[str, str], Tuple[float, Message]] = {}
+        self._connection: Optional[Connection] = None
+        self._producer: Optional[Producer] = None
+
+    def start(self) -> None:
+        self._thread = threading.Thread(
+            target=self._run, name="async-publisher", daemon=True
+        )
+        self._thread.start()
+
+    def put(self, message: Message) -> None:
+        try:
+            self.queue.put(message, timeout=self.timeout)
+        except queue.Full:
+            logger.warning("Message queue is full, publishing %s directly", message[0])
+            _send_messages([message])
+
+    def close(self, timeout: float = DEFAULT_CLOSE_TIMEOUT) -> None:
+        """
+        Waits up to `timeout` seconds for the queued and held messages to be sent, then
+        stops the thread.
+        """
+        if self._thread is None:
+            return
+        self.queue.put(self._STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.error(
+                "Gave up waiting for %d queued messages to be published",
+                self.queue.qsize() + len(self._held),
+            )
+        self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                message = self.queue.get(timeout=self._next_due())
+            except queue.Empty:
+                self._send_due()
+                continue
+            if message is self._STOP:
+                break
+            if self.coalesce_interval and message[0] in COALESCED_ROUTING_KEYS:
+                if message[:2] in self._held:
+                    logger.debug("Coalesced %s message", message[0])
+                else:
+                    self._held[message[:2]] = (
+                        time.monotonic() + self.coalesce_interval,
+                        message,
+                    )
+            else:
+                self._send(message)
+            self._send_due()
+
+        for _, message in self._held.values():
+            self._send(message)
+        self._held.clear()
+        self._disconnect()
+
+    def _next_due(self) -> Optional[float]:
+        """Seconds until the next held message is due, or None to wait indefinitely."""
+        if not self._held:
+            return None
+        due, _ = next(iter(self._held.values()))
+        return max(0.0, due - time.monotonic())
+
+    def _send_due(self) -> None:
+        now = time.monotonic()
+        while self._held:
+            key, (due, message) = next(iter(self._held.items()))
+            if due > now:
+                return
+            self._send(message)
+            del self._held[key]
+
+    def _send(self, message: Message) -> None:
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if _can_send():
+                    # The thread retries itself, so kombu only reconnects once.
+                    _send_message(
+                        self._get_producer(), message, retry_policy={"max_retries": 1}
+                    )
+                return
+            except OperationalError:
+                logger.warning(
+                    "Lost broker connection publishing %s message",
+                    message[0],
+                    exc_info=True,
+                )
+                self._disconnect()
+            except Exception:
+                logger.exception("Failed to publish %s message", message[0])
+            if attempt < self.max_attempts:
+                time.sleep(
+                    min(self.retry_interval * 2 ** (attempt - 1), MAX_RETRY_INTERVAL)
+                )
+        logger.error(
+            "Dropped %s message after %d attempts",
+            message[0],
+            self.max_attempts,
+            extra={"message_body": message[1], "correlation_id": message[2]},
+        )
+
+    def _get_producer(self) -> Producer:
+        if self._connection is None or self._producer is None:
+            self._connection = Connection(
+                kombu_batteries_included.get_connection_string(),
+                transport_options={"max_retries": 1},
+            )
+            self._producer = Producer(self._connection)
+        return self._producer
+
+    def _disconnect(self) -> None:
+        if self._connection is not None:
+            self._connection.release()
+        self._connection = self._producer = None
+
+
+def _async_publisher() -> AsyncPublisher:
+    return current_app.extensions[ASYNC_PUBLISHER_EXTENSION_NAME]
+
+
+def relay_outbox(batch_size: int = DEFAULT_RELAY_BATCH_SIZE) -> int:
+    """
+    Sends the oldest batch of outbox messages and deletes them, returning how many were
+    sent. Repeated encounter update messages in the batch are sent once. Rows are
+    locked with SKIP LOCKED so several relays can run at once. If sending fails the
+    transaction is rolled back and the batch is sent again on the next call, so
+    consumers may occasionally see a message twice.
+    """
+    messages: List[OutboxMessage] = (
+        db.session.query(OutboxMessage)
+        .order_by(OutboxMessage.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not messages:
+        db.session.rollback()
+        return 0
+    try:
+        _send_messages(
+            _coalesce([(m.routing_key, m.body, m.correlation_id) for m in messages])
+        )
+        db.session.query(OutboxMessage).filter(
+            OutboxMessage.id.in_([m.id for m in messages])
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.debug("Relayed %d outbox messages", len(messages))
+    return len(messages)
 
 
 def publish_audit_event(event_type: str, event_data: Dict[str, Any]) -> None:
     audit = {"event_type": event_type, "event_data": event_data}
     logger.debug(f"Publishing audit message of type {event_type}")
-    kombu_batteries_included.publish_message(routing_key="dhos.34837004", body=audit)
+    _publish(routing_key="dhos.34837004", body=audit)
 
 
 # DM000005 - Observation set with encounter
@@ -44,11 +444,30 @@ def publish_score_system_change(encounter: Dict) -> None:
             }
         ]
     }
-    kombu_batteries_included.publish_message(routing_key="dhos.DM000005", body=body)
+    _publish(routing_key="dhos.DM000005", body=body)
 
 
 def publish_encounter_update(encounter: Dict) -> None:
     logger.debug("Publishing encounter update", extra={"encounter_data": encounter})
-    kombu_batteries_included.publish_message(
-        routing_key="dhos.DM000007", body={"encounter_id": encounter.get("uuid")}
-    )
+    _publish(routing_key="dhos.DM000007", body={"encounter_id": encounter.get("uuid")})
+
+
+def publish_encounter_updates(encounter_uuids: List[str]) -> None:
+    """
+    Publishes the same DM000007 message as publish_encounter_update for each encounter.
+    In direct mode they are sent over a single broker connection rather than one
+    connection per message.
+    """
+    if not encounter_uuids:
+        return
+    logger.debug("Publishing %d encounter updates", len(encounter_uuids))
+    if _publish_mode() != "direct":
+        for encounter_uuid in encounter_uuids:
+            _publish(routing_key="dhos.DM000007", body={"encounter_id": encounter_uuid})
+        return
+    correlation_id = current_request_id()
+    messages = [
+        ("dhos.DM000007", _encode({"encounter_id": encounter_uuid}), correlation_id)
+        for encounter_uuid in encounter_uuids
+    ]
+    _send_after_commit(partial(_send_messages, messages))
@@ -2,21 +2,40 @@
 from typing import Any, Dict, List
 
 from flask import g
+from flask_batteries_included.helpers import generate_uuid
 from flask_batteries_included.helpers.error_handler import UnprocessibleEntityException
 from flask_batteries_included.sqldb import db
 from she_logging.logging import logger
 
+from dhos_encounters_api.helpers.patient_count_cache import get_patient_count_cache
 from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
 from dhos_encounters_api.models.location_history import LocationHistory
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
+from dhos_encounters_api.models.outbox_message import OutboxMessage
 from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
 
 
 def reset_database() -> None:
     """Drops SQL data"""
     try:
-        for model in (ScoreSystemHistory, LocationHistory, Encounter):
+        for model in (
+            OutboxMessage,
+            LatestEncounterByPatient,
+            OpenEncounterByLocation,
+            EncounterClosure,
+            ScoreSystemHistory,
+            LocationHistory,
+            Encounter,
+        ):
             db.session.query(model).delete()
         db.session.commit()
+        get_patient_count_cache().clear()
     except Exception:
         logger.exception("Drop SQL data failed")
         db.session.rollback()
@@ -40,8 +59,25 @@ def create_many_encounters(encounter_list: List[Dict[str, Any]]) -> Dict[str, in
             )
         if "epr_encounter_id" in details and details["epr_encounter_id"] == "":
             details["epr_encounter_id"] = None
-        objects.append(Encounter(**details))
+        objects.append(
+            Encounter(uuid=details.pop("uuid", None) or generate_uuid(), **details)
+        )
 
-    db.session.bulk_save_objects(objects)
+    # bulk_save_objects() skips relationship cascades, so the open encounter
+    # projection rows are saved explicitly after their encounters.
+    projections = [
+        OpenEncounterByLocation(
+            encounter_uuid=encounter.uuid,
+            location_uuid=encounter.location_uuid,
+            patient_uuid=encounter.patient_uuid,
+        )
+        for encounter in objects
+        if encounter.is_open
+    ]
+    db.session.bulk_save_objects(objects + projections)
+    Encounter.sync_latest_encounters(encounter.patient_uuid for encounter in objects)
     db.session.commit()
+    get_patient_count_cache().invalidate(
+        {encounter.location_uuid for encounter in objects}
+    )
     return {"created": len(encounter_list)}
@@ -1,8 +1,14 @@
+import time
+
 import click
 from flask import Flask
+from flask_batteries_included.config import is_not_production_environment
 from flask_batteries_included.helpers.apispec import generate_openapi_spec
+from she_logging import logger
 
 from dhos_encounters_api import blueprint_api
+from dhos_encounters_api.blueprint_api import publish
+from dhos_encounters_api.helpers import synthetic_data
 from dhos_encounters_api.models.api_spec import dhos_encounter_api_spec
 
 
@@ -13,3 +19,46 @@ def add_cli_command(app: Flask) -> None:
         generate_openapi_spec(
             dhos_encounter_api_spec, output, blueprint_api.api_blueprint
         )
+
+    @app.cli.command("relay-outbox")
+    @click.option("--batch-size", default=publish.DEFAULT_RELAY_BATCH_SIZE)
+    @click.option(
+        "--interval", default=1.0, help="Seconds to wait when the outbox is empty."
+    )
+    @click.option("--once", is_flag=True, help="Empty the outbox, then exit.")
+    def relay_outbox(batch_size: int, interval: float, once: bool) -> None:
+        """Sends the messages in the outbox table to RabbitMQ."""
+        while True:
+            try:
+                sent = publish.relay_outbox(batch_size=batch_size)
+            except Exception:
+                if once:
+                    raise
+                logger.exception("Failed to relay outbox messages")
+                sent = 0
+            if sent < batch_size:
+                if once:
+                    return
+                time.sleep(interval)
+
+    @app.cli.command("seed-encounters")
+    @click.option("--patients", default=10_000, help="Number of patients to add.")
+    @click.option("--locations", default=500)
+    @click.option("--seed", default=0, help="Seed of the random number generator.")
+    @click.option("--batch-size", default=10_000, help="Patients per transaction.")
+    @click.option(
+        "--truncate", is_flag=True, help="Delete all encounters before seeding."
+    )
+    def seed_encounters(
+        patients: int, locations: int, seed: int, batch_size: int, truncate: bool
+    ) -> None:
+        """Adds synthetic encounters shaped like production data, for load testing."""
+        if not is_not_production_environment():
+            raise click.ClickException("Not available in production")
+        if truncate:
+            synthetic_data.truncate_tables()
+        counts = synthetic_data.generate_encounters(
+            patients=patients, locations=locations, seed=seed, batch_size=batch_size
+        )
+        for table, count in counts.items():
+            click.echo(f"{table}: {count} rows")
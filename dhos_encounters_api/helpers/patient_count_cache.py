@@ -0,0 +1,186 @@
+"""
+Cache of open-encounter patient counts per location, used by
+POST /dhos/v1/encounter/locations/patient_count.
+
+Entries are dropped by the encounter write paths for every location they touch, and
+also expire after PATIENT_COUNT_CACHE_TTL seconds so that writes made by another
+process (which cannot invalidate an in-process cache) are picked up in bounded time.
+
+The backend is selected with PATIENT_COUNT_CACHE_BACKEND:
+  - "local" (default): a dictionary held in this process
+  - "redis": shared between processes, using the REDIS_* connection settings. Needs
+    the redis and dhosredis packages, which are only imported for this backend.
+  - "none": disables caching
+Other backends can be plugged in by passing a PatientCountCache to
+init_patient_count_cache().
+"""
+import threading
+import time
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Tuple
+
+from environs import Env
+from flask import Flask, current_app
+from she_logging import logger
+
+if TYPE_CHECKING:
+    from redis import Redis
+
+EXTENSION_NAME = "patient_count_cache"
+DEFAULT_TTL = 30
+
+
+class PatientCountCache:
+    """Base class for patient count cache backends. Stores nothing."""
+
+    def get_many(self, location_uuids: Iterable[str]) -> Dict[str, int]:
+        """Returns the cached count for each location that has a cache entry."""
+        return {}
+
+    def set_many(self, counts: Dict[str, int]) -> None:
+        pass
+
+    def invalidate(self, location_uuids: Iterable[Optional[str]]) -> None:
+        pass
+
+    def clear(self) -> None:
+        pass
+
+
+class LocalPatientCountCache(PatientCountCache):
+    def __init__(self, ttl: int = DEFAULT_TTL) -> None:
+        self.ttl = ttl
+        self._entries: Dict[str, Tuple[float, int]] = {}
+        self._lock = threading.Lock()
+
+    def get_many(self, location_uuids: Iterable[str]) -> Dict[str, int]:
+        now = time.monotonic()
+        result: Dict[str, int] = {}
+        with self._lock:
+            for location_uuid in location_uuids:
+                entry = self._entries.get(location_uuid)
+                if entry is None:
+                    continue
+                expires, count = entry
+                if expires <= now:
+                    del self._entries[location_uuid]
+                else:
+                    result[location_uuid] = count
+        return result
+
+    def set_many(self, counts: Dict[str, int]) -> None:
+        expires = time.monotonic() + self.ttl
+        with self._lock:
+            for location_uuid, count in counts.items():
+                self._entries[location_uuid] = (expires, count)
+
+    def invalidate(self, location_uuids: Iterable[Optional[str]]) -> None:
+        with self._lock:
+            for location_uuid in location_uuids:
+                if location_uuid is not None:
+                    self._entries.pop(location_uuid, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisPatientCountCache(PatientCountCache):
+    """
+    Shared backend. Redis errors are logged and treated as cache misses so that the
+    endpoint falls back to the database rather than failing.
+    """
+
+    KEY_PREFIX = "dhos-encounters-api:patient_count:"
+
+    def __init__(self, client: "Redis", ttl: int = DEFAULT_TTL) -> None:
+        from redis import RedisError
+
+        self.client = client
+        self.ttl = ttl
+        self._redis_error = RedisError
+
+    def _key(self, location_uuid: str) -> str:
+        return f"{self.KEY_PREFIX}{location_uuid}"
+
+    def get_many(self, location_uuids: Iterable[str]) -> Dict[str, int]:
+        location_uuids = list(location_uuids)
+        if not location_uuids:
+            return {}
+        try:
+            values = self.client.mget([self._key(uuid) for uuid in location_uuids])
+        except self._redis_error:
+            logger.warning("Couldn't read patient counts from redis")
+            return {}
+        return {
+            location_uuid: int(value)
+            for location_uuid, value in zip(location_uuids, values)
+            if value is not None
+        }
+
+    def set_many(self, counts: Dict[str, int]) -> None:
+        if not counts:
+            return
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for location_uuid, count in counts.items():
+                pipeline.set(self._key(location_uuid), count, ex=self.ttl)
+            pipeline.execute()
+        except self._redis_error:
+            logger.warning("Couldn't write patient counts to redis")
+
+    def invalidate(self, location_uuids: Iterable[Optional[str]]) -> None:
+        keys = [self._key(uuid) for uuid in location_uuids if uuid is not None]
+        if not keys:
+            return
+        try:
+            self.client.delete(*keys)
+        except self._redis_error:
+            logger.exception("Couldn't invalidate patient counts in redis")
+
+    def clear(self) -> None:
+        try:
+            keys = list(self.client.scan_iter(match=f"{self.KEY_PREFIX}*"))
+            if keys:
+                self.client.delete(*keys)
+        except self._redis_error:
+            logger.exception("Couldn't clear patient counts in redis")
+
+
+def _create_redis_cache(ttl: int) -> RedisPatientCountCache:
+    import dhosredis
+    from redis import Redis
+
+    config = dhosredis.config
+    client = Redis(
+        host=config["REDIS_HOST"],
+        port=config["REDIS_PORT"],
+        password=config["REDIS_PASSWORD"],
+        db=0,
+        socket_timeout=config["REDIS_TIMEOUT"],
+        decode_responses=True,
+        ssl=config["REDIS_USE_SSL"],
+    )
+    return RedisPatientCountCache(client, ttl=ttl)
+
+
+def init_patient_count_cache(
+    app: Flask, backend: Optional[PatientCountCache] = None
+) -> None:
+    if backend is None:
+        env = Env()
+        name = env.str("PATIENT_COUNT_CACHE_BACKEND", "local")
+        ttl = env.int("PATIENT_COUNT_CACHE_TTL", DEFAULT_TTL)
+        if name == "local":
+            backend = LocalPatientCountCache(ttl=ttl)
+        elif name == "redis":
+            backend = _create_redis_cache(ttl=ttl)
+        elif name == "none":
+            backend = PatientCountCache()
+        else:
+            raise ValueError(f"Unknown PATIENT_COUNT_CACHE_BACKEND '{name}'")
+    app.extensions[EXTENSION_NAME] = backend
+    app.logger.info("Using %s for patient counts", type(backend).__name__)
+
+
+def get_patient_count_cache() -> PatientCountCache:
+    return current_app.extensions[EXTENSION_NAME]
@@ -0,0 +1,139 @@
+"""
+Opt-in per-request SQL instrumentation, enabled with SQL_INSTRUMENTATION=true.
+
+Every statement a request executes is counted and timed through SQLAlchemy engine
+events. The totals are:
+  - added to the response as a Server-Timing header, with the statements executed
+    before the response was returned: `db` is their count and total time and
+    `db-slowest` the time of the slowest one
+  - logged when the request ends, including statements executed while streaming the
+    response body, in the `sqlStatements` field: count, durationMs, slowestDurationMs
+    and the text of the slowest statement as slowestStatement
+Statements executed outside of a request (CLI commands, background threads) are not
+recorded.
+"""
+import time
+from typing import Any, Optional
+
+import sqlalchemy
+from environs import Env
+from flask import Flask, current_app, g, has_request_context, request
+from she_logging import logger
+from sqlalchemy.engine import Engine
+from werkzeug import Response
+
+EXTENSION_NAME = "sql_instrumentation"
+# Longest statement text logged as slowestStatement.
+MAX_LOGGED_STATEMENT_LENGTH = 1000
+
+_START_TIME = "sql_instrumentation_start"
+
+
+class SqlStatistics:
+    """The statements executed by one request."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.duration = 0.0
+        self.slowest_duration = 0.0
+        self.slowest_statement: Optional[str] = None
+
+    def add(self, statement: str, duration: float) -> None:
+        self.count += 1
+        self.duration += duration
+        if duration >= self.slowest_duration:
+            self.slowest_duration = duration
+            self.slowest_statement = statement
+
+    def server_timing(self) -> str:
+        return (
+            f'db;dur={self.duration * 1000:.2f};desc="{self.count} statements", '
+            f"db-slowest;dur={self.slowest_duration * 1000:.2f}"
+        )
+
+
+def init_sql_instrumentation(app: Flask, enabled: Optional[bool] = None) -> None:
+    if enabled is None:
+        enabled = Env().bool("SQL_INSTRUMENTATION", False)
+    app.extensions[EXTENSION_NAME] = enabled
+    # The engine is created on first use, so listen to all engines. The listeners
+    # do nothing unless instrumentation is enabled for the current app.
+    for name, listener in [
+        ("before_cursor_execute", _before_cursor_execute),
+        ("after_cursor_execute", _after_cursor_execute),
+    ]:
+        if not sqlalchemy.event.contains(Engine, name, listener):
+            sqlalchemy.event.listen(Engine, name, listener)
+    app.before_request(_start_sql_statistics)
+    app.after_request(_add_server_timing)
+    app.teardown_request(_log_sql_statistics)
+    if enabled:
+        app.logger.info("SQL instrumentation enabled")
+
+
+def get_sql_statistics() -> Optional[SqlStatistics]:
+    """The statements executed so far by the current request, if instrumented."""
+    if not has_request_context() or not current_app.extensions.get(EXTENSION_NAME):
+        return None
+    return g.get("sql_statistics")
+
+
+def _start_sql_statistics() -> None:
+    if current_app.extensions.get(EXTENSION_NAME):
+        g.sql_statistics = SqlStatistics()
+
+
+def _before_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    if get_sql_statistics() is not None:
+        conn.info[_START_TIME] = time.perf_counter()
+
+
+def _after_cursor_execute(
+    conn: Any,
+    cursor: Any,
+    statement: str,
+    parameters: Any,
+    context: Any,
+    executemany: bool,
+) -> None:
+    start = conn.info.pop(_START_TIME, None)
+    statistics = get_sql_statistics()
+    if start is not None and statistics is not None:
+        statistics.add(statement, time.perf_counter() - start)
+
+
+def _add_server_timing(response: Response) -> Response:
+    statistics = get_sql_statistics()
+    if statistics is not None and statistics.count:
+        response.headers.add("Server-Timing", statistics.server_timing())
+    return response
+
+
+def _log_sql_statistics(exc: Optional[BaseException]) -> None:
+    statistics = get_sql_statistics()
+    if statistics is None or not statistics.count:
+        return
+    logger.info(
+        "%s %s executed %d SQL statements in %.2fms",
+        request.method,
+        request.path,
+        statistics.count,
+        statistics.duration * 1000,
+        extra={
+            "sqlStatements": {
+                "count": statistics.count,
+                "durationMs": round(statistics.duration * 1000, 2),
+                "slowestDurationMs": round(statistics.slowest_duration * 1000, 2),
+                "slowestStatement": (statistics.slowest_statement or "")[
+                    :MAX_LOGGED_STATEMENT_LENGTH
+                ],
+            }
+        },
+    )
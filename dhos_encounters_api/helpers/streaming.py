@@ -0,0 +1,21 @@
+from typing import Any, Iterable, Iterator
+
+from flask import Response, current_app, stream_with_context
+
+
+def json_array_response(items: Iterable[Any]) -> Response:
+    """
+    Streams items to the client as a JSON array, serialising one item at a time.
+    """
+    return Response(
+        stream_with_context(_json_array_chunks(items)), mimetype="application/json"
+    )
+
+
+def _json_array_chunks(items: Iterable[Any]) -> Iterator[str]:
+    separator = "["
+    for item in items:
+        yield separator
+        yield current_app.json.dumps(item)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
@@ -0,0 +1,495 @@
+"""
+Generator of synthetic encounters shaped like a trust's production data, for load
+testing and benchmarks. Used by the `flask seed-encounters` command.
+
+The data has:
+  - skewed location occupancy: location popularity follows a Zipf distribution
+  - several encounters per patient over time, the latest one possibly still open
+  - EPR child encounter trees several levels deep
+  - location histories with a long tail of moves
+  - SpO2 scale changes recorded in score_system_history
+  - local (no EPR id) and deleted encounters
+  - merge histories on the encounters of merged patients
+
+Rows are written with COPY, a batch of patients at a time, along with the
+encounter_closure, open_encounter_by_location and latest_encounter_by_patient rows
+that the API would have maintained. Needs Postgres.
+"""
+import bisect
+import io
+import itertools
+import json
+import random
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from flask_batteries_included.sqldb import db
+from she_logging import logger
+from sqlalchemy import Table, func
+
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
+from dhos_encounters_api.models.location_history import LocationHistory
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
+from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
+
+# In the order they are written, so that foreign keys are satisfied.
+TABLES: Sequence[Table] = (
+    Encounter.__table__,
+    EncounterClosure.__table__,
+    LocationHistory.__table__,
+    ScoreSystemHistory.__table__,
+    OpenEncounterByLocation.__table__,
+    LatestEncounterByPatient.__table__,
+)
+# The columns of the generated rows of each table, in order.
+_COLUMNS: Dict[str, Sequence[str]] = {
+    Encounter.__table__.name: (
+        "uuid",
+        "created",
+        "created_by_",
+        "modified",
+        "modified_by_",
+        "epr_encounter_id",
+        "encounter_type",
+        "admitted_at",
+        "discharged_at",
+        "deleted_at",
+        "spo2_scale",
+        "location_uuid",
+        "dh_product_uuid",
+        "patient_record_uuid",
+        "patient_uuid",
+        "parent_uuid",
+        "score_system",
+        "merge_history",
+    ),
+    EncounterClosure.__table__.name: ("ancestor_uuid", "descendant_uuid", "depth"),
+    LocationHistory.__table__.name: (
+        "uuid",
+        "created",
+        "created_by_",
+        "modified",
+        "modified_by_",
+        "encounter_uuid",
+        "location_uuid",
+        "arrived_at",
+        "departed_at",
+    ),
+    ScoreSystemHistory.__table__.name: (
+        "uuid",
+        "created",
+        "created_by_",
+        "modified",
+        "modified_by_",
+        "encounter_uuid",
+        "score_system",
+        "previous_score_system",
+        "spo2_scale",
+        "previous_spo2_scale",
+        "changed_time",
+    ),
+    OpenEncounterByLocation.__table__.name: (
+        "encounter_uuid",
+        "location_uuid",
+        "patient_uuid",
+    ),
+    LatestEncounterByPatient.__table__.name: ("patient_uuid", "encounter_uuid"),
+}
+
+CREATED_BY = "synthetic-data"
+START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+MAX_LOCATION_MOVES = 200
+# Matches the EPR ids given to generated encounters.
+EPR_ID_PATTERN = "^EPR[0-9]{10}$"
+
+
+def generate_encounters(
+    patients: int,
+    locations: int = 500,
+    seed: int = 0,
+    batch_size: int = 10_000,
+    encounters_per_patient: float = 3.0,
+    open_ratio: float = 0.3,
+    deleted_ratio: float = 0.02,
+    local_ratio: float = 0.1,
+    child_tree_ratio: float = 0.05,
+    max_tree_depth: int = 4,
+    score_change_ratio: float = 0.1,
+    merge_ratio: float = 0.01,
+    location_skew: float = 0.8,
+) -> Dict[str, int]:
+    """
+    Adds synthetic encounters for the given number of new patients, committing after
+    every batch_size patients. The same seed always generates the same data into empty
+    tables. Encounters already in the tables are added to: EPR ids carry on from the
+    largest generated one, and the number of existing encounters is mixed into the
+    seed, so running again with the same seed adds new patients at the same locations.
+
+    :param patients: Number of patients to generate encounters for
+    :param locations: Number of locations the encounters are spread over
+    :param seed: Seed of the random number generator
+    :param batch_size: Patients per COPY batch and transaction
+    :param encounters_per_patient: Mean number of (parent) encounters per patient
+    :param open_ratio: Proportion of patients whose latest encounter is still open
+    :param deleted_ratio: Proportion of encounters that are deleted
+    :param local_ratio: Proportion of patients whose encounters have no EPR id
+    :param child_tree_ratio: Proportion of EPR encounters with a tree of child encounters
+    :param max_tree_depth: Greatest depth of a child encounter tree
+    :param score_change_ratio: Proportion of encounters with SpO2 scale changes
+    :param merge_ratio: Proportion of patients that had another patient merged into them
+    :param location_skew: Zipf exponent of location popularity, 0 for uniform
+    :return: The number of rows written to each table
+    """
+    existing_encounters: int = db.session.query(func.count(Encounter.uuid)).scalar()
+    last_epr_id: Optional[str] = (
+        db.session.query(func.max(Encounter.epr_encounter_id))
+        .filter(Encounter.epr_encounter_id.op("~")(EPR_ID_PATTERN))
+        .scalar()
+    )
+    rng = random.Random(seed)
+    generator = _EncounterGenerator(
+        rng=rng,
+        locations=locations,
+        encounters_per_patient=encounters_per_patient,
+        open_ratio=open_ratio,
+        deleted_ratio=deleted_ratio,
+        local_ratio=local_ratio,
+        child_tree_ratio=child_tree_ratio,
+        max_tree_depth=max_tree_depth,
+        score_change_ratio=score_change_ratio,
+        merge_ratio=merge_ratio,
+        location_skew=location_skew,
+        first_epr_id=int(last_epr_id[3:]) + 1 if last_epr_id else 1,
+    )
+    if existing_encounters:
+        # After the locations are drawn, so that they stay the same.
+        rng.seed(f"{seed}:{existing_encounters}")
+    counts: Dict[str, int] = {table.name: 0 for table in TABLES}
+    for start in range(0, patients, batch_size):
+        batch = min(batch_size, patients - start)
+        for _ in range(batch):
+            generator.add_patient()
+        for table, rows in generator.take_rows().items():
+            _copy_rows(table, rows)
+            counts[table.name] += len(rows)
+        db.session.commit()
+        logger.info(
+            "Generated encounters for %d of %d patients", start + batch, patients
+        )
+
+    analyze_tables()
+    return counts
+
+
+def truncate_tables() -> None:
+    """
+    Deletes all encounters, along with their history and projection rows, and refreshes
+    the tables' statistics so that queries aren't planned for the deleted rows.
+    """
+    db.session.execute(f"TRUNCATE {', '.join(table.name for table in TABLES)}")
+    analyze_tables()
+
+
+def analyze_tables(statistics_target: Optional[int] = None) -> None:
+    """
+    Refreshes the planner statistics of the encounter tables. ANALYZE reads a random
+    sample of 300 rows per unit of statistics target, so a target high enough for the
+    sample to take in every row gives the same statistics, and plans, every time.
+    """
+    if statistics_target is not None:
+        db.session.execute(
+            f"SET LOCAL default_statistics_target = {int(statistics_target)}"
+        )
+    db.session.execute(f"ANALYZE {', '.join(table.name for table in TABLES)}")
+    db.session.commit()
+
+
+class _EncounterGenerator:
+    def __init__(
+        self,
+        rng: random.Random,
+        locations: int,
+        encounters_per_patient: float,
+        open_ratio: float,
+        deleted_ratio: float,
+        local_ratio: float,
+        child_tree_ratio: float,
+        max_tree_depth: int,
+        score_change_ratio: float,
+        merge_ratio: float,
+        location_skew: float,
+        first_epr_id: int = 1,
+    ) -> None:
+        self.rng = rng
+        self.encounters_per_patient = encounters_per_patient
+        self.open_ratio = open_ratio
+        self.deleted_ratio = deleted_ratio
+        self.local_ratio = local_ratio
+        self.child_tree_ratio = child_tree_ratio
+        self.max_tree_depth = max_tree_depth
+        self.score_change_ratio = score_change_ratio
+        self.merge_ratio = merge_ratio
+
+        self.location_uuids = [self._uuid() for _ in range(locations)]
+        self.location_weights = list(
+            itertools.accumulate(
+                1 / rank**location_skew for rank in range(1, locations + 1)
+            )
+        )
+        self.dh_product_uuid = self._uuid()
+        self.epr_ids = itertools.count(first_epr_id)
+        self.rows: Dict[Table, List[Tuple]] = {table: [] for table in TABLES}
+
+    def take_rows(self) -> Dict[Table, List[Tuple]]:
+        """Returns the rows generated since the last call, by table."""
+        rows, self.rows = self.rows, {table: [] for table in TABLES}
+        return rows
+
+    def add_patient(self) -> None:
+        rng = self.rng
+        patient_uuid, record_uuid = self._uuid(), self._uuid()
+        is_local = rng.random() < self.local_ratio
+        count = 1 + int(rng.expovariate(1 / max(self.encounters_per_patient - 1, 0.1)))
+
+        # The first encounters of a merged patient came from the other record.
+        merged = 0
+        merge_entry: Dict[str, str] = {}
+        if count > 1 and rng.random() < self.merge_ratio:
+            merged = rng.randint(1, count - 1)
+            merge_entry = {
+                "record_uuid": self._uuid(),
+                "patient_uuid": self._uuid(),
+                "message_uuid": self._uuid(),
+            }
+
+        latest: Optional[Tuple[Tuple, str]] = None
+        admitted_at = START + timedelta(days=rng.uniform(0, 365))
+        for index in range(count):
+            is_open = index == count - 1 and rng.random() < self.open_ratio
+            discharged_at = (
+                None
+                if is_open
+                else admitted_at + timedelta(hours=rng.lognormvariate(4.0, 1.0))
+            )
+            deleted = rng.random() < self.deleted_ratio
+            encounter_uuid = self._add_encounter(
+                patient_uuid=patient_uuid,
+                record_uuid=record_uuid,
+                location_uuid=self._location(),
+                admitted_at=admitted_at,
+                discharged_at=discharged_at,
+                deleted=deleted,
+                epr_encounter_id=None if is_local else self._epr_id(),
+                merge_history=[merge_entry] if index < merged else [],
+            )
+            if not is_local and rng.random() < self.child_tree_ratio:
+                self._add_child_tree(
+                    parent=[encounter_uuid],
+                    depth=rng.randint(1, self.max_tree_depth),
+                    patient_uuid=patient_uuid,
+                    record_uuid=record_uuid,
+                    admitted_at=admitted_at,
+                    discharged_at=discharged_at,
+                )
+            if not deleted:
+                # Open encounters first, then the latest admitted.
+                key = (discharged_at is None, admitted_at)
+                if latest is None or key > latest[0]:
+                    latest = (key, encounter_uuid)
+            admitted_at = (discharged_at or admitted_at) + timedelta(
+                days=rng.expovariate(1 / 90)
+            )
+
+        if latest is not None:
+            self.rows[LatestEncounterByPatient.__table__].append(
+                (patient_uuid, latest[1])
+            )
+
+    def _add_child_tree(
+        self,
+        parent: List[str],
+        depth: int,
+        patient_uuid: str,
+        record_uuid: str,
+        admitted_at: datetime,
+        discharged_at: Optional[datetime],
+    ) -> None:
+        """
+        Adds one or two children below parent[-1], and below each of them a tree depth - 1
+        levels deep. parent lists the ancestors of the new children, root first.
+        """
+        for _ in range(2 if self.rng.random() < 0.25 else 1):
+            child_uuid = self._add_encounter(
+                patient_uuid=patient_uuid,
+                record_uuid=record_uuid,
+                location_uuid=self._location(),
+                admitted_at=admitted_at,
+                discharged_at=discharged_at,
+                deleted=self.rng.random() < self.deleted_ratio,
+                epr_encounter_id=self._epr_id(),
+                merge_history=[],
+                ancestors=parent,
+            )
+            if depth > 1:
+                self._add_child_tree(
+                    parent=parent + [child_uuid],
+                    depth=depth - 1,
+                    patient_uuid=patient_uuid,
+                    record_uuid=record_uuid,
+                    admitted_at=admitted_at,
+                    discharged_at=discharged_at,
+                )
+
+    def _add_encounter(
+        self,
+        patient_uuid: str,
+        record_uuid: str,
+        location_uuid: str,
+        admitted_at: datetime,
+        discharged_at: Optional[datetime],
+        deleted: bool,
+        epr_encounter_id: Optional[str],
+        merge_history: List[Dict[str, str]],
+        ancestors: Sequence[str] = (),
+    ) -> str:
+        rng = self.rng
+        encounter_uuid = self._uuid()
+        created = admitted_at.replace(tzinfo=None)
+        modified = (discharged_at or admitted_at).replace(tzinfo=None)
+        deleted_at = admitted_at + timedelta(hours=1) if deleted else None
+
+        spo2_scale = 1
+        if rng.random() < self.score_change_ratio:
+            changed_time = admitted_at
+            for _ in range(rng.randint(1, 3)):
+                changed_time += timedelta(hours=rng.uniform(1, 48))
+                self.rows[ScoreSystemHistory.__table__].append(
+                    (
+                        *self._identifier(created),
+                        encounter_uuid,
+                        "news2",
+                        "news2",
+                        3 - spo2_scale,
+                        spo2_scale,
+                        changed_time,
+                    )
+                )
+                spo2_scale = 3 - spo2_scale
+
+        self.rows[Encounter.__table__].append(
+            (
+                encounter_uuid,
+                created,
+                CREATED_BY,
+                modified,
+                CREATED_BY,
+                epr_encounter_id,
+                "INPATIENT",
+                admitted_at,
+                discharged_at,
+                deleted_at,
+                spo2_scale,
+                location_uuid,
+                self.dh_product_uuid,
+                record_uuid,
+                patient_uuid,
+                ancestors[-1] if ancestors else None,
+                "news2",
+                merge_history,
+            )
+        )
+        self._add_location_history(
+            encounter_uuid, location_uuid, created, admitted_at, discharged_at
+        )
+        for depth, ancestor_uuid in enumerate(reversed(ancestors), start=1):
+            self.rows[EncounterClosure.__table__].append(
+                (ancestor_uuid, encounter_uuid, depth)
+            )
+        if discharged_at is None and not deleted and not ancestors:
+            self.rows[OpenEncounterByLocation.__table__].append(
+                (encounter_uuid, location_uuid, patient_uuid)
+            )
+        return encounter_uuid
+
+    def _add_location_history(
+        self,
+        encounter_uuid: str,
+        location_uuid: str,
+        created: datetime,
+        admitted_at: datetime,
+        discharged_at: Optional[datetime],
+    ) -> None:
+        """
+        Adds a long-tailed number of moves over the stay, ending at location_uuid.
+        """
+        moves = min(int(self.rng.paretovariate(1.2)), MAX_LOCATION_MOVES)
+        stay = (discharged_at or admitted_at + timedelta(days=2)) - admitted_at
+        arrivals = [admitted_at] + sorted(
+            admitted_at + stay * self.rng.random() for _ in range(moves - 1)
+        )
+        departures: List[Optional[datetime]] = [*arrivals[1:], discharged_at]
+        locations = [self._location() for _ in range(moves - 1)] + [location_uuid]
+        for location, arrived_at, departed_at in zip(locations, arrivals, departures):
+            self.rows[LocationHistory.__table__].append(
+                (
+                    *self._identifier(created),
+                    encounter_uuid,
+                    location,
+                    arrived_at,
+                    departed_at,
+                )
+            )
+
+    def _identifier(
+        self, created: datetime
+    ) -> Tuple[str, datetime, str, datetime, str]:
+        """uuid, created, created_by_, modified and modified_by_ of a new row."""
+        return self._uuid(), created, CREATED_BY, created, CREATED_BY
+
+    def _location(self) -> str:
+        index = bisect.bisect(
+            self.location_weights, self.rng.random() * self.location_weights[-1]
+        )
+        return self.location_uuids[min(index, len(self.location_uuids) - 1)]
+
+    def _epr_id(self) -> str:
+        return f"EPR{next(self.epr_ids):010d}"
+
+    def _uuid(self) -> str:
+        return str(uuid.UUID(int=self.rng.getrandbits(128), version=4))
+
+
+def _copy_rows(table: Table, rows: Iterable[Tuple]) -> None:
+    """Writes rows to the table with COPY, in the session's transaction."""
+    data = io.StringIO()
+    for row in rows:
+        data.write("\t".join(_copy_value(value) for value in row))
+        data.write("\n")
+    data.seek(0)
+    columns = ", ".join(_COLUMNS[table.name])
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY {table.name} ({columns}) FROM STDIN", data)
+
+
+def _copy_value(value: Any) -> str:
+    """Formats a value for COPY's text format."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
@@ -137,6 +137,20 @@ class EncounterRequestV2(EncounterRequest):
     )
 
 
+@openapi_schema(dhos_encounter_api_spec)
+class EncounterUpsertRequest(EncounterRequestV2):
+    class Meta:
+        title = "Encounter upsert request"
+        unknown = EXCLUDE
+        ordered = True
+
+    epr_encounter_id = fields.String(
+        required=True,
+        example="2017L2387461278",
+        description="EPR identifier used to find the encounter to update",
+    )
+
+
 @openapi_schema(dhos_encounter_api_spec)
 class EncounterResponse(Identifier):
     """Similar to EncounterRequest, but includes Identifier schema and some fields are in a different form."""
@@ -355,3 +369,71 @@ class EncounterMergeRequest(Schema):
         example="ed2ac4d5-10c6-48f5-8f38-6be68dec988c",
         description="The UUID of the message causing the merge",
     )
+
+
+@openapi_schema(dhos_encounter_api_spec)
+class EncounterPageResponse(Schema):
+    class Meta:
+        title = "A page of encounters"
+        unknown = RAISE
+        ordered = True
+
+        class Dict(TypedDict):
+            results: List[dict]
+            next: Optional[str]
+
+    results = fields.Nested(EncounterResponse, many=True)
+    next = fields.String(
+        required=True,
+        allow_none=True,
+        example="WyIyMDIwLTEyLTMwVDAwOjAwOjAwLjAwMDAwMSIsICJhYmMiXQ",
+        description="Cursor for the next page, null when there are no more encounters",
+    )
+
+
+@openapi_schema(dhos_encounter_api_spec)
+class EncounterBulkCreateResponse(Schema):
+    class Meta:
+        title = "Encounters created"
+        unknown = RAISE
+        ordered = True
+
+        class Dict(TypedDict):
+            created: int
+            uuids: List[str]
+
+    created = fields.Integer(
+        required=True, example=2, description="Number of encounters created"
+    )
+    uuids = fields.List(
+        fields.String(example="2126393f-c86b-4bf2-9f68-42bb03a7b68a"),
+        required=True,
+        description="UUIDs of the new encounters, in request order",
+    )
+
+
+@openapi_schema(dhos_encounter_api_spec)
+class EncounterBulkUpsertResponse(Schema):
+    class Meta:
+        title = "Encounters created or updated"
+        unknown = RAISE
+        ordered = True
+
+        class Dict(TypedDict):
+            created: int
+            updated: int
+            uuids: List[str]
+
+    created = fields.Integer(
+        required=True, example=1, description="Number of encounters created"
+    )
+    updated = fields.Integer(
+        required=True,
+        example=1,
+        description="Number of existing encounters that were changed",
+    )
+    uuids = fields.List(
+        fields.String(example="2126393f-c86b-4bf2-9f68-42bb03a7b68a"),
+        required=True,
+        description="UUIDs of the encounters, in request order",
+    )
@@ -1,14 +1,38 @@
 from datetime import datetime, timezone
-from typing import Any, Dict, List, Optional, Sequence, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 from flask_batteries_included.helpers import generate_uuid
 from flask_batteries_included.helpers.error_handler import UnprocessibleEntityException
 from flask_batteries_included.sqldb import ModelIdentifier, db
 from she_logging import logger
-from sqlalchemy import JSON, Column, DateTime, ForeignKey, Index, Integer, String, func
+from sqlalchemy import (
+    JSON,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    and_,
+    case,
+    delete,
+    func,
+    inspect,
+    or_,
+    select,
+)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import RelationshipProperty, relationship
+from sqlalchemy.orm.attributes import set_committed_value
 
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
 from dhos_encounters_api.models.location_history import LocationHistory
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
 from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
 
 
@@ -39,7 +63,7 @@ class Encounter(ModelIdentifier, db.Model):
         primaryjoin="Encounter.uuid == ScoreSystemHistory.encounter_uuid",
         cascade="all,delete",
     )
-    location_uuid = Column(String(length=36), nullable=False, index=True)
+    location_uuid = Column(String(length=36), nullable=False)
 
     location_history: RelationshipProperty = relationship(
         "LocationHistory",
@@ -52,16 +76,19 @@ class Encounter(ModelIdentifier, db.Model):
         String(length=36),
         nullable=False,
     )
-    patient_record_uuid = Column(
-        String(length=36),
-        nullable=False,
-    )
+    patient_record_uuid = Column(String(length=36), nullable=False, index=True)
     patient_uuid = Column(String(length=36), nullable=False, index=True)
     parent_uuid = Column(
         String(), ForeignKey("encounter.uuid"), index=True, nullable=True
     )
     score_system = Column(String(), nullable=True)
     merge_history = Column(JSON, default=[])
+    open_encounter: RelationshipProperty = relationship(
+        OpenEncounterByLocation,
+        uselist=False,
+        cascade="all,delete-orphan",
+        passive_deletes=True,
+    )
 
     __table_args__ = (
         Index(
@@ -70,6 +97,18 @@ class Encounter(ModelIdentifier, db.Model):
             func.coalesce(deleted_at, datetime(1970, 1, 1).isoformat()),
             unique=True,
         ),
+        Index("modified_idx", "modified"),
+        Index(
+            "open_idx",
+            patient_uuid,
+            admitted_at.desc(),
+            postgresql_where=and_(
+                parent_uuid.is_(None),
+                discharged_at.is_(None),
+                deleted_at.is_(None),
+                or_(epr_encounter_id.is_(None), epr_encounter_id == ""),
+            ),
+        ),
     )
 
     @property
@@ -80,6 +119,14 @@ class Encounter(ModelIdentifier, db.Model):
     def is_deleted(self) -> bool:
         return self.deleted_at is not None
 
+    @property
+    def is_open(self) -> bool:
+        return (
+            self.discharged_at is None
+            and self.deleted_at is None
+            and self.parent_uuid is None
+        )
+
     def __repr__(self) -> str:
         return f"<{self.__class__.__name__} {self.to_dict(compact=True)}"
 
@@ -99,6 +146,12 @@ class Encounter(ModelIdentifier, db.Model):
         if epr_encounter_id == "":
             epr_encounter_id = None  # Avoid triggering an integrity error for multiple local encounters
 
+        if child_of_encounter_uuid:
+            kwargs.setdefault("uuid", generate_uuid())
+            EncounterClosure.attach(
+                kwargs["uuid"], child_of_encounter_uuid, is_new=True
+            )
+
         obj = cls(
             dh_product_uuid=dh_product_uuid,
             location_uuid=location_uuid,
@@ -110,9 +163,82 @@ class Encounter(ModelIdentifier, db.Model):
             *args,
             **kwargs,
         )
+        obj.sync_open_encounter()
         db.session.add(obj)
         return obj
 
+    @classmethod
+    def upsert(
+        cls,
+        dh_product_uuid: str,
+        location_uuid: str,
+        patient_uuid: str,
+        patient_record_uuid: str,
+        epr_encounter_id: str,
+        location_history: Sequence[Dict] = (),
+        child_of_encounter_uuid: Optional[str] = None,
+        **kwargs: Any,
+    ) -> Tuple["Encounter", bool]:
+        """
+        Creates an EPR encounter with a single INSERT ... ON CONFLICT against the
+        epr_encounter_id_deleted_at index, so that concurrent requests for the same
+        epr_encounter_id can't both create it. If an encounter with that
+        epr_encounter_id (and deleted_at) already exists, it is returned unchanged but
+        locked until the end of the transaction, ready to be updated. The encounter is
+        matched against the ones that haven't been deleted: any deleted_at is only set
+        once the encounter has been created.
+
+        :return: The encounter, and whether it was created
+        """
+        uuid: str = kwargs.pop("uuid", None) or generate_uuid()
+        deleted_at = kwargs.pop("deleted_at", None)
+        table = cls.__table__
+        statement = insert(table).values(
+            uuid=uuid,
+            dh_product_uuid=dh_product_uuid,
+            location_uuid=location_uuid,
+            patient_record_uuid=patient_record_uuid,
+            patient_uuid=patient_uuid,
+            parent_uuid=child_of_encounter_uuid,
+            epr_encounter_id=epr_encounter_id,
+            **kwargs,
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=list(cls._epr_encounter_id_index().expressions),
+            # A no-op update, so that RETURNING gives the existing row and locks it.
+            set_={"epr_encounter_id": statement.excluded.epr_encounter_id},
+        ).returning(*table.columns)
+        obj: Encounter = (
+            db.session.execute(
+                select(cls)  # type: ignore
+                .from_statement(statement)
+                .execution_options(populate_existing=True)
+            )
+            .scalars()
+            .one()
+        )
+        created = obj.uuid == uuid
+        if created:
+            # The encounter is new, so there is nothing for these to lazy load.
+            set_committed_value(obj, "location_history", [])
+            set_committed_value(obj, "score_system_history", [])
+            set_committed_value(obj, "open_encounter", None)
+            if child_of_encounter_uuid:
+                EncounterClosure.attach(uuid, child_of_encounter_uuid, is_new=True)
+            obj.location_history = [LocationHistory(**lh) for lh in location_history]
+            if deleted_at:
+                obj.deleted_at = deleted_at
+            obj.sync_open_encounter()
+        return obj, created
+
+    @classmethod
+    def _epr_encounter_id_index(cls) -> Index:
+        return next(
+            index
+            for index in cls.__table__.indexes
+            if index.name == "epr_encounter_id_deleted_at"
+        )
+
     def update(self, *args: Any, **kwargs: Any) -> "Encounter":
         if "location_uuid" in kwargs:
             previous_location_uuid: str = self.location_uuid
@@ -170,22 +296,178 @@ class Encounter(ModelIdentifier, db.Model):
             if child_of is None:
                 raise UnprocessibleEntityException
 
+            if child_of_encounter_uuid != self.parent_uuid:
+                EncounterClosure.attach(self.uuid, child_of_encounter_uuid)
             self.parent_uuid = child_of_encounter_uuid
 
         for key in kwargs:
             setattr(self, key, kwargs[key])
 
+        self.sync_open_encounter()
         db.session.add(self)
         return self
 
     def remove(self, *args: Any, **kwargs: Any) -> "Encounter":
         child_of_encounter_uuid = kwargs.pop("child_of_encounter_uuid", None)
         if child_of_encounter_uuid and self.parent_uuid == child_of_encounter_uuid:
+            EncounterClosure.detach(self.uuid)
             self.parent_uuid = None  # type: ignore
+            self.sync_open_encounter()
             db.session.add(self)
 
         return self
 
+    # The to_dict() fields an update can change, in to_dict() order, and the attribute
+    # each is stored in. location_history is also changed, through the session.
+    _AUDITED_ATTRIBUTES: Dict[str, str] = {
+        "epr_encounter_id": "epr_encounter_id",
+        "admitted_at": "admitted_at",
+        "discharged_at": "discharged_at",
+        "deleted_at": "deleted_at",
+        "location_uuid": "location_uuid",
+        "patient_record_uuid": "patient_record_uuid",
+        "encounter_type": "encounter_type",
+        "score_system": "score_system",
+        "spo2_scale": "spo2_scale",
+        "dh_product": "dh_product_uuid",
+        "score_system_history": "score_system_history",
+        "child_of_encounter_uuid": "parent_uuid",
+    }
+
+    def pending_changes(self) -> Dict[str, Any]:
+        """
+        The to_dict() fields changed since the encounter was loaded, from the SQLAlchemy
+        attribute history: the previous value of each changed field, or the objects
+        added to each history list. Must be called before the session is flushed.
+        """
+        state = inspect(self)
+        changes: Dict[str, Any] = {}
+        for field, attribute in self._AUDITED_ATTRIBUTES.items():
+            history = state.attrs[attribute].history
+            if not history.has_changes():
+                continue
+            if field == "score_system_history":
+                changes[field] = list(history.added)
+            else:
+                changes[field] = history.deleted[0] if history.deleted else None
+        new_locations = [
+            obj
+            for obj in db.session.new
+            if isinstance(obj, LocationHistory) and obj.encounter_uuid == self.uuid
+        ]
+        if new_locations:
+            changes["location_history"] = new_locations
+        return {
+            field: changes[field]
+            for field in [*self._AUDITED_ATTRIBUTES, "location_history"]
+            if field in changes
+        }
+
+    def modifications(
+        self, pending_changes: Dict[str, Any], encounter_dict: Dict
+    ) -> List[Tuple]:
+        """
+        The audit modifications for pending_changes() once they have been flushed, in
+        dictdiffer format against the encounter's to_dict(). Fields that were set to
+        the value they already had are left out.
+        """
+        modifications: List[Tuple] = []
+        for field, previous in pending_changes.items():
+            if field in ("score_system_history", "location_history"):
+                collection = getattr(self, field)
+                added = sorted(collection.index(obj) for obj in previous)
+                modifications.append(
+                    ("add", field, [(i, encounter_dict[field][i]) for i in added])
+                )
+            elif field == "dh_product":
+                current = encounter_dict["dh_product"][0]["uuid"]
+                if previous != current:
+                    modifications.append(
+                        ("change", ["dh_product", 0, "uuid"], (previous, current))
+                    )
+            elif field == "child_of_encounter_uuid" and previous is None:
+                modifications.append(("add", "", [(field, encounter_dict[field])]))
+            elif previous != encounter_dict.get(field):
+                modifications.append(
+                    ("change", field, (previous, encounter_dict.get(field)))
+                )
+        return modifications
+
+    def sync_open_encounter(self) -> None:
+        """
+        Adds, updates or removes this encounter's row in the open_encounter_by_location
+        projection. Must be called whenever location, patient, discharge, deletion or
+        parent changes.
+        """
+        if not self.is_open:
+            self.open_encounter = None
+        elif self.open_encounter is None:
+            self.open_encounter = OpenEncounterByLocation(
+                location_uuid=self.location_uuid, patient_uuid=self.patient_uuid
+            )
+        else:
+            self.open_encounter.location_uuid = self.location_uuid
+            self.open_encounter.patient_uuid = self.patient_uuid
+
+    # Changes to these to_dict() fields can change which encounter is a patient's latest.
+    LATEST_ENCOUNTER_FIELDS = (
+        "admitted_at",
+        "discharged_at",
+        "deleted_at",
+        "child_of_encounter_uuid",
+    )
+
+    @classmethod
+    def sync_latest_encounters(cls, patient_uuids: Iterable[str]) -> None:
+        """
+        Recomputes the latest_encounter_by_patient rows of the given patients from their
+        encounters in the database, in a single statement. The session must have been
+        flushed. Must be called whenever an encounter is created, or its admission,
+        discharge, deletion, parent or patient changes.
+        """
+        patient_uuids = list(set(patient_uuids))
+        if not patient_uuids:
+            return
+        projection = LatestEncounterByPatient.__table__
+        latest = (
+            db.session.query(cls.patient_uuid, cls.uuid)
+            .distinct(cls.patient_uuid)
+            .filter(
+                cls.patient_uuid.in_(patient_uuids),
+                cls.deleted_at.is_(None),
+                cls.parent_uuid.is_(None),
+            )
+            .order_by(
+                cls.patient_uuid,
+                # Open encounters first
+                case([(cls.discharged_at.is_(None), 0)], else_=1),
+                cls.admitted_at.desc(),
+                cls.created.desc(),
+            )
+            .cte("latest")
+        )
+        # Patients left without any encounters that could be their latest.
+        removed = (
+            delete(projection)
+            .where(
+                and_(
+                    projection.c.patient_uuid.in_(patient_uuids),
+                    projection.c.patient_uuid.not_in(
+                        db.session.query(latest.c.patient_uuid)
+                    ),
+                )
+            )
+            .cte("removed")
+        )
+        statement = insert(projection).from_select(
+            ["patient_uuid", "encounter_uuid"], db.session.query(latest)
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[projection.c.patient_uuid],
+            set_={"encounter_uuid": statement.excluded.encounter_uuid},
+        ).add_cte(removed)
+        db.session.execute(statement)
+
     def to_dict(
         self,
         compact: bool = False,
@@ -224,6 +506,55 @@ class Encounter(ModelIdentifier, db.Model):
 
         return obj
 
+    @classmethod
+    def compact_columns(cls, expanded: bool = False) -> List[Column]:
+        """
+        The columns needed by `compact_dict`, for queries that skip loading Encounter objects.
+        """
+        columns: List[Column] = [
+            cls.epr_encounter_id,
+            cls.admitted_at,
+            cls.discharged_at,
+            cls.deleted_at,
+            cls.location_uuid,
+            cls.patient_record_uuid,
+            cls.patient_uuid,
+            cls.uuid,
+        ]
+        if expanded:
+            columns += [cls.created, cls.created_by_, cls.modified, cls.modified_by_]
+        return columns
+
+    @staticmethod
+    def compact_dict(row: Any, expanded: bool = False) -> Dict[str, Any]:
+        """
+        Builds the same dict as `to_dict(compact=True)` from a row selected with `compact_columns`.
+        """
+        obj: Dict[str, Any] = {
+            "epr_encounter_id": row.epr_encounter_id,
+            "admitted_at": row.admitted_at,
+            "discharged_at": row.discharged_at,
+            "deleted_at": row.deleted_at,
+            "location_uuid": row.location_uuid,
+            "patient_record_uuid": row.patient_record_uuid,
+            "patient_uuid": row.patient_uuid,
+            "uuid": row.uuid,
+        }
+        if expanded:
+            obj.update(
+                {
+                    "created": row.created.replace(tzinfo=timezone.utc)
+                    if row.created
+                    else None,
+                    "created_by": row.created_by_,
+                    "modified": row.modified.replace(tzinfo=timezone.utc)
+                    if row.modified
+                    else None,
+                    "modified_by": row.modified_by_,
+                }
+            )
+        return obj
+
     @classmethod
     def schema(cls) -> Dict:
         return {
@@ -258,3 +589,20 @@ class Encounter(ModelIdentifier, db.Model):
                 "spo2_scale": int,
             },
         }
+
+
+# Location queries with open_as_of (served by _build_latest_encounter_query), in the
+# order they sort. Declared here because `created` comes from ModelIdentifier and is
+# not in scope in the class body. discharged_at is included so that the discharge
+# filter, and the patient counts, can be answered from the index alone.
+Index(
+    "open_location_idx",
+    Encounter.location_uuid,
+    Encounter.patient_uuid,
+    Encounter.admitted_at.desc(),
+    Encounter.created.desc(),
+    postgresql_where=and_(
+        Encounter.parent_uuid.is_(None), Encounter.deleted_at.is_(None)
+    ),
+    postgresql_include=["discharged_at"],
+)
@@ -0,0 +1,94 @@
+from typing import Dict, List, Tuple
+
+from flask_batteries_included.helpers.error_handler import UnprocessibleEntityException
+from flask_batteries_included.sqldb import db
+from sqlalchemy import Column, ForeignKey, Integer, String
+
+
+class EncounterClosure(db.Model):
+    """
+    Closure table for the encounter tree: one row for every (ancestor, descendant) pair
+    linked through parent_uuid, so that all descendants of an encounter can be found
+    with a single indexed lookup. Rows are maintained by Encounter.new/update/remove.
+    """
+
+    ancestor_uuid = Column(
+        String(length=36),
+        ForeignKey("encounter.uuid", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    descendant_uuid = Column(
+        String(length=36),
+        ForeignKey("encounter.uuid", ondelete="CASCADE"),
+        primary_key=True,
+        index=True,
+    )
+    depth = Column(Integer, nullable=False)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.to_dict()}"
+
+    @classmethod
+    def attach(
+        cls, encounter_uuid: str, parent_uuid: str, is_new: bool = False
+    ) -> None:
+        """
+        Records encounter_uuid (and any encounters below it) as descendants of parent_uuid
+        and all of its ancestors. Any previous position in the tree is removed first.
+        """
+        ancestors: List[Tuple[str, int]] = [(parent_uuid, 0)] + (
+            db.session.query(cls.ancestor_uuid, cls.depth)
+            .filter(cls.descendant_uuid == parent_uuid)
+            .all()
+        )
+        subtree: List[Tuple[str, int]] = [(encounter_uuid, 0)]
+        if not is_new:
+            subtree += (
+                db.session.query(cls.descendant_uuid, cls.depth)
+                .filter(cls.ancestor_uuid == encounter_uuid)
+                .all()
+            )
+            if parent_uuid in {uuid for uuid, _ in subtree}:
+                raise UnprocessibleEntityException(
+                    f"Encounter '{parent_uuid}' is a child of encounter '{encounter_uuid}'"
+                )
+            cls.detach(encounter_uuid)
+
+        for ancestor_uuid, ancestor_depth in ancestors:
+            for descendant_uuid, descendant_depth in subtree:
+                db.session.add(
+                    cls(
+                        ancestor_uuid=ancestor_uuid,
+                        descendant_uuid=descendant_uuid,
+                        depth=ancestor_depth + descendant_depth + 1,
+                    )
+                )
+
+    @classmethod
+    def detach(cls, encounter_uuid: str) -> None:
+        """
+        Removes the links between encounter_uuid (and any encounters below it) and the
+        encounters above it, leaving the subtree below encounter_uuid intact.
+        """
+        old_ancestors = (
+            db.session.query(cls.ancestor_uuid)
+            .filter(cls.descendant_uuid == encounter_uuid)
+            .subquery()
+        )
+        subtree = (
+            db.session.query(cls.descendant_uuid)
+            .filter(cls.ancestor_uuid == encounter_uuid)
+            .subquery()
+        )
+        db.session.query(cls).filter(
+            cls.ancestor_uuid.in_(old_ancestors.select()),
+            (cls.descendant_uuid == encounter_uuid)
+            | cls.descendant_uuid.in_(subtree.select()),
+        ).delete(synchronize_session=False)
+
+    def to_dict(self) -> Dict:
+        return {
+            "ancestor_uuid": self.ancestor_uuid,
+            "descendant_uuid": self.descendant_uuid,
+            "depth": self.depth,
+        }
@@ -0,0 +1,31 @@
+from typing import Dict
+
+from flask_batteries_included.sqldb import db
+from sqlalchemy import Column, ForeignKey, String
+
+
+class LatestEncounterByPatient(db.Model):
+    """
+    Projection of each patient's latest encounter: of their encounters that are not
+    deleted and not a child encounter, open ones first, then the most recently
+    admitted and created. Latest encounter lookups without open_as_of read this table
+    instead of sorting all of a patient's encounters. Rows are maintained by
+    Encounter.sync_latest_encounters().
+    """
+
+    patient_uuid = Column(String(length=36), primary_key=True)
+    encounter_uuid = Column(
+        String(length=36),
+        ForeignKey("encounter.uuid", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.to_dict()}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "patient_uuid": self.patient_uuid,
+            "encounter_uuid": self.encounter_uuid,
+        }
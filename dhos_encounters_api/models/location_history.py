@@ -19,6 +19,7 @@ class LocationHistory(ModelIdentifier, db.Model):
         String(),
         ForeignKey("encounter.uuid"),
         nullable=False,
+        index=True,
     )
     location_uuid = Column(String(length=36), nullable=False, index=True)
 
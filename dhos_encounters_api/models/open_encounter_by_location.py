@@ -0,0 +1,39 @@
+from typing import Dict
+
+from flask_batteries_included.sqldb import db
+from sqlalchemy import Column, ForeignKey, Index, String
+
+
+class OpenEncounterByLocation(db.Model):
+    """
+    Projection of the encounters that are currently open: not discharged, not deleted
+    and not a child encounter. Location queries without open_as_of read this table
+    instead of filtering the full encounter history. Rows are maintained by
+    Encounter.sync_open_encounter().
+    """
+
+    encounter_uuid = Column(
+        String(length=36),
+        ForeignKey("encounter.uuid", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    location_uuid = Column(String(length=36), nullable=False)
+    patient_uuid = Column(String(length=36), nullable=False)
+
+    __table_args__ = (
+        Index(
+            "open_encounter_by_location_location_uuid_patient_uuid",
+            location_uuid,
+            patient_uuid,
+        ),
+    )
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.to_dict()}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "encounter_uuid": self.encounter_uuid,
+            "location_uuid": self.location_uuid,
+            "patient_uuid": self.patient_uuid,
+        }
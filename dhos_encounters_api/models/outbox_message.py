@@ -0,0 +1,33 @@
+from datetime import datetime
+from typing import Dict
+
+from flask_batteries_included.sqldb import db
+from sqlalchemy import BigInteger, Column, DateTime, String, Text
+
+
+class OutboxMessage(db.Model):
+    """
+    A RabbitMQ message waiting to be sent. Rows are written in the same transaction as
+    the encounter change that produced them, and deleted by the outbox relay once the
+    message has been published, so a message is sent if and only if its change commits.
+    Messages are sent in id order.
+    """
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    created = Column(DateTime(timezone=True), nullable=False, default=datetime.utcnow)
+    routing_key = Column(String, nullable=False)
+    # JSON encoded, exactly as it will be sent.
+    body = Column(Text, nullable=False)
+    correlation_id = Column(String, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"<{self.__class__.__name__} {self.to_dict()}"
+
+    def to_dict(self) -> Dict:
+        return {
+            "id": self.id,
+            "created": self.created,
+            "routing_key": self.routing_key,
+            "body": self.body,
+            "correlation_id": self.correlation_id,
+        }
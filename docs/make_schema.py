@@ -3,12 +3,24 @@ import subprocess
 
 import sadisplay
 
-from dhos_encounters_api.models import encounter, location_history, score_system_history
+from dhos_encounters_api.models import (
+    encounter,
+    encounter_closure,
+    latest_encounter_by_patient,
+    location_history,
+    open_encounter_by_location,
+    outbox_message,
+    score_system_history,
+)
 
 desc = sadisplay.describe(
     [
         encounter.Encounter,
+        encounter_closure.EncounterClosure,
+        latest_encounter_by_patient.LatestEncounterByPatient,
         location_history.LocationHistory,
+        open_encounter_by_location.OpenEncounterByLocation,
+        outbox_message.OutboxMessage,
         score_system_history.ScoreSystemHistory,
     ]
 )
@@ -0,0 +1,62 @@
+"""encounter_closure
+
+Revision ID: 4f1c2b7e9a3d
+Revises: 1a2960dfd979
+Create Date: 2026-10-17 09:12:41.582304
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4f1c2b7e9a3d"
+down_revision = "1a2960dfd979"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "encounter_closure",
+        sa.Column("ancestor_uuid", sa.String(length=36), nullable=False),
+        sa.Column("descendant_uuid", sa.String(length=36), nullable=False),
+        sa.Column("depth", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["ancestor_uuid"], ["encounter.uuid"], ondelete="CASCADE"
+        ),
+        sa.ForeignKeyConstraint(
+            ["descendant_uuid"], ["encounter.uuid"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("ancestor_uuid", "descendant_uuid"),
+    )
+    op.create_index(
+        op.f("ix_encounter_closure_descendant_uuid"),
+        "encounter_closure",
+        ["descendant_uuid"],
+        unique=False,
+    )
+
+    # Backfill from the existing parent_uuid links
+    conn = op.get_bind()
+    conn.execute(
+        """
+            WITH RECURSIVE tree(ancestor_uuid, descendant_uuid, depth) AS (
+                SELECT parent_uuid, uuid, 1
+                FROM encounter
+                WHERE parent_uuid IS NOT NULL
+            UNION ALL
+                SELECT parent.parent_uuid, tree.descendant_uuid, tree.depth + 1
+                FROM tree JOIN encounter AS parent ON parent.uuid = tree.ancestor_uuid
+                WHERE parent.parent_uuid IS NOT NULL
+            )
+            INSERT INTO encounter_closure (ancestor_uuid, descendant_uuid, depth)
+            SELECT ancestor_uuid, descendant_uuid, depth FROM tree;
+        """
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_encounter_closure_descendant_uuid"), table_name="encounter_closure"
+    )
+    op.drop_table("encounter_closure")
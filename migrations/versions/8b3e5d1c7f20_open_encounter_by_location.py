@@ -0,0 +1,53 @@
+"""open_encounter_by_location
+
+Revision ID: 8b3e5d1c7f20
+Revises: 4f1c2b7e9a3d
+Create Date: 2026-10-17 11:05:13.217940
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8b3e5d1c7f20"
+down_revision = "4f1c2b7e9a3d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "open_encounter_by_location",
+        sa.Column("encounter_uuid", sa.String(length=36), nullable=False),
+        sa.Column("location_uuid", sa.String(length=36), nullable=False),
+        sa.Column("patient_uuid", sa.String(length=36), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["encounter_uuid"], ["encounter.uuid"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("encounter_uuid"),
+    )
+    op.create_index(
+        "open_encounter_by_location_location_uuid_patient_uuid",
+        "open_encounter_by_location",
+        ["location_uuid", "patient_uuid"],
+        unique=False,
+    )
+
+    # Backfill from the currently open encounters
+    conn = op.get_bind()
+    conn.execute(
+        """
+            INSERT INTO open_encounter_by_location (encounter_uuid, location_uuid, patient_uuid)
+            SELECT uuid, location_uuid, patient_uuid
+            FROM encounter
+            WHERE discharged_at IS NULL AND deleted_at IS NULL AND parent_uuid IS NULL;
+        """
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "open_encounter_by_location_location_uuid_patient_uuid",
+        table_name="open_encounter_by_location",
+    )
+    op.drop_table("open_encounter_by_location")
@@ -0,0 +1,63 @@
+"""open_location_idx
+
+Revision ID: a7d4e2f8c915
+Revises: f3b9c6d2a417
+Create Date: 2026-10-17 17:26:41.338092
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "a7d4e2f8c915"
+down_revision = "f3b9c6d2a417"
+branch_labels = None
+depends_on = None
+
+# Indexes are built and dropped CONCURRENTLY so that writes are not blocked, which
+# cannot run inside a transaction. A failed build leaves an INVALID index behind which
+# must be dropped before the migration is re-run.
+#
+# location_idx and ix_encounter_location_uuid are duplicate plain btrees on
+# location_uuid. Every query on encounter.location_uuid also filters out child and
+# deleted encounters, so open_location_idx replaces both of them.
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "open_location_idx",
+            "encounter",
+            [
+                "location_uuid",
+                "patient_uuid",
+                sa.text("admitted_at DESC"),
+                sa.text("created DESC"),
+            ],
+            unique=False,
+            postgresql_where=sa.text("parent_uuid IS NULL AND deleted_at IS NULL"),
+            postgresql_include=["discharged_at"],
+            postgresql_concurrently=True,
+        )
+        for name in ("location_idx", "ix_encounter_location_uuid"):
+            op.drop_index(
+                name,
+                table_name="encounter",
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in ("ix_encounter_location_uuid", "location_idx"):
+            op.create_index(
+                name,
+                "encounter",
+                ["location_uuid"],
+                unique=False,
+                postgresql_concurrently=True,
+            )
+        op.drop_index(
+            "open_location_idx", table_name="encounter", postgresql_concurrently=True
+        )
@@ -0,0 +1,45 @@
+"""filter_path_indexes
+
+Revision ID: c2d7a4e91b06
+Revises: 8b3e5d1c7f20
+Create Date: 2026-10-17 14:22:47.903118
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c2d7a4e91b06"
+down_revision = "8b3e5d1c7f20"
+branch_labels = None
+depends_on = None
+
+# CREATE INDEX CONCURRENTLY builds without blocking writes but cannot run inside a
+# transaction, so these run in an autocommit block. A failed build leaves an INVALID
+# index behind which must be dropped before the migration is re-run.
+#
+# Lookups by epr_encounter_id alone are served by the leading column of the
+# epr_encounter_id_deleted_at unique index, so they need no index of their own.
+INDEXES = [
+    # merge_encounters
+    ("ix_encounter_patient_record_uuid", "encounter", ["patient_record_uuid"]),
+    # Encounter.location_history
+    ("ix_location_history_encounter_uuid", "location_history", ["encounter_uuid"]),
+]
+
+
+def upgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, _ in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
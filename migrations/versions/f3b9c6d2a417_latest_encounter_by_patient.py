@@ -0,0 +1,56 @@
+"""latest_encounter_by_patient
+
+Revision ID: f3b9c6d2a417
+Revises: e5a1f0c3b827
+Create Date: 2026-10-17 16:41:08.904512
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f3b9c6d2a417"
+down_revision = "e5a1f0c3b827"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "latest_encounter_by_patient",
+        sa.Column("patient_uuid", sa.String(length=36), nullable=False),
+        sa.Column("encounter_uuid", sa.String(length=36), nullable=False),
+        sa.ForeignKeyConstraint(
+            ["encounter_uuid"], ["encounter.uuid"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("patient_uuid"),
+    )
+    op.create_index(
+        op.f("ix_latest_encounter_by_patient_encounter_uuid"),
+        "latest_encounter_by_patient",
+        ["encounter_uuid"],
+        unique=False,
+    )
+
+    # Backfill with each patient's latest encounter
+    conn = op.get_bind()
+    conn.execute(
+        """
+            INSERT INTO latest_encounter_by_patient (patient_uuid, encounter_uuid)
+            SELECT DISTINCT ON (patient_uuid) patient_uuid, uuid
+            FROM encounter
+            WHERE deleted_at IS NULL AND parent_uuid IS NULL
+            ORDER BY patient_uuid,
+                CASE WHEN discharged_at IS NULL THEN 0 ELSE 1 END,
+                admitted_at DESC,
+                created DESC;
+        """
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f("ix_latest_encounter_by_patient_encounter_uuid"),
+        table_name="latest_encounter_by_patient",
+    )
+    op.drop_table("latest_encounter_by_patient")
@@ -3,8 +3,11 @@ import json
 import os
 import signal
 import socket
+import statistics
 import sys
 import time
+from datetime import datetime, timezone
+from pathlib import Path
 from typing import (
     Any,
     Callable,
@@ -36,6 +39,7 @@ from flask_batteries_included.sqldb import (
 from marshmallow import RAISE, Schema
 from mock import Mock
 from pytest_mock import MockFixture
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 GDM_CLINICIAN_PERMISSIONS: List[str] = [
@@ -226,11 +230,15 @@ def session_app() -> Flask:
 def app(mocker: MockFixture, session_app: Flask) -> Flask:
     from flask_batteries_included.helpers.security import _ProtectedRoute
 
+    from dhos_encounters_api.helpers.patient_count_cache import EXTENSION_NAME
+
     def mock_claims(self: Any, verify: bool = True) -> Tuple:
         return g.jwt_claims, g.jwt_scopes
 
     mocker.patch.object(_ProtectedRoute, "_retrieve_jwt_claims", mock_claims)
     session_app.config["IGNORE_JWT_VALIDATION"] = False
+    # Tests delete encounters directly, so cached counts must not outlive a test.
+    session_app.extensions[EXTENSION_NAME].clear()
     return session_app
 
 
@@ -358,6 +366,23 @@ def mock_publish_msg(mocker: MockFixture) -> Mock:
     return mocker.patch.object(kombu_batteries_included, "publish_message")
 
 
+@pytest.fixture
+def mock_connection(mocker: MockFixture) -> Mock:
+    """Patches the broker connection that publish sends batches of messages over."""
+    from dhos_encounters_api.blueprint_api import publish
+
+    mocker.patch.object(publish.kbi_config, "RABBITMQ_DISABLED", False)
+    mocker.patch.object(publish.kbi_config, "INITIALISED", True)
+    return mocker.patch.object(publish, "Connection")
+
+
+@pytest.fixture
+def mock_producer(mocker: MockFixture, mock_connection: Mock) -> Mock:
+    from dhos_encounters_api.blueprint_api import publish
+
+    return mocker.patch.object(publish, "Producer").return_value
+
+
 @pytest.fixture
 def mock_uuid4(mocker: MockFixture, request: Any) -> Any:
     mocker.patch("uuid.uuid4", return_value=request.param)
@@ -384,6 +409,8 @@ def encounter_factory() -> Callable:
     def factory(*args: Any, **kw: Any) -> Encounter:
         e = Encounter.new(*args, **kw)
         db.session.add(e)
+        db.session.flush()
+        Encounter.sync_latest_encounters([e.patient_uuid])
         db.session.commit()
         return e
 
@@ -404,14 +431,43 @@ def assert_valid_schema(
     return verify_schema
 
 
+class RecordedStatement(object):
+    """A statement as sent to the database cursor."""
+
+    def __init__(self, statement: str, parameters: Any, executemany: bool) -> None:
+        self.statement = statement
+        self.parameters = parameters
+        self.executemany = executemany
+        # The number of rows returned, for statements that return rows.
+        self.rows: Optional[int] = None
+        # The top-level plan node from EXPLAIN, if the statement was explained.
+        self.plan: Optional[Dict] = None
+
+
+# Statements that can be explained.
+EXPLAINABLE_STATEMENTS = ("SELECT", "UPDATE", "DELETE", "INSERT", "WITH")
+
+
 class DBStatementCounter(object):
-    def __init__(self) -> None:
+    def __init__(
+        self,
+        explain: Optional[str] = None,
+        explain_settings: Optional[Dict[str, str]] = None,
+    ) -> None:
         self.clauses: List[sqlalchemy.sql.ClauseElement] = []
+        self.statements: List[RecordedStatement] = []
+        self.explain = explain
+        self.explain_settings = explain_settings or {}
 
     @property
     def count(self) -> int:
         return len(self.clauses)
 
+    @property
+    def rows(self) -> int:
+        """The rows returned by all of the cursor statements."""
+        return sum(statement.rows or 0 for statement in self.statements)
+
     def callback(
         self,
         conn: sqlalchemy.engine.Connection,
@@ -424,18 +480,302 @@ class DBStatementCounter(object):
 
         self.clauses.append(clauseelement)
 
+    def before_cursor_execute(
+        self,
+        conn: sqlalchemy.engine.Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        recorded = RecordedStatement(statement, parameters, executemany)
+        if (
+            self.explain is not None
+            and not executemany
+            and statement.lstrip().upper().startswith(EXPLAINABLE_STATEMENTS)
+        ):
+            recorded.plan = self._explain(cursor, statement, parameters)
+        self.statements.append(recorded)
+
+    def after_cursor_execute(
+        self,
+        conn: sqlalchemy.engine.Connection,
+        cursor: Any,
+        statement: str,
+        parameters: Any,
+        context: Any,
+        executemany: bool,
+    ) -> None:
+        if cursor.description is not None:
+            self.statements[-1].rows = cursor.rowcount
+
+    def _explain(self, cursor: Any, statement: str, parameters: Any) -> Dict:
+        """
+        Runs EXPLAIN with the explain options before the statement is executed. It runs
+        in a savepoint that is rolled back, along with the explain settings, so that
+        with ANALYZE statements which change data still take effect only once.
+        """
+        explain = cursor.connection.cursor()
+        explain.execute("SAVEPOINT explain_statement")
+        for name, value in self.explain_settings.items():
+            explain.execute(f"SET LOCAL {name} = {value}")
+        options = ", ".join(filter(None, [self.explain, "FORMAT JSON"]))
+        explain.execute(f"EXPLAIN ({options}) {statement}", parameters)
+        plan = explain.fetchone()[0]
+        explain.execute("ROLLBACK TO SAVEPOINT explain_statement")
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]["Plan"]
+
 
 @contextlib.contextmanager
-def db_statement_counter(session: Session) -> Iterator[DBStatementCounter]:
-    counter = DBStatementCounter()
-    cb = counter.callback
-    sqlalchemy.event.listen(db.engine, "before_execute", cb)
+def db_statement_counter(
+    session: Session,
+    explain: Optional[str] = None,
+    explain_settings: Optional[Dict[str, str]] = None,
+) -> Iterator[DBStatementCounter]:
+    """
+    Records the statements executed while the block runs: the clauses the application
+    executes, and the statements sent to the database cursor. Pass explain with the
+    options for Postgres' EXPLAIN, e.g. "ANALYZE, BUFFERS", to record the plan of each
+    cursor statement ("" for a plain EXPLAIN), with explain_settings applied to the
+    EXPLAIN only.
+    """
+    counter = DBStatementCounter(explain=explain, explain_settings=explain_settings)
+    listeners = [
+        ("before_execute", counter.callback),
+        ("before_cursor_execute", counter.before_cursor_execute),
+        ("after_cursor_execute", counter.after_cursor_execute),
+    ]
+    for name, listener in listeners:
+        sqlalchemy.event.listen(db.engine, name, listener)
     try:
         yield counter
     finally:
-        sqlalchemy.event.remove(db.engine, "before_execute", cb)
+        for name, listener in listeners:
+            sqlalchemy.event.remove(db.engine, name, listener)
 
 
 @pytest.fixture
-def statement_counter() -> Callable[[Session], ContextManager[DBStatementCounter]]:
+def statement_counter() -> Callable[..., ContextManager[DBStatementCounter]]:
     return db_statement_counter
+
+
+BENCHMARK_BASELINE_PATH = Path(__file__).parent / "benchmark_baseline.json"
+# Set to rewrite the benchmark baseline file from the results of this run.
+RECORD_BENCHMARK_BASELINE = bool(os.environ.get("RECORD_BENCHMARK_BASELINE"))
+# Timings depend on the machine, so they are only compared against the baseline
+# when this is set. Statement counts are always compared.
+COMPARE_BENCHMARK_TIMES = bool(os.environ.get("COMPARE_BENCHMARK_TIMES"))
+# Headroom over the recorded p95 before a benchmark counts as regressed.
+BENCHMARK_TIME_TOLERANCE = 1.5
+
+
+class Benchmark:
+    """
+    Times repeated in-process calls of a function and counts the statements each call
+    executes. The p50/p95/p99 times and the statement count are recorded as test
+    properties (see --junitxml) and compared against benchmark_baseline.json.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        baseline: Dict[str, Dict[str, float]],
+        record_property: Callable[[str, object], None],
+    ) -> None:
+        self.name = name
+        self.baseline = baseline
+        self.record_property = record_property
+
+    def __call__(
+        self, func: Callable[[], Any], rounds: int = 50, warmup: int = 5
+    ) -> Any:
+        for _ in range(warmup):
+            func()
+
+        times: List[float] = []
+        statements = 0
+        for _ in range(rounds):
+            with db_statement_counter(db.session) as counter:
+                start = time.perf_counter()
+                result = func()
+                times.append((time.perf_counter() - start) * 1000)
+            statements = max(statements, counter.count)
+
+        p50, p95, p99 = (
+            statistics.quantiles(times, n=100, method="inclusive")[p - 1]
+            for p in (50, 95, 99)
+        )
+        stats = {
+            "p50_ms": round(p50, 3),
+            "p95_ms": round(p95, 3),
+            "p99_ms": round(p99, 3),
+            "statements": statements,
+        }
+        for key, value in stats.items():
+            self.record_property(key, value)
+
+        if RECORD_BENCHMARK_BASELINE:
+            self.baseline[self.name] = stats
+        else:
+            assert self.name in self.baseline, f"No baseline recorded for {self.name}"
+            expected = self.baseline[self.name]
+            assert stats["statements"] <= expected["statements"]
+            if COMPARE_BENCHMARK_TIMES:
+                assert stats["p95_ms"] <= expected["p95_ms"] * BENCHMARK_TIME_TOLERANCE
+        return result
+
+
+@pytest.fixture(scope="session")
+def benchmark_baseline() -> Iterator[Dict[str, Dict[str, float]]]:
+    """The recorded benchmark results, by test name. Written back when recording."""
+    recorded = json.loads(BENCHMARK_BASELINE_PATH.read_text())
+    yield recorded
+    if RECORD_BENCHMARK_BASELINE:
+        BENCHMARK_BASELINE_PATH.write_text(
+            json.dumps(recorded, indent=4, sort_keys=True) + "\n"
+        )
+
+
+@pytest.fixture
+def controller_benchmark(
+    request: Any,
+    record_property: Callable[[str, object], None],
+    benchmark_baseline: Dict[str, Dict[str, float]],
+) -> Benchmark:
+    """
+    Use this fixture to benchmark a function, which is called without arguments:
+        result = controller_benchmark(lambda: controller.get_encounter(uuid))
+    """
+    return Benchmark(request.node.name, benchmark_baseline, record_property)
+
+
+class SyntheticEncounters(object):
+    """
+    Encounters from generate_encounters with a fixed seed, so that benchmarks and query
+    plans are measured against data shaped like a trust's, along with the patients,
+    locations and encounters in it that those tests look up.
+    """
+
+    SEED = 1
+
+    def __init__(self, patients: int, locations: int) -> None:
+        """Replaces all encounters with the generated ones. Needs Postgres."""
+        from dhos_encounters_api.helpers.synthetic_data import generate_encounters
+        from dhos_encounters_api.models.encounter import Encounter
+        from dhos_encounters_api.models.encounter_closure import EncounterClosure
+        from dhos_encounters_api.models.latest_encounter_by_patient import (
+            LatestEncounterByPatient,
+        )
+        from dhos_encounters_api.models.open_encounter_by_location import (
+            OpenEncounterByLocation,
+        )
+
+        self.truncate()
+        generate_encounters(patients=patients, locations=locations, seed=self.SEED)
+
+        # The locations with the most open encounters, busiest first
+        self.location_uuids: List[str] = [
+            location_uuid
+            for location_uuid, _ in db.session.query(
+                OpenEncounterByLocation.location_uuid, func.count()
+            )
+            .group_by(OpenEncounterByLocation.location_uuid)
+            .order_by(func.count().desc(), OpenEncounterByLocation.location_uuid)
+            .limit(5)
+        ]
+        # An open encounter at the busiest location
+        self.open_encounter_uuid: str = (
+            db.session.query(OpenEncounterByLocation.encounter_uuid)
+            .filter(OpenEncounterByLocation.location_uuid == self.location_uuids[0])
+            .order_by(OpenEncounterByLocation.encounter_uuid)
+            .limit(1)
+            .scalar()
+        )
+        self.patient_uuids: List[str] = [
+            patient_uuid
+            for (patient_uuid,) in db.session.query(
+                LatestEncounterByPatient.patient_uuid
+            )
+            .order_by(LatestEncounterByPatient.patient_uuid)
+            .limit(10)
+        ]
+        # The patient with the longest history
+        self.patient_uuid: str = (
+            db.session.query(Encounter.patient_uuid)
+            .group_by(Encounter.patient_uuid)
+            .order_by(func.count().desc(), Encounter.patient_uuid)
+            .limit(1)
+            .scalar()
+        )
+        # A patient with an open local encounter
+        self.local_patient_uuid: str = (
+            db.session.query(Encounter.patient_uuid)
+            .filter(
+                Encounter.epr_encounter_id.is_(None),
+                Encounter.discharged_at.is_(None),
+                Encounter.deleted_at.is_(None),
+            )
+            .order_by(Encounter.patient_uuid)
+            .limit(1)
+            .scalar()
+        )
+        self.epr_encounter_id: str = (
+            db.session.query(Encounter.epr_encounter_id)
+            .filter(
+                Encounter.epr_encounter_id.isnot(None), Encounter.deleted_at.is_(None)
+            )
+            .order_by(Encounter.uuid)
+            .limit(1)
+            .scalar()
+        )
+        # The encounter with the largest tree of child encounters
+        self.tree_root_uuid: str = (
+            db.session.query(EncounterClosure.ancestor_uuid)
+            .group_by(EncounterClosure.ancestor_uuid)
+            .order_by(func.count().desc(), EncounterClosure.ancestor_uuid)
+            .limit(1)
+            .scalar()
+        )
+        # The (record, patient, encounters) of the two records with the most
+        # encounters, to merge into each other
+        self.merge_records: List[Tuple[str, str, int]] = [
+            (record_uuid, patient_uuid, count)
+            for record_uuid, patient_uuid, count in db.session.query(
+                Encounter.patient_record_uuid, Encounter.patient_uuid, func.count()
+            )
+            .group_by(Encounter.patient_record_uuid, Encounter.patient_uuid)
+            .order_by(func.count().desc(), Encounter.patient_record_uuid)
+            .limit(2)
+        ]
+        # Times that about a hundred encounters were modified or discharged after
+        self.modified_since: str = self._timestamp(
+            db.session.query(Encounter.modified)
+            .order_by(Encounter.modified.desc())
+            .offset(100)
+            .limit(1)
+            .scalar()
+        )
+        self.open_as_of: str = self._timestamp(
+            db.session.query(Encounter.discharged_at)
+            .filter(Encounter.discharged_at.isnot(None))
+            .order_by(Encounter.discharged_at.desc())
+            .offset(100)
+            .limit(1)
+            .scalar()
+        )
+        db.session.commit()
+
+    @staticmethod
+    def _timestamp(value: datetime) -> str:
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc)
+        return value.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+    @staticmethod
+    def truncate() -> None:
+        from dhos_encounters_api.helpers.synthetic_data import truncate_tables
+
+        truncate_tables()
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Any, Callable, Dict, Generator, List, Optional
+from typing import Any, Callable, Dict, Generator, List, Optional, Union
 
 import draymed
 import pytest
@@ -112,6 +112,49 @@ class TestApi:
         )
         assert response.json == expected
 
+    def test_put_encounter_success(
+        self, client: FlaskClient, mocker: MockFixture
+    ) -> None:
+        payload = {
+            "location_uuid": "L1",
+            "epr_encounter_id": "thisisanencounterid",
+            "encounter_type": "INPATIENT",
+            "admitted_at": "2018-01-01T00:00:00.000Z",
+            "patient_record_uuid": "R1",
+            "patient_uuid": "P1",
+            "dh_product_uuid": "eae12da8-410b-4a60-858b-d554d511f26f",
+            "score_system": "news2",
+        }
+        expected = {"some": "return"}
+        mock_upsert = mocker.patch(
+            "dhos_encounters_api.blueprint_api.controller.upsert_encounter",
+            return_value=expected,
+        )
+        response = client.put(
+            "/dhos/v2/encounter",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=payload,
+        )
+        assert response.status_code == 200
+        assert response.json == expected
+        mock_upsert.assert_called_once_with(payload)
+
+    def test_put_encounter_requires_epr_encounter_id(self, client: FlaskClient) -> None:
+        response = client.put(
+            "/dhos/v2/encounter",
+            headers={"Authorization": "Bearer TOKEN"},
+            json={
+                "location_uuid": "L1",
+                "encounter_type": "INPATIENT",
+                "admitted_at": "2018-01-01T00:00:00.000Z",
+                "patient_record_uuid": "R1",
+                "patient_uuid": "P1",
+                "dh_product_uuid": "eae12da8-410b-4a60-858b-d554d511f26f",
+                "score_system": "news2",
+            },
+        )
+        assert response.status_code == 400
+
     def test_get_encounter_unknown(
         self, client: FlaskClient, mocker: MockFixture
     ) -> None:
@@ -211,20 +254,18 @@ class TestApi:
     def test_get_latest_encounter_for_patient(
         self, client: FlaskClient, mocker: MockFixture
     ) -> None:
-        expected = [
-            {"uuid": "encounter1", "discharged_at": None, "deleted_at": None},
-            {"uuid": "encounter2", "discharged_at": None, "deleted_at": None},
-        ]
-        mocker.patch(
-            "dhos_encounters_api.blueprint_api.controller.get_encounters_by_patient_or_epr_id",
-            return_value=expected,
+        expected = {"uuid": "encounter1", "discharged_at": None, "deleted_at": None}
+        mock_latest = mocker.patch(
+            "dhos_encounters_api.blueprint_api.controller.get_latest_encounters_for_patients",
+            return_value={"X": expected},
         )
         response = client.get(
             "/dhos/v2/encounter/latest?patient_id=X",
             headers={"Authorization": "Bearer TOKEN"},
         )
         assert response.status_code == 200
-        assert response.json == expected[0]
+        assert response.json == expected
+        mock_latest.assert_called_once_with(patient_ids=["X"], compact=False)
 
     def test_get_encounter_by_id(
         self,
@@ -947,6 +988,164 @@ class TestApi:
         assert response.status_code == 200
         assert response.json == expected
 
+    @pytest.mark.parametrize("compact", [True, False])
+    def test_get_encounters_stream(
+        self,
+        client: FlaskClient,
+        encounter_factory: Callable,
+        location_uuid: str,
+        dh_product_uuid: str,
+        record_uuid: str,
+        patient_uuid: str,
+        compact: bool,
+    ) -> None:
+        for epr_encounter_id in ("stream1", "stream2", "stream3"):
+            encounter_factory(
+                location_uuid=location_uuid,
+                epr_encounter_id=epr_encounter_id,
+                encounter_type="INPATIENT",
+                admitted_at="2018-01-01T00:00:00.000Z",
+                patient_record_uuid=record_uuid,
+                patient_uuid=patient_uuid,
+                dh_product_uuid=dh_product_uuid,
+                location_history=[
+                    {
+                        "location_uuid": location_uuid,
+                        "arrived_at": "2018-01-01T00:00:00.000Z",
+                    }
+                ],
+            )
+        url = f"/dhos/v2/encounters?modified_since=2020-01-01&compact={str(compact).lower()}"
+
+        response = client.get(url, headers={"Authorization": "Bearer TOKEN"})
+        streamed = client.get(
+            f"{url}&stream=true", headers={"Authorization": "Bearer TOKEN"}
+        )
+
+        assert streamed.status_code == 200
+        assert streamed.is_streamed
+        json: Optional[List] = streamed.json
+        assert json is not None
+        assert json == response.json
+        assert len(json) == 3
+
+    def test_get_encounters_stream_empty(self, client: FlaskClient) -> None:
+        response = client.get(
+            "/dhos/v2/encounters?modified_since=2020-01-01&stream=true",
+            headers={"Authorization": "Bearer TOKEN"},
+        )
+        assert response.status_code == 200
+        assert response.json == []
+
+    @pytest.mark.parametrize(
+        "query,expected_status",
+        [
+            ("", 200),
+            ("&page_size=10", 200),
+            ("&page_size=0", 400),
+            ("&cursor=invalid", 400),
+        ],
+    )
+    def test_get_encounters_page(
+        self, client: FlaskClient, query: str, expected_status: int
+    ) -> None:
+        response = client.get(
+            f"/dhos/v2/encounters/page?modified_since=2020-01-01{query}",
+            headers={"Authorization": "Bearer TOKEN"},
+        )
+        assert response.status_code == expected_status
+        if expected_status == 200:
+            assert response.json == {"results": [], "next": None}
+
+    def test_post_encounters_success(
+        self, client: FlaskClient, mocker: MockFixture, patient_uuid: str
+    ) -> None:
+        payload = [
+            {
+                "location_uuid": "L1",
+                "epr_encounter_id": f"epr-{i}",
+                "encounter_type": "INPATIENT",
+                "admitted_at": "2018-01-01T00:00:00.000Z",
+                "patient_record_uuid": "R1",
+                "patient_uuid": patient_uuid,
+                "dh_product_uuid": "eae12da8-410b-4a60-858b-d554d511f26f",
+                "score_system": "news2",
+            }
+            for i in range(2)
+        ]
+        expected = {"created": 2, "uuids": ["E1", "E2"]}
+        mock_create = mocker.patch(
+            "dhos_encounters_api.blueprint_api.controller.create_encounters",
+            return_value=expected,
+        )
+        response = client.post(
+            "/dhos/v2/encounters",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=payload,
+        )
+        assert response.status_code == 200
+        assert response.json == expected
+        mock_create.assert_called_once_with(payload)
+
+    @pytest.mark.parametrize("payload", [[], [{"test": "value"}], {}])
+    def test_post_encounters_invalid(
+        self, client: FlaskClient, payload: Union[List, Dict]
+    ) -> None:
+        response = client.post(
+            "/dhos/v2/encounters",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=payload,
+        )
+        assert response.status_code == 400
+
+    def test_post_encounters_upsert_success(
+        self, client: FlaskClient, mocker: MockFixture, patient_uuid: str
+    ) -> None:
+        payload = [
+            {
+                "location_uuid": "L1",
+                "epr_encounter_id": "epr-1",
+                "encounter_type": "INPATIENT",
+                "admitted_at": "2018-01-01T00:00:00.000Z",
+                "patient_record_uuid": "R1",
+                "patient_uuid": patient_uuid,
+                "dh_product_uuid": "eae12da8-410b-4a60-858b-d554d511f26f",
+                "score_system": "news2",
+            }
+        ]
+        expected = {"created": 0, "updated": 1, "uuids": ["E1"]}
+        mock_upsert = mocker.patch(
+            "dhos_encounters_api.blueprint_api.controller.upsert_encounters",
+            return_value=expected,
+        )
+        response = client.post(
+            "/dhos/v2/encounters/upsert",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=payload,
+        )
+        assert response.status_code == 200
+        assert response.json == expected
+        mock_upsert.assert_called_once_with(payload)
+
+    def test_post_encounters_upsert_requires_epr_encounter_id(
+        self, client: FlaskClient, patient_uuid: str
+    ) -> None:
+        response = client.post(
+            "/dhos/v2/encounters/upsert",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=[
+                {
+                    "location_uuid": "L1",
+                    "admitted_at": "2018-01-01T00:00:00.000Z",
+                    "patient_record_uuid": "R1",
+                    "patient_uuid": patient_uuid,
+                    "dh_product_uuid": "eae12da8-410b-4a60-858b-d554d511f26f",
+                    "score_system": "news2",
+                }
+            ],
+        )
+        assert response.status_code == 400
+
 
 @pytest.mark.usefixtures(
     "app",
@@ -1359,6 +1558,45 @@ class TestSpo2ScaleChange:
         assert enc.patient_uuid == parent_patient_uuid
         assert enc.patient_record_uuid == parent_patient_record_uuid
 
+    @pytest.mark.parametrize(
+        "payload,expected_status",
+        [
+            ([{"child_record_uuid": "R1"}], 400),
+            ([], 400),
+            (
+                [
+                    {
+                        "child_record_uuid": "R1",
+                        "parent_record_uuid": "R2",
+                        "parent_patient_uuid": "P2",
+                        "message_uuid": "M1",
+                    }
+                ],
+                200,
+            ),
+        ],
+    )
+    def test_merge_encounters_batch(
+        self,
+        client: FlaskClient,
+        mocker: MockFixture,
+        payload: List[Dict],
+        expected_status: int,
+    ) -> None:
+        mock_merge = mocker.patch(
+            "dhos_encounters_api.blueprint_api.controller.merge_encounters_batch",
+            return_value={"total": 3},
+        )
+        response = client.post(
+            "/dhos/v1/encounter/merge/batch",
+            headers={"Authorization": "Bearer TOKEN"},
+            json=payload,
+        )
+        assert response.status_code == expected_status
+        if expected_status == 200:
+            assert response.json == {"total": 3}
+            mock_merge.assert_called_once_with(payload)
+
     def test_get_encounters(self, client: FlaskClient, mocker: MockFixture) -> None:
         mock_get = mocker.patch(
             "dhos_encounters_api.blueprint_api.controller.get_encounters",
@@ -0,0 +1,155 @@
+import json
+import time
+from typing import Dict, Generator, List, Optional
+
+import pytest
+from flask import Flask
+from kombu.exceptions import OperationalError
+from mock import Mock
+from pytest_mock import MockFixture
+from she_logging.request_id import current_request_id
+
+from dhos_encounters_api.blueprint_api import controller, publish
+from dhos_encounters_api.blueprint_development import reset_database
+
+
+def _bodies(mock_producer: Mock) -> list:
+    return [json.loads(c[1]["body"]) for c in mock_producer.publish.call_args_list]
+
+
+class TestAsyncPublisher:
+    def test_sends_in_order_over_one_connection(
+        self, mock_connection: Mock, mock_producer: Mock
+    ) -> None:
+        request_ids: List[Optional[str]] = []
+        mock_producer.publish.side_effect = lambda **kwargs: request_ids.append(
+            current_request_id()
+        )
+        publisher = publish.AsyncPublisher()
+        publisher.start()
+        for i in range(3):
+            publisher.put(
+                ("dhos.DM000007", json.dumps({"encounter_id": f"E{i}"}), "C1")
+            )
+        publisher.close()
+
+        assert mock_connection.call_count == 1
+        mock_connection.return_value.release.assert_called_once()
+        assert _bodies(mock_producer) == [{"encounter_id": f"E{i}"} for i in range(3)]
+        assert mock_producer.publish.call_args[1]["correlation_id"] == "C1"
+        assert request_ids == ["C1"] * 3
+
+    def test_reconnects_after_connection_error(
+        self, mock_connection: Mock, mock_producer: Mock
+    ) -> None:
+        mock_producer.publish.side_effect = [OperationalError(), None]
+        publisher = publish.AsyncPublisher(retry_interval=0)
+        publisher.start()
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.close()
+
+        assert mock_connection.call_count == 2
+        assert _bodies(mock_producer) == [{"encounter_id": "E1"}] * 2
+
+    def test_drops_message_after_max_attempts(
+        self, mock_connection: Mock, mock_producer: Mock, mocker: MockFixture
+    ) -> None:
+        mock_sleep = mocker.patch.object(publish.time, "sleep")
+        mock_producer.publish.side_effect = [
+            ValueError(),
+            ValueError(),
+            ValueError(),
+            None,
+        ]
+        publisher = publish.AsyncPublisher(retry_interval=1, max_attempts=3)
+        publisher.start()
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E2"}', None))
+        publisher.close()
+
+        # The connection is kept, as the error was not the broker's
+        assert mock_connection.call_count == 1
+        assert [c[0][0] for c in mock_sleep.call_args_list] == [1, 2]
+        assert _bodies(mock_producer) == [{"encounter_id": "E1"}] * 3 + [
+            {"encounter_id": "E2"}
+        ]
+
+    def test_full_queue_sends_directly(self, mock_producer: Mock) -> None:
+        publisher = publish.AsyncPublisher(maxsize=1, timeout=0)
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E2"}', None))
+
+        assert _bodies(mock_producer) == [{"encounter_id": "E2"}]
+        assert publisher.queue.qsize() == 1
+
+    def test_coalesces_encounter_updates(self, mock_producer: Mock) -> None:
+        publisher = publish.AsyncPublisher(coalesce_interval=0.1)
+        publisher.start()
+        for encounter_id in ["E1", "E1", "E2", "E1"]:
+            publisher.put(
+                ("dhos.DM000007", json.dumps({"encounter_id": encounter_id}), None)
+            )
+        publisher.put(("dhos.DM000005", '{"actions": []}', None))
+        time.sleep(0.5)
+
+        assert _bodies(mock_producer) == [
+            {"actions": []},
+            {"encounter_id": "E1"},
+            {"encounter_id": "E2"},
+        ]
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.close()
+        assert _bodies(mock_producer)[3:] == [{"encounter_id": "E1"}]
+
+    def test_close_sends_held_messages(self, mock_producer: Mock) -> None:
+        publisher = publish.AsyncPublisher(coalesce_interval=60)
+        publisher.start()
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.close()
+
+        assert _bodies(mock_producer) == [{"encounter_id": "E1"}]
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician")
+class TestAsyncMode:
+    @pytest.fixture(autouse=True)
+    def async_publisher(
+        self, app: Flask, monkeypatch: pytest.MonkeyPatch
+    ) -> Generator[Mock, None, None]:
+        publisher = Mock(spec=publish.AsyncPublisher)
+        monkeypatch.setitem(app.extensions, publish.EXTENSION_NAME, "async")
+        monkeypatch.setitem(
+            app.extensions, publish.ASYNC_PUBLISHER_EXTENSION_NAME, publisher
+        )
+        yield publisher
+        reset_database()
+
+    def test_messages_queued_after_commit(
+        self, async_publisher: Mock, mock_publish_msg: Mock, dh_product_uuid: str
+    ) -> None:
+        encounter: Dict = controller.create_encounter(
+            {
+                "patient_uuid": "P1",
+                "patient_record_uuid": "R1",
+                "location_uuid": "L1",
+                "dh_product_uuid": dh_product_uuid,
+            }
+        )
+
+        mock_publish_msg.assert_not_called()
+        routing_key, body, _ = async_publisher.put.call_args[0][0]
+        assert routing_key == "dhos.DM000007"
+        assert json.loads(body) == {"encounter_id": encounter["uuid"]}
+
+    def test_init_starts_publisher(
+        self, app: Flask, mock_producer: Mock, mocker: MockFixture
+    ) -> None:
+        mock_atexit = mocker.patch.object(publish.atexit, "register")
+
+        publish.init_publish(app, mode="async")
+        publisher = app.extensions[publish.ASYNC_PUBLISHER_EXTENSION_NAME]
+        publisher.put(("dhos.DM000007", '{"encounter_id": "E1"}', None))
+        publisher.close()
+
+        mock_atexit.assert_called_once_with(publisher.close)
+        assert _bodies(mock_producer) == [{"encounter_id": "E1"}]
@@ -0,0 +1,160 @@
+from typing import Callable, ContextManager, Dict, Generator, List, Optional
+
+import pytest
+from flask_batteries_included.helpers.error_handler import (
+    DuplicateResourceException,
+    UnprocessibleEntityException,
+)
+from flask_batteries_included.sqldb import db
+from mock import Mock
+from pytest_mock import MockFixture
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller, publish
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.encounter import Encounter
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician")
+class TestCreateEncounters:
+    @pytest.fixture(autouse=True)
+    def cleanup(self) -> Generator[None, None, None]:
+        yield
+        reset_database()
+
+    @pytest.fixture
+    def mock_publish_updates(self, mocker: MockFixture) -> Mock:
+        return mocker.patch.object(publish, "publish_encounter_updates")
+
+    @pytest.fixture
+    def make_encounter(self, dh_product_uuid: str) -> Callable[..., Dict]:
+        def make(
+            patient: str, epr_encounter_id: Optional[str] = None, **kwargs: str
+        ) -> Dict:
+            return {
+                "patient_uuid": patient,
+                "patient_record_uuid": f"{patient}R1",
+                "location_uuid": "L1",
+                "dh_product_uuid": dh_product_uuid,
+                "epr_encounter_id": epr_encounter_id,
+                "admitted_at": "2020-01-01T00:00:00.000Z",
+                "location_history": [
+                    {"location_uuid": "L0", "arrived_at": "2019-12-31T00:00:00.000Z"}
+                ],
+                **kwargs,
+            }
+
+        return make
+
+    def test_create_encounters(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        batch: List[Dict] = [
+            make_encounter(f"P{i}", epr_encounter_id=f"EPR{i}") for i in range(50)
+        ] + [make_encounter("P100")]
+
+        with statement_counter(db.session) as ctr:
+            result = controller.create_encounters(batch)
+
+        assert result["created"] == 51
+        assert len(result["uuids"]) == 51
+        # duplicate check, then one INSERT each for encounters, location history,
+        # the open encounter projection and the latest encounter projection
+        assert ctr.count == 5
+        mock_publish_updates.assert_called_once_with(result["uuids"])
+        created = Encounter.query.get(result["uuids"][3])
+        assert created.patient_uuid == "P3"
+        assert len(created.location_history) == 1
+
+    def test_existing_local_encounter(
+        self, make_encounter: Callable[..., Dict], mock_publish_updates: Mock
+    ) -> None:
+        controller.create_encounters([make_encounter("P1")])
+
+        with pytest.raises(DuplicateResourceException):
+            controller.create_encounters([make_encounter("P2"), make_encounter("P1")])
+        assert mock_publish_updates.call_count == 1
+
+    @pytest.mark.parametrize(
+        "second,error",
+        [
+            ({}, DuplicateResourceException),
+            ({"discharged_at": "2020-01-02T00:00:00.000Z"}, None),
+        ],
+    )
+    def test_local_encounters_in_batch(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        second: Dict,
+        error: type,
+    ) -> None:
+        """A discharged local encounter doesn't block a later one for the same patient"""
+        batch = [make_encounter("P1", **second), make_encounter("P1")]
+        if error:
+            with pytest.raises(error):
+                controller.create_encounters(batch)
+        else:
+            assert controller.create_encounters(batch)["created"] == 2
+
+    def test_duplicate_epr_encounter_creates_nothing(
+        self, make_encounter: Callable[..., Dict], mock_publish_updates: Mock
+    ) -> None:
+        with pytest.raises(DuplicateResourceException):
+            controller.create_encounters(
+                [
+                    make_encounter("P1", epr_encounter_id="EPR1"),
+                    make_encounter("P2", epr_encounter_id="EPR1"),
+                ]
+            )
+        db.session.rollback()
+
+        assert Encounter.query.count() == 0
+        mock_publish_updates.assert_not_called()
+
+    @pytest.mark.parametrize("jwt_extra_claims", [{"can_edit_ews": False}])
+    @pytest.mark.parametrize(
+        "changes,error",
+        [
+            ({"patient_uuid": None}, UnprocessibleEntityException),
+            ({"spo2_scale": 2}, PermissionError),
+        ],
+    )
+    def test_invalid_encounter(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        changes: Dict,
+        error: type,
+    ) -> None:
+        with pytest.raises(error):
+            controller.create_encounters(
+                [make_encounter("P1"), {**make_encounter("P2"), **changes}]
+            )
+        assert Encounter.query.count() == 0
+
+    def test_too_many_encounters(self, make_encounter: Callable[..., Dict]) -> None:
+        with pytest.raises(ValueError):
+            controller.create_encounters(
+                [make_encounter("P1")] * (controller.MAX_BULK_CREATE_SIZE + 1)
+            )
+
+
+@pytest.mark.usefixtures("app")
+class TestPublishEncounterUpdates:
+    def test_publishes_over_one_connection(
+        self, mock_connection: Mock, mock_producer: Mock
+    ) -> None:
+        publish.publish_encounter_updates(["E1", "E2", "E3"])
+
+        assert mock_connection.call_count == 1
+        publish_calls = mock_producer.publish.call_args_list
+        assert [c[1]["body"] for c in publish_calls] == [
+            '{"encounter_id": "E1"}',
+            '{"encounter_id": "E2"}',
+            '{"encounter_id": "E3"}',
+        ]
+        assert {c[1]["routing_key"] for c in publish_calls} == {"dhos.DM000007"}
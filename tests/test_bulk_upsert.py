@@ -0,0 +1,188 @@
+from typing import Callable, ContextManager, Dict, Generator
+
+import pytest
+from flask_batteries_included.helpers.error_handler import UnprocessibleEntityException
+from flask_batteries_included.sqldb import db
+from mock import Mock
+from pytest_mock import MockFixture
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller, publish
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician")
+class TestUpsertEncounters:
+    @pytest.fixture(autouse=True)
+    def existing(
+        self, encounter_factory: Callable, make_encounter: Callable[..., Dict]
+    ) -> Generator[None, None, None]:
+        for epr_encounter_id in ["EPR1", "EPR2"]:
+            encounter_factory(
+                uuid=f"E-{epr_encounter_id}", **make_encounter(epr_encounter_id)
+            )
+        db.session.expire_all()
+        yield
+        reset_database()
+
+    @pytest.fixture
+    def mock_publish_updates(self, mocker: MockFixture) -> Mock:
+        return mocker.patch.object(publish, "publish_encounter_updates")
+
+    @pytest.fixture
+    def make_encounter(self, dh_product_uuid: str) -> Callable[..., Dict]:
+        def make(epr_encounter_id: str, **kwargs: str) -> Dict:
+            return {
+                "epr_encounter_id": epr_encounter_id,
+                "patient_uuid": "P1",
+                "patient_record_uuid": "R1",
+                "location_uuid": "L1",
+                "dh_product_uuid": dh_product_uuid,
+                "encounter_type": "INPATIENT",
+                "score_system": "news2",
+                "admitted_at": "2020-01-01T00:00:00.000Z",
+                **kwargs,
+            }
+
+        return make
+
+    def test_upsert(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        batch = [
+            make_encounter("EPR1"),
+            make_encounter("EPR2", location_uuid="L2"),
+            make_encounter("EPR3"),
+        ]
+
+        with statement_counter(db.session) as ctr:
+            result = controller.upsert_encounters(batch)
+
+        assert result["created"] == 1
+        assert result["updated"] == 1
+        assert result["uuids"][:2] == ["E-EPR1", "E-EPR2"]
+        # Unchanged encounters are not notified
+        mock_publish_updates.assert_called_once_with(result["uuids"][1:])
+        # load, UPDATE encounter, INSERT for each of encounter, location history and
+        # the open encounter projection, UPDATE open encounter projection, refresh
+        # the latest encounter projection for the new encounter's patient
+        assert ctr.count == 7
+        moved = Encounter.query.get("E-EPR2")
+        assert moved.location_uuid == "L2"
+        assert [h.location_uuid for h in moved.location_history] == ["L1"]
+
+    def test_updates_published_over_one_connection(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_connection: Mock,
+        mock_producer: Mock,
+    ) -> None:
+        result = controller.upsert_encounters(
+            [make_encounter(f"EPR{i}", location_uuid="L2") for i in range(1, 6)]
+        )
+
+        assert mock_connection.call_count == 1
+        assert [c[1]["body"] for c in mock_producer.publish.call_args_list] == [
+            f'{{"encounter_id": "{uuid}"}}' for uuid in result["uuids"]
+        ]
+
+    def test_repeated_epr_encounter_id(
+        self, make_encounter: Callable[..., Dict], mock_publish_updates: Mock
+    ) -> None:
+        result = controller.upsert_encounters(
+            [
+                make_encounter("EPR3"),
+                make_encounter("EPR3", discharged_at="2020-01-02T00:00:00.000Z"),
+                make_encounter("EPR1", encounter_type="OUTPATIENT"),
+                make_encounter("EPR1", encounter_type="OUTPATIENT", location_uuid="L2"),
+            ]
+        )
+
+        assert result["created"] == 1
+        assert result["updated"] == 1
+        assert result["uuids"][0] == result["uuids"][1]
+        mock_publish_updates.assert_called_once_with([result["uuids"][0], "E-EPR1"])
+        created = Encounter.query.get(result["uuids"][0])
+        assert created.discharged_at is not None
+        updated = Encounter.query.get("E-EPR1")
+        assert (updated.encounter_type, updated.location_uuid) == ("OUTPATIENT", "L2")
+
+    def test_deleted_encounter_is_not_updated(
+        self, make_encounter: Callable[..., Dict], mock_publish_updates: Mock
+    ) -> None:
+        controller.upsert_encounters(
+            [make_encounter("EPR1", deleted_at="2020-01-02T00:00:00.000Z")]
+        )
+
+        result = controller.upsert_encounters([make_encounter("EPR1")])
+
+        assert result["created"] == 1
+        assert result["uuids"] != ["E-EPR1"]
+
+    @pytest.mark.parametrize("reverse", [False, True])
+    def test_reparenting_chain(
+        self,
+        encounter_factory: Callable,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        reverse: bool,
+    ) -> None:
+        encounter_factory(uuid="E-EPR3", **make_encounter("EPR3"))
+        reparent = [
+            make_encounter("EPR2", child_of_encounter_uuid="E-EPR1"),
+            make_encounter("EPR3", child_of_encounter_uuid="E-EPR2"),
+        ]
+        if reverse:
+            reparent.reverse()
+
+        result = controller.upsert_encounters(
+            reparent + [make_encounter("EPR4", child_of_encounter_uuid="E-EPR3")]
+        )
+
+        new_uuid = result["uuids"][-1]
+        closure = {
+            (c.ancestor_uuid, c.descendant_uuid, c.depth)
+            for c in EncounterClosure.query.all()
+        }
+        assert closure == {
+            ("E-EPR1", "E-EPR2", 1),
+            ("E-EPR1", "E-EPR3", 2),
+            ("E-EPR1", new_uuid, 3),
+            ("E-EPR2", "E-EPR3", 1),
+            ("E-EPR2", new_uuid, 2),
+            ("E-EPR3", new_uuid, 1),
+        }
+        assert controller.get_child_encounters("E-EPR1") == [
+            "E-EPR2",
+            "E-EPR3",
+            new_uuid,
+        ]
+
+    @pytest.mark.parametrize(
+        "changes",
+        [
+            {"score_system": "meows"},
+            {"spo2_scale": 2},
+            {"epr_encounter_id": None},
+            {"patient_uuid": None},
+        ],
+    )
+    def test_invalid_upsert_changes_nothing(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_updates: Mock,
+        changes: Dict,
+    ) -> None:
+        with pytest.raises(UnprocessibleEntityException):
+            controller.upsert_encounters(
+                [make_encounter("EPR3"), {**make_encounter("EPR1"), **changes}]
+            )
+        db.session.rollback()
+
+        assert Encounter.query.count() == 2
+        mock_publish_updates.assert_not_called()
@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Callable, Dict, Generator, List, Optional, Tuple
+from typing import Callable, ContextManager, Dict, Generator, List, Optional, Tuple
 
 import pytest
 from dateutil.parser import parse
@@ -8,6 +8,7 @@ from flask_batteries_included.helpers import generate_uuid
 from flask_batteries_included.helpers.error_handler import DuplicateResourceException
 from flask_batteries_included.sqldb import db
 from pytest_mock import MockFixture
+from sqlalchemy.orm import Session
 
 import dhos_encounters_api.blueprint_api.controller
 from dhos_encounters_api.blueprint_api import controller, publish
@@ -122,6 +123,74 @@ class TestController:
         )
         assert result == expected
 
+    @pytest.mark.parametrize(
+        "show_deleted,expected",
+        [
+            (False, {"E1P1": [], "E4P2": ["E3P2"], "E3P2": []}),
+            (True, {"E1P1": [], "E4P2": ["E3P2", "E2P2"], "E3P2": ["E2P2"]}),
+        ],
+    )
+    def test_get_child_encounters_bulk(
+        self,
+        open_encounters: List[str],
+        show_deleted: bool,
+        expected: Dict[str, List[str]],
+    ) -> None:
+        result = controller.get_child_encounters_bulk(
+            ["E1P1", "E4P2", "E3P2"], show_deleted=show_deleted
+        )
+        assert result == expected
+
+    @pytest.mark.parametrize(
+        "open_as_of,compact,expected",
+        [
+            (None, False, {"P1": "E1P1", "P2": "E4P2"}),
+            (None, True, {"P1": "E1P1", "P2": "E4P2"}),
+            ("2019-12-31T00:00:00.000Z", False, {"P1": "E1P1", "P2": "E4P2"}),
+        ],
+    )
+    def test_get_latest_encounters_for_patients(
+        self,
+        open_encounters: List[str],
+        statement_counter: Callable[[Session], ContextManager],
+        open_as_of: Optional[str],
+        compact: bool,
+        expected: Dict[str, str],
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            result = controller.get_latest_encounters_for_patients(
+                ["P1", "P2", "P3"], open_as_of=open_as_of, compact=compact
+            )
+        # Encounters, then (unless compact) both histories and all child encounters
+        assert ctr.count == (1 if compact else 4)
+
+        assert {
+            patient: encounter["uuid"] for patient, encounter in result.items()
+        } == expected
+        if compact:
+            assert "child_encounter_uuids" not in result["P2"]
+        else:
+            assert result["P2"]["child_encounter_uuids"] == ["E3P2", "E2P2"]
+            assert result["P1"]["child_encounter_uuids"] == []
+
+    def test_get_encounters_by_patient_child_lookup_batched(
+        self,
+        open_encounters: List[str],
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            result = controller.get_encounters_by_patient_or_epr_id(
+                patient_id="P2", show_children=True, show_deleted=True
+            )
+        # Children of all four encounters are found by a single query
+        assert sum("encounter_closure" in str(clause) for clause in ctr.clauses) == 1
+        assert {e["uuid"]: e["child_encounter_uuids"] for e in result} == {
+            "E4P2": ["E3P2", "E2P2"],
+            "E3P2": ["E2P2"],
+            "E2P2": [],
+            "E1P2": [],
+        }
+
     def test_create_encounter_duplicate_epr_id(
         self,
         encounter_factory: Callable,
@@ -513,6 +582,104 @@ class TestController:
             },
         )
 
+    @pytest.mark.usefixtures("jwt_clinician")
+    @pytest.mark.parametrize(
+        "changes,expected",
+        [
+            ({"encounter_type": "INPATIENT", "location_uuid": "L1"}, None),
+            ({"admitted_at": "2020-01-01T00:00:00Z"}, None),
+            (
+                {"discharged_at": "2020-01-03T00:00:00.000Z", "encounter_type": "X"},
+                [
+                    (
+                        "change",
+                        "discharged_at",
+                        (None, parse("2020-01-03T00:00:00.000Z")),
+                    ),
+                    ("change", "encounter_type", ("INPATIENT", "X")),
+                ],
+            ),
+            (
+                {"dh_product_uuid": "D2"},
+                [("change", ["dh_product", 0, "uuid"], ("D1", "D2"))],
+            ),
+            (
+                {"child_of_encounter_uuid": "E0"},
+                [("add", "", [("child_of_encounter_uuid", "E0")])],
+            ),
+        ],
+    )
+    def test_update_encounter_modifications(
+        self,
+        encounter_factory: Callable,
+        mocker: MockFixture,
+        changes: Dict,
+        expected: Optional[List[Tuple]],
+    ) -> None:
+        for uuid in ["E0", "E1"]:
+            encounter_factory(
+                uuid=uuid,
+                patient_uuid="P1",
+                patient_record_uuid="R1",
+                location_uuid="L1",
+                dh_product_uuid="D1",
+                epr_encounter_id=uuid,
+                encounter_type="INPATIENT",
+                admitted_at="2020-01-01T00:00:00.000Z",
+            )
+        mock_publish_update = mocker.patch.object(publish, "publish_encounter_update")
+        mock_publish_audit_event = mocker.patch.object(publish, "publish_audit_event")
+
+        controller.update_encounter("E1", changes)
+
+        if expected is None:
+            mock_publish_update.assert_not_called()
+            mock_publish_audit_event.assert_not_called()
+        else:
+            mock_publish_update.assert_called_once()
+            assert (
+                mock_publish_audit_event.call_args[1]["event_data"]["modifications"]
+                == expected
+            )
+        reset_database()
+
+    @pytest.mark.usefixtures("jwt_clinician")
+    def test_update_encounter_history_modifications(
+        self, encounter_factory: Callable, mocker: MockFixture
+    ) -> None:
+        encounter_factory(
+            uuid="E1",
+            patient_uuid="P1",
+            patient_record_uuid="R1",
+            location_uuid="L1",
+            dh_product_uuid="D1",
+            score_system="news2",
+            location_history=[
+                {"location_uuid": "L0", "arrived_at": "2019-01-01T00:00:00.000Z"}
+            ],
+        )
+        mock_publish_audit_event = mocker.patch.object(publish, "publish_audit_event")
+
+        result = controller.update_encounter(
+            "E1", {"location_uuid": "L2", "score_system": "meows"}
+        )
+
+        modifications = mock_publish_audit_event.call_args[1]["event_data"][
+            "modifications"
+        ]
+        assert modifications == [
+            ("change", "location_uuid", ("L1", "L2")),
+            ("change", "score_system", ("news2", "meows")),
+            (
+                "add",
+                "score_system_history",
+                [(0, result["score_system_history"][0])],
+            ),
+            ("add", "location_history", [(1, result["location_history"][1])]),
+        ]
+        assert result["location_history"][1]["location_uuid"] == "L1"
+        reset_database()
+
     def test_retrieve_patient_count_for_locations(
         self, open_encounters: List[str]
     ) -> None:
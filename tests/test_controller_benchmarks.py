@@ -0,0 +1,109 @@
+import itertools
+import os
+from typing import Iterator
+
+import pytest
+from flask import Flask
+
+from dhos_encounters_api.blueprint_api import controller
+from tests.conftest import Benchmark, SyntheticEncounters
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("DATABASE_PORT"), reason="Benchmarks need Postgres"
+)
+
+
+@pytest.fixture(scope="module", params=[500, 5000])
+def data(
+    request: pytest.FixtureRequest, session_app: Flask
+) -> Iterator[SyntheticEncounters]:
+    """Synthetic encounters for the number of patients, ten to a location."""
+    with session_app.app_context():
+        data = SyntheticEncounters(
+            patients=request.param, locations=request.param // 10
+        )
+    yield data
+    with session_app.app_context():
+        data.truncate()
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestControllerBenchmarks:
+    """
+    Benchmarks controller functions in-process against databases of different sizes.
+    Record a new baseline after an intended change with:
+        RECORD_BENCHMARK_BASELINE=1 pytest tests/test_controller_benchmarks.py
+    """
+
+    def test_get_open_encounters_for_locations(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        assert controller_benchmark(
+            lambda: controller.get_open_encounters_for_locations(
+                data.location_uuids, compact=True
+            )
+        )
+
+    def test_get_open_encounters_for_locations_open_as_of(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        assert controller_benchmark(
+            lambda: controller.get_open_encounters_for_locations(
+                data.location_uuids, open_as_of=data.open_as_of
+            )
+        )
+
+    def test_retrieve_patient_count_for_locations(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        # With open_as_of, as the counts without it are cached.
+        assert controller_benchmark(
+            lambda: controller.retrieve_patient_count_for_locations(
+                data.location_uuids, open_as_of=data.open_as_of
+            )
+        )
+
+    def test_get_encounters_by_patient_or_epr_id(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        assert controller_benchmark(
+            lambda: controller.get_encounters_by_patient_or_epr_id(
+                patient_id=data.patient_uuid
+            )
+        )
+
+    def test_update_encounter(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        # Moves an open encounter back and forth between the two busiest locations.
+        changes = itertools.cycle(
+            {"location_uuid": location_uuid}
+            for location_uuid in data.location_uuids[:2]
+        )
+        assert controller_benchmark(
+            lambda: controller.update_encounter(data.open_encounter_uuid, next(changes))
+        )
+
+    def test_merge_encounters(
+        self, data: SyntheticEncounters, controller_benchmark: Benchmark
+    ) -> None:
+        # Merges two patients' encounters one way then back again.
+        first_record, first_patient, _ = data.merge_records[0]
+        second_record, second_patient, _ = data.merge_records[1]
+        merges = itertools.cycle(
+            [
+                {
+                    "child_record_uuid": first_record,
+                    "parent_record_uuid": second_record,
+                    "parent_patient_uuid": second_patient,
+                    "message_uuid": "M1",
+                },
+                {
+                    "child_record_uuid": second_record,
+                    "parent_record_uuid": first_record,
+                    "parent_patient_uuid": first_patient,
+                    "message_uuid": "M1",
+                },
+            ]
+        )
+        assert controller_benchmark(lambda: controller.merge_encounters(**next(merges)))
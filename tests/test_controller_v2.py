@@ -1,3 +1,4 @@
+from datetime import datetime
 from typing import Callable, Dict, Generator, List, Optional
 
 import pytest
@@ -377,3 +378,68 @@ class TestControllerV2:
         )
 
         assert len(encounters) == 5
+
+    @pytest.mark.parametrize("compact", [True, False])
+    def test_get_encounters_page(
+        self,
+        encounter_factory: Callable,
+        location_uuid: str,
+        dh_product_uuid: str,
+        record_uuid: str,
+        patient_uuid: str,
+        compact: bool,
+    ) -> None:
+        for i in range(5):
+            encounter_factory(
+                location_uuid=location_uuid,
+                epr_encounter_id=f"thisisanencounterid_page{i}",
+                encounter_type="INPATIENT",
+                admitted_at="2020-01-01T00:00:00.001Z",
+                patient_record_uuid=record_uuid,
+                patient_uuid=patient_uuid,
+                dh_product_uuid=dh_product_uuid,
+            )
+        # Give two encounters the same modified time to check the uuid tie-break
+        Encounter.query.filter(
+            Encounter.epr_encounter_id.in_(
+                ["thisisanencounterid_page1", "thisisanencounterid_page2"]
+            )
+        ).update({"modified": datetime(2021, 1, 1)}, synchronize_session=False)
+        db.session.commit()
+        expected = [
+            enc["uuid"]
+            for enc in reversed(
+                dhos_encounters_api.blueprint_api.controller.get_encounters(
+                    modified_since="2020-01-01"
+                )
+            )
+        ]
+
+        pages: List[List[str]] = []
+        cursor: Optional[str] = None
+        while True:
+            page = dhos_encounters_api.blueprint_api.controller.get_encounters_page(
+                modified_since="2020-01-01",
+                page_size=2,
+                cursor=cursor,
+                compact=compact,
+            )
+            pages.append([enc["uuid"] for enc in page["results"]])
+            cursor = page["next"]
+            if cursor is None:
+                break
+
+        assert [len(page) for page in pages] == [2, 2, 1]
+        assert sorted(uuid for page in pages for uuid in page) == sorted(expected)
+
+    @pytest.mark.parametrize(
+        "page_size,cursor",
+        [(0, None), (100_000, None), (10, "not a cursor"), (10, "W10")],
+    )
+    def test_get_encounters_page_invalid(
+        self, page_size: int, cursor: Optional[str]
+    ) -> None:
+        with pytest.raises(ValueError):
+            dhos_encounters_api.blueprint_api.controller.get_encounters_page(
+                modified_since="2020-01-01", page_size=page_size, cursor=cursor
+            )
@@ -0,0 +1,96 @@
+from typing import Callable, Dict, Generator, List
+
+import pytest
+from flask_batteries_included.helpers.error_handler import UnprocessibleEntityException
+from flask_batteries_included.sqldb import db
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+
+
+@pytest.mark.usefixtures("app_context", "jwt_clinician")
+class TestEncounterClosure:
+    @pytest.fixture(autouse=True)
+    def pre_existing_nodes(self) -> Generator[None, None, None]:
+        yield
+        Encounter.query.delete()
+        db.session.commit()
+
+    @pytest.fixture
+    def tree(
+        self,
+        encounter_factory: Callable,
+        location_uuid: str,
+        dh_product_uuid: str,
+        record_uuid: str,
+        patient_uuid: str,
+    ) -> Dict[str, Encounter]:
+        """A -> B -> C and a separate root D"""
+        encounters: Dict[str, Encounter] = {}
+        for name, parent in [("A", None), ("B", "A"), ("C", "B"), ("D", None)]:
+            encounters[name] = encounter_factory(
+                uuid=f"closure-{name}",
+                location_uuid=location_uuid,
+                epr_encounter_id=f"epr-closure-{name}",
+                patient_record_uuid=record_uuid,
+                patient_uuid=patient_uuid,
+                dh_product_uuid=dh_product_uuid,
+                child_of_encounter_uuid=None if parent is None else f"closure-{parent}",
+            )
+        return encounters
+
+    def _closure(self) -> List[tuple]:
+        return sorted(
+            db.session.query(
+                EncounterClosure.ancestor_uuid,
+                EncounterClosure.descendant_uuid,
+                EncounterClosure.depth,
+            ).all()
+        )
+
+    def test_new_populates_closure(self, tree: Dict[str, Encounter]) -> None:
+        assert self._closure() == [
+            ("closure-A", "closure-B", 1),
+            ("closure-A", "closure-C", 2),
+            ("closure-B", "closure-C", 1),
+        ]
+        assert controller.get_child_encounters("closure-A") == [
+            "closure-B",
+            "closure-C",
+        ]
+
+    def test_update_moves_subtree(self, tree: Dict[str, Encounter]) -> None:
+        tree["B"].update(child_of_encounter_uuid="closure-D")
+        db.session.commit()
+
+        assert self._closure() == [
+            ("closure-B", "closure-C", 1),
+            ("closure-D", "closure-B", 1),
+            ("closure-D", "closure-C", 2),
+        ]
+        assert controller.get_child_encounters("closure-A") == []
+
+    def test_update_rejects_cycle(self, tree: Dict[str, Encounter]) -> None:
+        with pytest.raises(UnprocessibleEntityException):
+            tree["A"].update(child_of_encounter_uuid="closure-C")
+
+    def test_remove_detaches_subtree(self, tree: Dict[str, Encounter]) -> None:
+        tree["B"].remove(child_of_encounter_uuid="closure-A")
+        db.session.commit()
+
+        assert self._closure() == [("closure-B", "closure-C", 1)]
+        assert controller.get_child_encounters("closure-A") == []
+        assert controller.get_child_encounters("closure-B") == ["closure-C"]
+
+    def test_deleted_encounter_hides_descendants(
+        self, tree: Dict[str, Encounter]
+    ) -> None:
+        tree["B"].update(deleted_at="2020-01-01T00:00:00.000Z")
+        db.session.commit()
+
+        assert controller.get_child_encounters("closure-A") == []
+        assert controller.get_child_encounters("closure-A", show_deleted=True) == [
+            "closure-B",
+            "closure-C",
+        ]
@@ -81,7 +81,8 @@ def test_get_open_encounters_for_locations(
             ),
             compact=compact,
         )
-    assert ctr.count == 1
+    # One query for the encounters and, unless compact, one per history relationship
+    assert ctr.count == (1 if compact else 3)
 
     assert len(open_encounters) == 1
     assert open_encounters[0]["epr_encounter_id"] == "thisisanencounterid8"
@@ -57,3 +57,34 @@ def test_get_open_encounters_for_patients(
         patient_ids=uuids_in, open_as_of="2019-01-01T00:00:00.000Z"
     )
     assert [e["patient_uuid"] for e in open_encounters] == expect_uuids
+
+
+@pytest.mark.parametrize("expanded", [True, False])
+def test_get_open_encounters_for_patients_compact(
+    app: Flask,
+    jwt_clinician: str,
+    encounter_factory: Callable,
+    location_uuid: str,
+    dh_product_uuid: str,
+    record_uuid: str,
+    patient_uuid: str,
+    expanded: bool,
+) -> None:
+    encounter = encounter_factory(
+        location_uuid=location_uuid,
+        epr_encounter_id=str(uuid.uuid4()),
+        encounter_type="INPATIENT",
+        admitted_at="2018-01-02T00:00:00.000Z",
+        discharged_at=None,
+        patient_record_uuid=record_uuid,
+        patient_uuid=patient_uuid,
+        dh_product_uuid=dh_product_uuid,
+    )
+
+    open_encounters: List[Dict] = get_open_encounters_for_patients(
+        patient_ids=[patient_uuid],
+        open_as_of="2019-01-01T00:00:00.000Z",
+        compact=True,
+        expanded=expanded,
+    )
+    assert open_encounters == [encounter.to_dict(compact=True, expanded=expanded)]
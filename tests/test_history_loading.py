@@ -0,0 +1,121 @@
+import time
+from typing import Callable, ContextManager, Generator, List
+
+import pytest
+from flask_batteries_included.sqldb import db
+from sqlalchemy.orm import Session, joinedload, selectinload
+from sqlalchemy.orm.strategy_options import Load
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.location_history import LocationHistory
+from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
+
+ENCOUNTERS = 10
+LOCATION_MOVES = 20
+SCORE_SYSTEM_CHANGES = 10
+
+
+@pytest.mark.usefixtures("app_context", "jwt_clinician")
+class TestHistoryLoading:
+    """
+    Benchmarks loading encounters with long location and score system histories.
+    Rows fetched and elapsed time are recorded as test properties (see --junitxml).
+    """
+
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self,
+        location_uuid: str,
+        dh_product_uuid: str,
+        record_uuid: str,
+        patient_uuid: str,
+    ) -> Generator[List[str], None, None]:
+        uuids: List[str] = []
+        for i in range(ENCOUNTERS):
+            encounter = Encounter.new(
+                location_uuid=location_uuid,
+                epr_encounter_id=f"history-loading-{i}",
+                encounter_type="INPATIENT",
+                admitted_at="2018-01-01T00:00:00.000Z",
+                patient_record_uuid=record_uuid,
+                patient_uuid=f"{patient_uuid[:30]}-{i}",
+                dh_product_uuid=dh_product_uuid,
+            )
+            db.session.flush()
+            for move in range(LOCATION_MOVES):
+                LocationHistory.new(
+                    encounter_uuid=encounter.uuid, location_uuid=f"location-{move}"
+                )
+            for change in range(SCORE_SYSTEM_CHANGES):
+                ScoreSystemHistory.new(
+                    encounter_uuid=encounter.uuid,
+                    score_system="news2",
+                    spo2_scale=1 + change % 2,
+                )
+            uuids.append(encounter.uuid)
+        db.session.commit()
+        db.session.expunge_all()
+
+        yield uuids
+
+        LocationHistory.query.delete()
+        ScoreSystemHistory.query.delete()
+        Encounter.query.delete()
+        db.session.commit()
+
+    @pytest.mark.parametrize(
+        "strategy,expected_rows",
+        [
+            (joinedload, ENCOUNTERS * LOCATION_MOVES * SCORE_SYSTEM_CHANGES),
+            (
+                selectinload,
+                ENCOUNTERS * (1 + LOCATION_MOVES + SCORE_SYSTEM_CHANGES),
+            ),
+        ],
+    )
+    def test_loading_strategy_rows(
+        self,
+        encounters: List[str],
+        statement_counter: Callable[[Session], ContextManager],
+        record_property: Callable,
+        strategy: Callable[..., Load],
+        expected_rows: int,
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            start = time.perf_counter()
+            results = (
+                Encounter.query.filter(Encounter.uuid.in_(encounters))
+                .options(
+                    strategy(Encounter.score_system_history),
+                    strategy(Encounter.location_history),
+                )
+                .all()
+            )
+            dicts = [encounter.to_dict() for encounter in results]
+            record_property("elapsed_ms", (time.perf_counter() - start) * 1000)
+        record_property("rows", ctr.rows)
+
+        assert ctr.rows == expected_rows
+        assert len(dicts) == ENCOUNTERS
+        assert all(
+            len(d["location_history"]) == LOCATION_MOVES
+            and len(d["score_system_history"]) == SCORE_SYSTEM_CHANGES
+            for d in dicts
+        )
+
+    def test_get_open_encounters_for_patients_rows(
+        self,
+        statement_counter: Callable[[Session], ContextManager],
+        record_property: Callable,
+    ) -> None:
+        patient_uuids = [encounter.patient_uuid for encounter in Encounter.query.all()]
+
+        with statement_counter(db.session) as ctr:
+            start = time.perf_counter()
+            result = controller.get_open_encounters_for_patients(patient_uuids)
+            record_property("elapsed_ms", (time.perf_counter() - start) * 1000)
+        record_property("rows", ctr.rows)
+
+        assert len(result) == ENCOUNTERS
+        assert ctr.rows == ENCOUNTERS * (1 + LOCATION_MOVES + SCORE_SYSTEM_CHANGES)
@@ -0,0 +1,119 @@
+from typing import Callable, ContextManager, Dict, Generator
+
+import pytest
+from flask_batteries_included.sqldb import db
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestLatestEncounterByPatient:
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[Dict[str, Encounter], None, None]:
+        encounters = {
+            uuid: encounter_factory(
+                uuid=uuid,
+                patient_uuid=patient,
+                patient_record_uuid=f"{patient}R1",
+                location_uuid="L1",
+                dh_product_uuid=dh_product_uuid,
+                admitted_at=admitted_at,
+                discharged_at=discharged_at,
+                child_of_encounter_uuid=parent,
+            )
+            for uuid, patient, admitted_at, discharged_at, parent in [
+                ("E1", "P1", "2020-01-01", None, None),
+                ("E2", "P1", "2020-02-01", "2020-03-01", None),
+                ("E3", "P1", "2020-04-01", None, "E1"),
+                ("E4", "P2", "2020-01-15", None, None),
+            ]
+        }
+        yield encounters
+        reset_database()
+
+    def _projection(self) -> Dict[str, str]:
+        return dict(
+            db.session.query(
+                LatestEncounterByPatient.patient_uuid,
+                LatestEncounterByPatient.encounter_uuid,
+            ).all()
+        )
+
+    def test_new_prefers_open_parent_encounters(self) -> None:
+        assert self._projection() == {"P1": "E1", "P2": "E4"}
+
+    @pytest.mark.parametrize(
+        "changes,expected",
+        [
+            ({"discharged_at": "2020-05-01T00:00:00.000Z"}, "E2"),
+            ({"deleted_at": "2020-05-01T00:00:00.000Z"}, "E2"),
+            ({"child_of_encounter_uuid": "E4"}, "E2"),
+            ({"admitted_at": "2021-01-01T00:00:00.000Z"}, "E1"),
+        ],
+    )
+    def test_update(self, changes: Dict, expected: str) -> None:
+        controller.update_encounter("E1", changes)
+
+        assert self._projection() == {"P1": expected, "P2": "E4"}
+
+    def test_update_reopen(self) -> None:
+        controller.update_encounter("E2", {"discharged_at": None})
+
+        assert self._projection() == {"P1": "E2", "P2": "E4"}
+
+    def test_remove_parent(self) -> None:
+        controller.remove_from_encounter("E3", {"child_of_encounter_uuid": "E1"})
+
+        assert self._projection() == {"P1": "E3", "P2": "E4"}
+
+    def test_delete_last_encounter_removes_patient(self) -> None:
+        controller.update_encounter("E4", {"deleted_at": "2020-05-01T00:00:00.000Z"})
+
+        assert self._projection() == {"P1": "E1"}
+
+    def test_create(self, dh_product_uuid: str) -> None:
+        encounter = controller.create_encounter(
+            {
+                "patient_uuid": "P2",
+                "patient_record_uuid": "P2R1",
+                "location_uuid": "L1",
+                "dh_product_uuid": dh_product_uuid,
+                "epr_encounter_id": "EPR5",
+                "admitted_at": "2020-02-01T00:00:00.000Z",
+            }
+        )
+
+        assert self._projection() == {"P1": "E1", "P2": encounter["uuid"]}
+
+    def test_merge(self) -> None:
+        controller.merge_encounters(
+            child_record_uuid="P1R1",
+            parent_record_uuid="P2R1",
+            parent_patient_uuid="P2",
+            message_uuid="M1",
+        )
+
+        assert self._projection() == {"P2": "E4"}
+
+    def test_latest_reads_use_projection(
+        self, statement_counter: Callable[[Session], ContextManager]
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            encounters = controller.get_latest_encounters_for_patients(
+                ["P1", "P2", "P3"], compact=True
+            )
+
+        assert {p: e["uuid"] for p, e in encounters.items()} == {
+            "P1": "E1",
+            "P2": "E4",
+        }
+        assert ctr.count == 1
+        assert "latest_encounter_by_patient" in str(ctr.clauses[0])
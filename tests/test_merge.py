@@ -1,11 +1,15 @@
 from collections import Callable
-from typing import Dict, Generator
+from typing import ContextManager, Dict, Generator
 
 import pytest
 from flask_batteries_included.sqldb import db
+from sqlalchemy.orm import Session
 
 from dhos_encounters_api.blueprint_api import controller
 from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
 from dhos_encounters_api.models.location_history import LocationHistory
 from dhos_encounters_api.models.score_system_history import ScoreSystemHistory
 
@@ -169,3 +173,91 @@ class TestMerge:
         ]
         assert enc.patient_uuid == parent_patient_uuid
         assert enc.patient_record_uuid == parent_patient_record_uuid
+
+    @pytest.fixture
+    def many_encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Dict[str, str]:
+        """Encounters for records R1 (patient P1) and R2 (patient P2)"""
+        encounters = {}
+        for i, (record, patient) in enumerate([("R1", "P1")] * 5 + [("R2", "P2")]):
+            encounters[f"E{i}"] = encounter_factory(
+                uuid=f"E{i}",
+                epr_encounter_id=f"epr_encounter{i}",
+                location_uuid=f"L{i % 2}",
+                dh_product_uuid=dh_product_uuid,
+                patient_record_uuid=record,
+                patient_uuid=patient,
+                merge_history=None if i == 0 else [],
+            ).modified
+        return encounters
+
+    def test_merge_is_set_based(
+        self,
+        many_encounters: Dict[str, str],
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            result = controller.merge_encounters(
+                child_record_uuid="R1",
+                parent_record_uuid="R3",
+                parent_patient_uuid="P3",
+                message_uuid="M1",
+            )
+
+        assert result == {"total": 5}
+        # UPDATE encounter, UPDATE open_encounter_by_location, then find the patients
+        # whose latest encounter moved and refresh latest_encounter_by_patient
+        assert ctr.count == 4
+        latest = {
+            row.patient_uuid: row.encounter_uuid
+            for row in LatestEncounterByPatient.query.all()
+        }
+        assert latest == {"P2": "E5", "P3": "E4"}
+        for uuid in ["E0", "E4"]:
+            enc = Encounter.query.get(uuid)
+            assert enc.patient_uuid == "P3"
+            assert enc.open_encounter.patient_uuid == "P3"
+            assert enc.merge_history == [
+                {"record_uuid": "R1", "patient_uuid": "P1", "message_uuid": "M1"}
+            ]
+            assert enc.modified > many_encounters[uuid]
+        assert Encounter.query.get("E5").merge_history == []
+
+    def test_merge_batch(self, many_encounters: Dict[str, str]) -> None:
+        result = controller.merge_encounters_batch(
+            [
+                {
+                    "child_record_uuid": "R1",
+                    "parent_record_uuid": "R2",
+                    "parent_patient_uuid": "P2",
+                    "message_uuid": "M1",
+                },
+                {
+                    "child_record_uuid": "R2",
+                    "parent_record_uuid": "R3",
+                    "parent_patient_uuid": "P3",
+                    "message_uuid": "M2",
+                },
+            ]
+        )
+
+        assert result == {"total": 11}
+        assert Encounter.query.get("E1").merge_history == [
+            {"record_uuid": "R1", "patient_uuid": "P1", "message_uuid": "M1"},
+            {"record_uuid": "R2", "patient_uuid": "P2", "message_uuid": "M2"},
+        ]
+        assert {e.patient_uuid for e in Encounter.query.all()} == {"P3"}
+
+    def test_merge_batch_identical_records(self) -> None:
+        with pytest.raises(ValueError):
+            controller.merge_encounters_batch(
+                [
+                    {
+                        "child_record_uuid": "R1",
+                        "parent_record_uuid": "R1",
+                        "parent_patient_uuid": "P1",
+                        "message_uuid": "M1",
+                    }
+                ]
+            )
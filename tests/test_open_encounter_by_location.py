@@ -0,0 +1,102 @@
+from typing import Callable, ContextManager, Dict, Generator, List, Tuple
+
+import pytest
+from flask_batteries_included.sqldb import db
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestOpenEncounterByLocation:
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[Dict[str, Encounter], None, None]:
+        encounters = {
+            uuid: encounter_factory(
+                uuid=uuid,
+                patient_uuid=patient,
+                patient_record_uuid=f"{patient}R1",
+                location_uuid=location,
+                dh_product_uuid=dh_product_uuid,
+                admitted_at="2020-01-01",
+                child_of_encounter_uuid=parent,
+            )
+            for uuid, patient, location, parent in [
+                ("E1", "P1", "L1", None),
+                ("E2", "P2", "L1", None),
+                ("E3", "P2", "L1", "E2"),
+            ]
+        }
+        yield encounters
+        reset_database()
+
+    def _projection(self) -> List[Tuple[str, str, str]]:
+        return sorted(
+            db.session.query(
+                OpenEncounterByLocation.encounter_uuid,
+                OpenEncounterByLocation.location_uuid,
+                OpenEncounterByLocation.patient_uuid,
+            ).all()
+        )
+
+    def test_new_adds_open_parent_encounters(self) -> None:
+        assert self._projection() == [("E1", "L1", "P1"), ("E2", "L1", "P2")]
+
+    @pytest.mark.parametrize(
+        "changes,expected",
+        [
+            ({"location_uuid": "L2"}, [("E1", "L2", "P1"), ("E2", "L1", "P2")]),
+            ({"discharged_at": "2020-02-01T00:00:00.000Z"}, [("E2", "L1", "P2")]),
+            ({"deleted_at": "2020-02-01T00:00:00.000Z"}, [("E2", "L1", "P2")]),
+            ({"child_of_encounter_uuid": "E2"}, [("E2", "L1", "P2")]),
+        ],
+    )
+    def test_update(self, changes: Dict, expected: List[Tuple]) -> None:
+        controller.update_encounter("E1", changes)
+
+        assert self._projection() == expected
+
+    def test_update_reopen(self) -> None:
+        controller.update_encounter("E1", {"discharged_at": "2020-02-01T00:00:00Z"})
+        controller.update_encounter("E1", {"discharged_at": None})
+
+        assert self._projection() == [("E1", "L1", "P1"), ("E2", "L1", "P2")]
+
+    def test_remove_parent_adds_encounter(self) -> None:
+        controller.remove_from_encounter("E3", {"child_of_encounter_uuid": "E2"})
+
+        assert self._projection() == [
+            ("E1", "L1", "P1"),
+            ("E2", "L1", "P2"),
+            ("E3", "L1", "P2"),
+        ]
+
+    def test_merge_updates_patient(self) -> None:
+        controller.merge_encounters(
+            child_record_uuid="P1R1",
+            parent_record_uuid="P3R1",
+            parent_patient_uuid="P3",
+            message_uuid="M1",
+        )
+
+        assert self._projection() == [("E1", "L1", "P3"), ("E2", "L1", "P2")]
+
+    def test_location_reads_use_projection(
+        self, statement_counter: Callable[[Session], ContextManager]
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            encounters = controller.get_open_encounters_for_locations(
+                ["L1"], compact=True
+            )
+            counts = controller.retrieve_patient_count_for_locations(["L1"], None)
+
+        assert sorted(e["uuid"] for e in encounters) == ["E1", "E2"]
+        assert counts == {"L1": 2}
+        assert all("open_encounter_by_location" in str(c) for c in ctr.clauses)
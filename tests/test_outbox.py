@@ -0,0 +1,168 @@
+import json
+from typing import Dict, Generator, List, Optional
+
+import pytest
+from flask import Flask
+from flask_batteries_included.helpers.error_handler import DuplicateResourceException
+from flask_batteries_included.sqldb import db
+from mock import Mock
+from pytest_mock import MockFixture
+from she_logging.request_id import current_request_id, reset_request_id, set_request_id
+
+from dhos_encounters_api.blueprint_api import controller, publish
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.outbox_message import OutboxMessage
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician")
+class TestOutbox:
+    @pytest.fixture(autouse=True)
+    def outbox_mode(
+        self, app: Flask, monkeypatch: pytest.MonkeyPatch
+    ) -> Generator[None, None, None]:
+        monkeypatch.setitem(app.extensions, publish.EXTENSION_NAME, "outbox")
+        yield
+        reset_database()
+
+    @pytest.fixture
+    def encounter_data(self, dh_product_uuid: str) -> Dict:
+        return {
+            "patient_uuid": "P1",
+            "patient_record_uuid": "R1",
+            "location_uuid": "L1",
+            "dh_product_uuid": dh_product_uuid,
+            "epr_encounter_id": "EPR1",
+        }
+
+    def _outbox(self) -> List[Dict]:
+        return [
+            {"routing_key": m.routing_key, "body": json.loads(m.body)}
+            for m in OutboxMessage.query.order_by(OutboxMessage.id)
+        ]
+
+    def test_messages_written_with_changes(
+        self, encounter_data: Dict, mock_publish_msg: Mock
+    ) -> None:
+        encounter = controller.create_encounter(encounter_data)
+        controller.update_encounter(encounter["uuid"], {"location_uuid": "L2"})
+
+        mock_publish_msg.assert_not_called()
+        outbox = self._outbox()
+        assert [m["routing_key"] for m in outbox] == [
+            "dhos.DM000007",
+            "dhos.DM000007",
+            "dhos.34837004",
+        ]
+        assert outbox[0]["body"] == {"encounter_id": encounter["uuid"]}
+        assert outbox[2]["body"]["event_type"] == "encounter_modified"
+
+    def test_no_messages_for_failed_change(
+        self, encounter_data: Dict, mock_publish_msg: Mock
+    ) -> None:
+        controller.create_encounter(encounter_data)
+        with pytest.raises(DuplicateResourceException):
+            controller.create_encounter(encounter_data)
+        db.session.rollback()
+
+        assert len(self._outbox()) == 1
+
+    def test_bulk_create(self, encounter_data: Dict, mock_publish_msg: Mock) -> None:
+        result = controller.create_encounters(
+            [encounter_data, {**encounter_data, "epr_encounter_id": "EPR2"}]
+        )
+
+        mock_publish_msg.assert_not_called()
+        assert [m["body"] for m in self._outbox()] == [
+            {"encounter_id": uuid} for uuid in result["uuids"]
+        ]
+
+    def test_relay(self, mock_connection: Mock, mock_producer: Mock) -> None:
+        token = set_request_id("R1")
+        for i in range(3):
+            publish.publish_encounter_update({"uuid": f"E{i}"})
+        db.session.commit()
+        reset_request_id(token)
+        request_ids: List[Optional[str]] = []
+        mock_producer.publish.side_effect = lambda **kwargs: request_ids.append(
+            current_request_id()
+        )
+
+        assert publish.relay_outbox(batch_size=2) == 2
+        assert publish.relay_outbox(batch_size=2) == 1
+        assert publish.relay_outbox(batch_size=2) == 0
+
+        # One connection per batch
+        assert mock_connection.call_count == 2
+        publish_calls = mock_producer.publish.call_args_list
+        assert [json.loads(c[1]["body"]) for c in publish_calls] == [
+            {"encounter_id": "E0"},
+            {"encounter_id": "E1"},
+            {"encounter_id": "E2"},
+        ]
+        # Sent under the ID of the request that published them
+        assert [c[1]["correlation_id"] for c in publish_calls] == ["R1"] * 3
+        assert request_ids == ["R1"] * 3
+        assert self._outbox() == []
+
+    def test_relay_coalesces_encounter_updates(self, mock_producer: Mock) -> None:
+        for encounter_id in ["E1", "E2", "E1"]:
+            publish.publish_encounter_update({"uuid": encounter_id})
+        publish.publish_audit_event("event", {})
+        publish.publish_audit_event("event", {})
+        db.session.commit()
+
+        assert publish.relay_outbox() == 5
+
+        assert [
+            json.loads(c[1]["body"]) for c in mock_producer.publish.call_args_list
+        ] == [
+            {"encounter_id": "E2"},
+            {"encounter_id": "E1"},
+            {"event_type": "event", "event_data": {}},
+            {"event_type": "event", "event_data": {}},
+        ]
+        assert self._outbox() == []
+
+    def test_relay_keeps_messages_on_failure(self, mock_producer: Mock) -> None:
+        publish.publish_encounter_update({"uuid": "E1"})
+        db.session.commit()
+        mock_producer.publish.side_effect = ConnectionError
+
+        with pytest.raises(ConnectionError):
+            publish.relay_outbox()
+
+        assert self._outbox() == [
+            {"routing_key": "dhos.DM000007", "body": {"encounter_id": "E1"}}
+        ]
+
+
+@pytest.mark.usefixtures("app")
+class TestDirectTransaction:
+    def test_sent_after_commit(
+        self, mock_publish_msg: Mock, mocker: MockFixture
+    ) -> None:
+        mock_commit = mocker.patch.object(db.session, "commit")
+
+        with publish.transaction():
+            publish.publish_encounter_update({"uuid": "E1"})
+            mock_publish_msg.assert_not_called()
+            mock_commit.assert_not_called()
+
+        mock_commit.assert_called_once()
+        mock_publish_msg.assert_called_once_with(
+            routing_key="dhos.DM000007", body={"encounter_id": "E1"}
+        )
+
+    def test_not_sent_on_error(self, mock_publish_msg: Mock) -> None:
+        with pytest.raises(ValueError):
+            with publish.transaction():
+                publish.publish_encounter_update({"uuid": "E1"})
+                raise ValueError()
+
+        mock_publish_msg.assert_not_called()
+        publish.publish_encounter_update({"uuid": "E2"})
+        assert mock_publish_msg.call_count == 1
+
+    def test_unknown_mode(self, app: Flask) -> None:
+        with pytest.raises(ValueError):
+            publish.init_publish(app, mode="carrier-pigeon")
@@ -0,0 +1,76 @@
+import time
+from typing import Callable, ContextManager, Dict, Generator
+
+import pytest
+from flask.testing import FlaskClient
+from flask_batteries_included.sqldb import db
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_development import reset_database
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician", "mock_publish_msg")
+class TestPatchRoundTrips:
+    """
+    Benchmarks the database round trips made by PATCH /dhos/v1/encounter/<id>. The
+    statement count and elapsed time are recorded as test properties (see --junitxml).
+    """
+
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[None, None, None]:
+        for uuid in ["E0", "E1"]:
+            encounter_factory(
+                uuid=uuid,
+                patient_uuid=f"P-{uuid}",
+                patient_record_uuid=f"R-{uuid}",
+                location_uuid="L1",
+                dh_product_uuid=dh_product_uuid,
+                epr_encounter_id=f"EPR-{uuid}",
+                score_system="news2",
+                location_history=[{"location_uuid": "L0"}],
+            )
+        db.session.expire_all()
+        yield
+        reset_database()
+
+    @pytest.mark.parametrize(
+        "changes,expected_status,expected_statements",
+        [
+            # load, UPDATE, reload
+            ({"encounter_type": "INPATIENT"}, 200, 3),
+            # + INSERT location_history, UPDATE open_encounter_by_location
+            ({"location_uuid": "L2"}, 200, 5),
+            # + INSERT score_system_history
+            ({"score_system": "meows"}, 200, 4),
+            # + 3 closure table statements, DELETE open_encounter_by_location,
+            # refresh latest_encounter_by_patient
+            ({"child_of_encounter_uuid": "E0"}, 200, 9),
+            # load, then the parent lookup finds nothing
+            ({"child_of_encounter_uuid": "unknown"}, 422, 2),
+        ],
+    )
+    def test_patch_round_trips(
+        self,
+        client: FlaskClient,
+        statement_counter: Callable[[Session], ContextManager],
+        record_property: Callable,
+        changes: Dict,
+        expected_status: int,
+        expected_statements: int,
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            start = time.perf_counter()
+            response = client.patch(
+                "/dhos/v1/encounter/E1",
+                headers={"Authorization": "Bearer TOKEN"},
+                json=changes,
+            )
+            record_property("elapsed_ms", (time.perf_counter() - start) * 1000)
+        # Round trips, so statements sent to the cursor rather than clauses executed
+        round_trips = len(ctr.statements)
+        record_property("statements", round_trips)
+
+        assert response.status_code == expected_status
+        assert round_trips == expected_statements
@@ -0,0 +1,185 @@
+import subprocess
+import sys
+from typing import Callable, ContextManager, Dict, Generator
+
+import pytest
+from flask_batteries_included.sqldb import db
+from mock import Mock
+from redis import RedisError
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.helpers.patient_count_cache import (
+    LocalPatientCountCache,
+    RedisPatientCountCache,
+)
+from dhos_encounters_api.models.encounter import Encounter
+
+
+class TestLocalPatientCountCache:
+    def test_get_set_invalidate(self) -> None:
+        cache = LocalPatientCountCache(ttl=60)
+        cache.set_many({"L1": 2, "L2": 0})
+
+        assert cache.get_many(["L1", "L2", "L3"]) == {"L1": 2, "L2": 0}
+
+        cache.invalidate(["L1", None])
+        assert cache.get_many(["L1", "L2"]) == {"L2": 0}
+
+        cache.clear()
+        assert cache.get_many(["L2"]) == {}
+
+    def test_expired_entries_are_misses(self) -> None:
+        cache = LocalPatientCountCache(ttl=0)
+        cache.set_many({"L1": 2})
+
+        assert cache.get_many(["L1"]) == {}
+
+    def test_works_without_redis(self) -> None:
+        # In a new interpreter, as redis is already imported in this one.
+        subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; sys.modules['redis'] = sys.modules['dhosredis'] = None; "
+                "from dhos_encounters_api.helpers import patient_count_cache; "
+                "patient_count_cache.LocalPatientCountCache()",
+            ],
+            check=True,
+        )
+
+
+class TestRedisPatientCountCache:
+    def test_get_many(self) -> None:
+        client = Mock()
+        client.mget.return_value = ["3", None]
+        cache = RedisPatientCountCache(client, ttl=10)
+
+        assert cache.get_many(["L1", "L2"]) == {"L1": 3}
+        client.mget.assert_called_once_with(
+            [
+                "dhos-encounters-api:patient_count:L1",
+                "dhos-encounters-api:patient_count:L2",
+            ]
+        )
+
+    def test_set_many_sets_expiry(self) -> None:
+        client = Mock()
+        cache = RedisPatientCountCache(client, ttl=10)
+
+        cache.set_many({"L1": 3})
+
+        pipeline = client.pipeline.return_value
+        pipeline.set.assert_called_once_with(
+            "dhos-encounters-api:patient_count:L1", 3, ex=10
+        )
+        pipeline.execute.assert_called_once()
+
+    def test_redis_errors_are_misses(self) -> None:
+        client = Mock()
+        client.mget.side_effect = RedisError()
+        client.delete.side_effect = RedisError()
+        cache = RedisPatientCountCache(client)
+
+        assert cache.get_many(["L1"]) == {}
+        cache.invalidate(["L1"])
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestCachedPatientCount:
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[Dict[str, Encounter], None, None]:
+        encounters = {
+            uuid: encounter_factory(
+                uuid=uuid,
+                patient_uuid=patient,
+                patient_record_uuid=f"{patient}R1",
+                location_uuid=location,
+                dh_product_uuid=dh_product_uuid,
+                admitted_at="2020-01-01",
+            )
+            for uuid, patient, location in [
+                ("E1", "P1", "L1"),
+                ("E2", "P2", "L1"),
+                ("E3", "P3", "L2"),
+            ]
+        }
+        yield encounters
+        reset_database()
+
+    def test_repeated_poll_is_served_from_cache(
+        self, statement_counter: Callable[[Session], ContextManager]
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            first = controller.retrieve_patient_count_for_locations(
+                ["L1", "L2", "L3"], open_as_of=None
+            )
+            second = controller.retrieve_patient_count_for_locations(
+                ["L1", "L2", "L3"], open_as_of=None
+            )
+
+        assert first == second == {"L1": 2, "L2": 1}
+        assert ctr.count == 1
+
+    def test_open_as_of_is_not_cached(
+        self, statement_counter: Callable[[Session], ContextManager]
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            for _ in range(2):
+                controller.retrieve_patient_count_for_locations(
+                    ["L1"], open_as_of="2020-01-01T00:00:00.000Z"
+                )
+
+        assert ctr.count == 2
+
+    def test_create_invalidates(self, dh_product_uuid: str) -> None:
+        assert controller.retrieve_patient_count_for_locations(["L3"], None) == {}
+
+        controller.create_encounter(
+            {
+                "patient_uuid": "P4",
+                "patient_record_uuid": "P4R1",
+                "location_uuid": "L3",
+                "dh_product_uuid": dh_product_uuid,
+                "epr_encounter_id": "epr-P4",
+            }
+        )
+
+        assert controller.retrieve_patient_count_for_locations(["L3"], None) == {
+            "L3": 1
+        }
+
+    @pytest.mark.parametrize(
+        "changes,expected",
+        [
+            ({"location_uuid": "L2"}, {"L1": 1, "L2": 2}),
+            ({"discharged_at": "2020-02-01T00:00:00.000Z"}, {"L1": 1, "L2": 1}),
+            ({"deleted_at": "2020-02-01T00:00:00.000Z"}, {"L1": 1, "L2": 1}),
+        ],
+    )
+    def test_update_invalidates(self, changes: Dict, expected: Dict) -> None:
+        controller.retrieve_patient_count_for_locations(["L1", "L2"], None)
+
+        controller.update_encounter("E1", changes)
+
+        assert (
+            controller.retrieve_patient_count_for_locations(["L1", "L2"], None)
+            == expected
+        )
+
+    def test_merge_invalidates(self) -> None:
+        controller.retrieve_patient_count_for_locations(["L1"], None)
+
+        controller.merge_encounters(
+            child_record_uuid="P1R1",
+            parent_record_uuid="P2R1",
+            parent_patient_uuid="P2",
+            message_uuid="M1",
+        )
+
+        assert controller.retrieve_patient_count_for_locations(["L1"], None) == {
+            "L1": 1
+        }
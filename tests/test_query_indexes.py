@@ -0,0 +1,226 @@
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+)
+
+import pytest
+from flask.testing import FlaskClient
+from flask_batteries_included.sqldb import db
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.blueprint_development import reset_database
+from tests.conftest import DBStatementCounter
+
+# Sequential scans are disabled for the EXPLAINs so that the plans on the small test
+# tables show which index each query can use.
+EXPLAIN_INDEXES = {"explain": "", "explain_settings": {"enable_seqscan": "off"}}
+
+
+def _scans(counter: DBStatementCounter) -> Set[Tuple[str, str]]:
+    """The (node type, index name) of each index scan, and (node type, table) of each
+    sequential scan, in the plans of the recorded statements."""
+    return {
+        scan
+        for statement in counter.statements
+        if statement.plan is not None
+        for scan in _plan_scans(statement.plan)
+    }
+
+
+def _plan_scans(node: Dict) -> Iterator[Tuple[str, str]]:
+    if "Index Name" in node:
+        yield node["Node Type"], node["Index Name"]
+    elif node["Node Type"] == "Seq Scan":
+        yield node["Node Type"], node["Relation Name"]
+    for child in node.get("Plans", []):
+        yield from _plan_scans(child)
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestQueryIndexes:
+    """
+    Maps each query path in blueprint_api/controller.py to the index it is expected to use.
+    A failure here means a query no longer matches its index (or the index has gone), and
+    the query will scale with the size of the table.
+    """
+
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[None, None, None]:
+        for uuid, epr_encounter_id, parent in [
+            ("E1", "EPR1", None),
+            ("E2", None, None),
+            ("E3", "EPR3", "E1"),
+        ]:
+            encounter_factory(
+                uuid=uuid,
+                epr_encounter_id=epr_encounter_id,
+                child_of_encounter_uuid=parent,
+                patient_uuid="P1",
+                patient_record_uuid="R1",
+                location_uuid="L1",
+                dh_product_uuid=dh_product_uuid,
+                location_history=[{"location_uuid": "L0"}],
+            )
+        # Other patients at other locations, so that the planner statistics show
+        # lookups by patient or location as selective. Each has a child encounter, so
+        # that lookups by ancestor in the closure table are selective too.
+        for i in range(2, 50):
+            filler = encounter_factory(
+                patient_uuid=f"P{i}",
+                patient_record_uuid=f"R{i}",
+                location_uuid=f"L{i}",
+                dh_product_uuid=dh_product_uuid,
+            )
+            encounter_factory(
+                patient_uuid=f"P{i}",
+                patient_record_uuid=f"R{i}",
+                location_uuid=f"L{i}",
+                dh_product_uuid=dh_product_uuid,
+                child_of_encounter_uuid=filler.uuid,
+            )
+        # All tables, so that no statistics are left from earlier tests' data.
+        db.session.execute("ANALYZE")
+        yield
+        reset_database()
+
+    @pytest.mark.parametrize(
+        "query,expected_indexes",
+        [
+            (
+                lambda: controller.get_encounter("E1"),
+                [
+                    "encounter_pkey",
+                    "ix_location_history_encounter_uuid",
+                    "ix_score_system_history_encounter_uuid",
+                ],
+            ),
+            (
+                lambda: controller.get_child_encounters_bulk(["E1"]),
+                ["encounter_closure_pkey"],
+            ),
+            (
+                lambda: controller.get_open_local_encounters_for_patient("P1"),
+                ["open_idx"],
+            ),
+            (
+                lambda: controller.get_encounters_by_patient_or_epr_id(
+                    epr_encounter_id="EPR1", compact=True
+                ),
+                ["epr_encounter_id_deleted_at"],
+            ),
+            (
+                lambda: controller.get_encounters_by_patient_or_epr_id(
+                    patient_id="P1", compact=True
+                ),
+                ["ix_encounter_patient_uuid"],
+            ),
+            (
+                lambda: controller.get_open_encounters_for_patients(
+                    ["P1"], compact=True
+                ),
+                ["ix_encounter_patient_uuid"],
+            ),
+            (
+                lambda: controller.get_latest_encounters_for_patients(
+                    ["P1"], compact=True
+                ),
+                ["latest_encounter_by_patient_pkey", "encounter_pkey"],
+            ),
+            (
+                lambda: controller.get_open_encounters_for_locations(
+                    ["L1"], compact=True
+                ),
+                ["open_encounter_by_location_location_uuid_patient_uuid"],
+            ),
+            (
+                lambda: controller.get_open_encounters_for_locations(
+                    ["L1"], open_as_of="2020-01-01T00:00:00.000Z", compact=True
+                ),
+                ["open_location_idx"],
+            ),
+            (
+                lambda: controller.retrieve_patient_count_for_locations(
+                    ["L1"], open_as_of="2020-01-01T00:00:00.000Z"
+                ),
+                ["open_location_idx"],
+            ),
+            (
+                lambda: controller.retrieve_patient_count_for_locations(
+                    ["L1"], open_as_of=None
+                ),
+                ["open_encounter_by_location_location_uuid_patient_uuid"],
+            ),
+            (
+                # show_children, because every test encounter was modified after
+                # the date, so a parent_uuid IS NULL filter looks more selective.
+                lambda: controller.get_encounters(
+                    "2020-01-01T00:00:00.000Z", compact=True, show_children=True
+                ),
+                ["modified_idx"],
+            ),
+            (
+                lambda: controller.merge_encounters(
+                    child_record_uuid="R1",
+                    parent_record_uuid="R2",
+                    parent_patient_uuid="P2",
+                    message_uuid="M1",
+                ),
+                [
+                    "ix_encounter_patient_record_uuid",
+                    "open_encounter_by_location_pkey",
+                ],
+            ),
+        ],
+    )
+    def test_query_uses_index(
+        self,
+        statement_counter: Callable[..., ContextManager[DBStatementCounter]],
+        query: Callable[[], Any],
+        expected_indexes: List[str],
+    ) -> None:
+        with statement_counter(db.session, **EXPLAIN_INDEXES) as ctr:
+            query()
+
+        indexes = {name for node_type, name in _scans(ctr) if node_type != "Seq Scan"}
+        assert set(expected_indexes) <= indexes
+
+    @pytest.mark.parametrize(
+        "url,params",
+        [
+            ("/dhos/v1/encounter/locations", {"compact": "true"}),
+            ("/dhos/v1/encounter/locations/patient_count", {}),
+        ],
+    )
+    def test_location_endpoints_with_open_as_of(
+        self,
+        client: FlaskClient,
+        statement_counter: Callable[..., ContextManager[DBStatementCounter]],
+        url: str,
+        params: Dict[str, str],
+    ) -> None:
+        with statement_counter(db.session, **EXPLAIN_INDEXES) as ctr:
+            response = client.post(
+                url,
+                query_string={"open_as_of": "2020-01-01T00:00:00.000Z", **params},
+                headers={"Authorization": "Bearer TOKEN"},
+                json=["L1"],
+            )
+
+        assert response.status_code == 200
+        scans = _scans(ctr)
+        # Only index scans (plain, index-only or bitmap) of the partial index.
+        assert {name for _, name in scans} == {"open_location_idx"}
+        assert {node_type for node_type, _ in scans} <= {
+            "Index Scan",
+            "Index Only Scan",
+            "Bitmap Index Scan",
+        }
@@ -0,0 +1,216 @@
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, Iterator
+
+import pytest
+from flask import Flask
+from flask_batteries_included.sqldb import db
+
+from dhos_encounters_api.blueprint_api import controller
+from dhos_encounters_api.helpers.synthetic_data import analyze_tables
+from tests.conftest import DBStatementCounter, SyntheticEncounters
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("DATABASE_PORT"), reason="Query plans need Postgres"
+)
+
+BASELINE_PATH = Path(__file__).parent / "query_plan_baseline.json"
+# Set to rewrite the baseline file from the buffer counts of this run.
+RECORD_BASELINE = bool(os.environ.get("RECORD_QUERY_PLAN_BASELINE"))
+# Headroom over the recorded buffer counts before a query counts as regressed.
+BUFFER_TOLERANCE = 1.2
+
+PATIENTS = 5000
+LOCATIONS = 500
+# Each statement is run once more by EXPLAIN ANALYZE, in a savepoint that is rolled back.
+EXPLAIN = "ANALYZE, BUFFERS"
+# With sequential scans disabled the planner only falls back to one when no index can
+# serve the query, however small the table or large the share of it read, so a
+# sequential scan in a plan means a missing index.
+EXPLAIN_SETTINGS = {"enable_seqscan": "off"}
+# Large enough for ANALYZE to sample every generated row, so the statistics and the
+# buffer counts of the plans are the same on every run.
+STATISTICS_TARGET = 1000
+
+
+def _seq_scans(node: Dict) -> Iterator[str]:
+    """The tables scanned sequentially in a plan."""
+    if node["Node Type"] == "Seq Scan":
+        yield node["Relation Name"]
+    for child in node.get("Plans", []):
+        yield from _seq_scans(child)
+
+
+@pytest.fixture(scope="module")
+def baseline() -> Iterator[Dict[str, int]]:
+    """The recorded buffer counts, by test id. Written back when recording."""
+    recorded: Dict[str, int] = json.loads(BASELINE_PATH.read_text())
+    yield recorded
+    if RECORD_BASELINE:
+        BASELINE_PATH.write_text(json.dumps(recorded, indent=4, sort_keys=True) + "\n")
+
+
+@pytest.fixture(scope="module")
+def data(session_app: Flask) -> Iterator[SyntheticEncounters]:
+    with session_app.app_context():
+        data = SyntheticEncounters(patients=PATIENTS, locations=LOCATIONS)
+    yield data
+    with session_app.app_context():
+        data.truncate()
+
+
+@pytest.mark.usefixtures("mock_publish_msg", "app", "jwt_clinician")
+class TestQueryPlans:
+    """
+    Checks the plans of the controller queries against a trust-like volume and
+    distribution of synthetic encounters on Postgres. A query fails if any of its
+    statements has to scan a whole table, or if together they touch more buffers than
+    recorded in query_plan_baseline.json.
+
+    After an intended change in the buffer counts, record a new baseline with:
+        RECORD_QUERY_PLAN_BASELINE=1 pytest tests/test_query_plans.py
+    """
+
+    @pytest.fixture(autouse=True)
+    def statistics(self, app: Flask, data: SyntheticEncounters) -> None:
+        """Fresh statistics for each test, after any changes made by earlier ones."""
+        analyze_tables(statistics_target=STATISTICS_TARGET)
+
+    def _check_plans(
+        self, name: str, counter: DBStatementCounter, baseline: Dict[str, int]
+    ) -> None:
+        plans = [(s.statement, s.plan) for s in counter.statements if s.plan]
+        assert plans, "No statements were executed"
+        seq_scans = [
+            (table, statement)
+            for statement, plan in plans
+            for table in _seq_scans(plan)
+        ]
+        assert seq_scans == []
+        # Shared buffers hit or read by all of the statements
+        buffers = sum(
+            plan["Shared Hit Blocks"] + plan["Shared Read Blocks"] for _, plan in plans
+        )
+        if RECORD_BASELINE:
+            baseline[name] = buffers
+        else:
+            assert name in baseline, f"No baseline recorded for {name}"
+            assert buffers <= baseline[name] * BUFFER_TOLERANCE
+
+    @pytest.mark.parametrize(
+        "query",
+        [
+            pytest.param(
+                lambda data: controller.get_encounters_by_patient_or_epr_id(
+                    patient_id=data.patient_uuid
+                ),
+                id="encounters_by_patient",
+            ),
+            pytest.param(
+                lambda data: controller.get_encounters_by_patient_or_epr_id(
+                    epr_encounter_id=data.epr_encounter_id, compact=True
+                ),
+                id="encounters_by_epr_id",
+            ),
+            pytest.param(
+                lambda data: controller.retrieve_patient_count_for_locations(
+                    data.location_uuids, open_as_of=data.open_as_of
+                ),
+                id="patient_count_open_as_of",
+            ),
+            pytest.param(
+                lambda data: controller.retrieve_patient_count_for_locations(
+                    data.location_uuids, open_as_of=None
+                ),
+                id="patient_count",
+            ),
+            pytest.param(
+                lambda data: controller.get_open_encounters_for_locations(
+                    data.location_uuids[:1], compact=True
+                ),
+                id="open_encounters_for_locations",
+            ),
+            pytest.param(
+                lambda data: controller.get_open_encounters_for_locations(
+                    data.location_uuids[:1], open_as_of=data.open_as_of
+                ),
+                id="open_encounters_for_locations_open_as_of",
+            ),
+            pytest.param(
+                lambda data: controller.get_open_encounters_for_patients(
+                    data.patient_uuids
+                ),
+                id="open_encounters_for_patients",
+            ),
+            pytest.param(
+                lambda data: controller.get_latest_encounters_for_patients(
+                    data.patient_uuids
+                ),
+                id="latest_encounters_for_patients",
+            ),
+            pytest.param(
+                lambda data: controller.get_latest_encounters_for_patients(
+                    data.patient_uuids, open_as_of=data.open_as_of, compact=True
+                ),
+                id="latest_encounters_for_patients_open_as_of",
+            ),
+            pytest.param(
+                lambda data: controller.get_open_local_encounters_for_patient(
+                    data.local_patient_uuid
+                ),
+                id="open_local_encounters_for_patient",
+            ),
+            pytest.param(
+                lambda data: controller.get_child_encounters(data.tree_root_uuid),
+                id="child_encounters",
+            ),
+            pytest.param(
+                # The most recently modified hundred or so encounters
+                lambda data: controller.get_encounters(
+                    data.modified_since, compact=True
+                ),
+                id="encounters_modified_since",
+            ),
+            pytest.param(
+                lambda data: controller.get_encounters(data.modified_since),
+                id="encounters_modified_since_expanded",
+            ),
+        ],
+    )
+    def test_query_plan(
+        self,
+        request: Any,
+        data: SyntheticEncounters,
+        statement_counter: Callable[..., ContextManager[DBStatementCounter]],
+        baseline: Dict[str, int],
+        query: Callable[[SyntheticEncounters], Any],
+    ) -> None:
+        with statement_counter(
+            db.session, explain=EXPLAIN, explain_settings=EXPLAIN_SETTINGS
+        ) as ctr:
+            assert query(data)
+
+        self._check_plans(request.node.callspec.id, ctr, baseline)
+
+    def test_merge_encounters_plan(
+        self,
+        data: SyntheticEncounters,
+        statement_counter: Callable[..., ContextManager[DBStatementCounter]],
+        baseline: Dict[str, int],
+    ) -> None:
+        # Last, as the merge changes the generated data.
+        child_record, _, encounters = data.merge_records[0]
+        parent_record, parent_patient, _ = data.merge_records[1]
+        with statement_counter(
+            db.session, explain=EXPLAIN, explain_settings=EXPLAIN_SETTINGS
+        ) as ctr:
+            result = controller.merge_encounters(
+                child_record_uuid=child_record,
+                parent_record_uuid=parent_record,
+                parent_patient_uuid=parent_patient,
+                message_uuid="M1",
+            )
+
+        assert result["total"] == encounters
+        self._check_plans("merge_encounters", ctr, baseline)
@@ -0,0 +1,108 @@
+import re
+from typing import Callable, Dict, Generator, Optional
+
+import pytest
+from flask import Flask
+from flask.testing import FlaskClient
+from mock import Mock
+from pytest_mock import MockFixture
+
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.helpers import sql_instrumentation
+
+
+@pytest.fixture
+def mock_logger(mocker: MockFixture) -> Mock:
+    return mocker.patch.object(sql_instrumentation, "logger")
+
+
+def _logged_statistics(mock_logger: Mock) -> Dict:
+    (call,) = [
+        call
+        for call in mock_logger.info.call_args_list
+        if "sqlStatements" in call.kwargs.get("extra", {})
+    ]
+    return call.kwargs["extra"]["sqlStatements"]
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician", "mock_publish_msg")
+class TestSqlInstrumentation:
+    @pytest.fixture(autouse=True)
+    def encounters(
+        self, encounter_factory: Callable, dh_product_uuid: str
+    ) -> Generator[None, None, None]:
+        for uuid in ["E1", "E2"]:
+            encounter_factory(
+                uuid=uuid,
+                patient_uuid="P1",
+                patient_record_uuid="R1",
+                location_uuid="L1",
+                dh_product_uuid=dh_product_uuid,
+                epr_encounter_id=f"EPR-{uuid}",
+            )
+        yield
+        reset_database()
+
+    @pytest.fixture
+    def enabled(self, app: Flask, monkeypatch: pytest.MonkeyPatch) -> None:
+        monkeypatch.setitem(app.extensions, sql_instrumentation.EXTENSION_NAME, True)
+
+    @pytest.mark.usefixtures("enabled")
+    def test_server_timing_and_log(
+        self, client: FlaskClient, mock_logger: Mock
+    ) -> None:
+        response = client.get(
+            "/dhos/v1/encounter/E1", headers={"Authorization": "Bearer TOKEN"}
+        )
+
+        assert response.status_code == 200
+        # The encounter, then its location and score system history
+        match = re.fullmatch(
+            r'db;dur=([\d.]+);desc="3 statements", db-slowest;dur=([\d.]+)',
+            response.headers["Server-Timing"],
+        )
+        assert match is not None
+        assert float(match[2]) <= float(match[1])
+
+        logged = _logged_statistics(mock_logger)
+        assert logged["count"] == 3
+        assert logged["slowestDurationMs"] <= logged["durationMs"]
+        assert logged["slowestStatement"].startswith("SELECT")
+
+    @pytest.mark.usefixtures("enabled")
+    def test_streamed_statements_are_logged(
+        self, client: FlaskClient, mock_logger: Mock
+    ) -> None:
+        response = client.get(
+            "/dhos/v2/encounters?modified_since=2000-01-01T00:00:00.000Z&stream=true",
+            headers={"Authorization": "Bearer TOKEN"},
+        )
+
+        assert response.json is not None and len(response.json) == 2
+        # The encounters are queried while the body streams, after the headers are sent.
+        assert "Server-Timing" not in response.headers
+        assert _logged_statistics(mock_logger)["count"] == 3
+
+    def test_disabled(self, client: FlaskClient, mock_logger: Mock) -> None:
+        response = client.get(
+            "/dhos/v1/encounter/E1", headers={"Authorization": "Bearer TOKEN"}
+        )
+
+        assert response.status_code == 200
+        assert "Server-Timing" not in response.headers
+        mock_logger.info.assert_not_called()
+
+
+@pytest.mark.parametrize("value,expected", [(None, False), ("true", True)])
+def test_init_from_environment(
+    monkeypatch: pytest.MonkeyPatch, value: Optional[str], expected: bool
+) -> None:
+    if value is None:
+        monkeypatch.delenv("SQL_INSTRUMENTATION", raising=False)
+    else:
+        monkeypatch.setenv("SQL_INSTRUMENTATION", value)
+    app = Flask(__name__)
+
+    sql_instrumentation.init_sql_instrumentation(app)
+
+    assert app.extensions[sql_instrumentation.EXTENSION_NAME] is expected
@@ -0,0 +1,188 @@
+import os
+from collections import Counter
+from typing import Dict, Iterator, Set, Tuple
+
+import pytest
+from flask import Flask
+from flask_batteries_included.sqldb import db
+
+from dhos_encounters_api.helpers.synthetic_data import (
+    TABLES,
+    generate_encounters,
+    truncate_tables,
+)
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.latest_encounter_by_patient import (
+    LatestEncounterByPatient,
+)
+from dhos_encounters_api.models.location_history import LocationHistory
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("DATABASE_PORT"), reason="COPY needs Postgres"
+)
+
+
+@pytest.mark.usefixtures("app_context")
+class TestSyntheticData:
+    @pytest.fixture(scope="class")
+    def counts(self, session_app: Flask) -> Iterator[Dict[str, int]]:
+        with session_app.app_context():
+            truncate_tables()
+            counts = generate_encounters(
+                patients=500,
+                locations=20,
+                batch_size=200,
+                child_tree_ratio=0.2,
+                merge_ratio=0.1,
+            )
+        yield counts
+        with session_app.app_context():
+            truncate_tables()
+
+    def test_counts(self, counts: Dict[str, int]) -> None:
+        assert counts == {
+            table.name: db.session.query(table).count() for table in TABLES
+        }
+        assert counts["latest_encounter_by_patient"] <= 500
+
+    def test_closure(self, counts: Dict[str, int]) -> None:
+        parents = dict(
+            db.session.query(Encounter.uuid, Encounter.parent_uuid).filter(
+                Encounter.parent_uuid.isnot(None)
+            )
+        )
+        expected: Set[Tuple[str, str, int]] = set()
+        for descendant_uuid, parent_uuid in parents.items():
+            depth = 1
+            while parent_uuid is not None:
+                expected.add((parent_uuid, descendant_uuid, depth))
+                parent_uuid, depth = parents.get(parent_uuid), depth + 1
+
+        closure = set(
+            db.session.query(
+                EncounterClosure.ancestor_uuid,
+                EncounterClosure.descendant_uuid,
+                EncounterClosure.depth,
+            )
+        )
+        assert closure == expected
+        # Trees several levels deep
+        assert max(depth for _, _, depth in closure) >= 3
+
+    def test_open_encounters(self, counts: Dict[str, int]) -> None:
+        open_encounters = set(
+            db.session.query(
+                Encounter.uuid, Encounter.location_uuid, Encounter.patient_uuid
+            ).filter(
+                Encounter.discharged_at.is_(None),
+                Encounter.deleted_at.is_(None),
+                Encounter.parent_uuid.is_(None),
+            )
+        )
+
+        assert open_encounters
+        assert open_encounters == set(
+            db.session.query(
+                OpenEncounterByLocation.encounter_uuid,
+                OpenEncounterByLocation.location_uuid,
+                OpenEncounterByLocation.patient_uuid,
+            )
+        )
+
+    def test_latest_encounters(self, counts: Dict[str, int]) -> None:
+        patient_uuids = [uuid for (uuid,) in db.session.query(Encounter.patient_uuid)]
+        generated = {
+            (row.patient_uuid, row.encounter_uuid)
+            for row in db.session.query(LatestEncounterByPatient)
+        }
+
+        Encounter.sync_latest_encounters(patient_uuids)
+        synced = {
+            (row.patient_uuid, row.encounter_uuid)
+            for row in db.session.query(LatestEncounterByPatient)
+        }
+        db.session.rollback()
+
+        assert generated == synced
+
+    def test_location_history(self, counts: Dict[str, int]) -> None:
+        # Each history ends at the encounter's location.
+        last_locations = dict(
+            db.session.query(
+                LocationHistory.encounter_uuid, LocationHistory.location_uuid
+            )
+            .distinct(LocationHistory.encounter_uuid)
+            .order_by(LocationHistory.encounter_uuid, LocationHistory.arrived_at.desc())
+        )
+        assert last_locations == dict(
+            db.session.query(Encounter.uuid, Encounter.location_uuid)
+        )
+        # A long tail of moves
+        assert counts["location_history"] > counts["encounter"]
+        assert (
+            max(
+                Counter(
+                    uuid for (uuid,) in db.session.query(LocationHistory.encounter_uuid)
+                ).values()
+            )
+            >= 10
+        )
+
+    def test_shape(self, counts: Dict[str, int]) -> None:
+        encounters = db.session.query(Encounter).all()
+
+        occupancy = Counter(e.location_uuid for e in encounters)
+        assert max(occupancy.values()) > 3 * min(occupancy.values())
+        assert any(e.deleted_at is not None for e in encounters)
+        assert any(e.epr_encounter_id is None for e in encounters)
+        assert any(e.merge_history for e in encounters)
+        assert any(e.spo2_scale == 2 for e in encounters)
+        assert counts["score_system_history"] > 0
+
+    def test_cli(self, app: Flask) -> None:
+        # Last, as it replaces the generated data.
+        uuids = []
+        for _ in range(2):
+            result = app.test_cli_runner().invoke(
+                args=[
+                    "seed-encounters",
+                    "--patients",
+                    "10",
+                    "--seed",
+                    "1",
+                    "--truncate",
+                ]
+            )
+            assert result.exit_code == 0, result.output
+            assert "encounter: " in result.output
+            uuids.append({uuid for (uuid,) in db.session.query(Encounter.uuid)})
+
+        # The same seed generates the same encounters.
+        assert uuids[0] and uuids[0] == uuids[1]
+
+    def test_cli_adds_to_existing(self, app: Flask) -> None:
+        # After test_cli, so the tables hold the encounters it generated.
+        before = {
+            (e.uuid, e.patient_uuid, e.epr_encounter_id)
+            for e in db.session.query(Encounter)
+        }
+
+        # Again with the same seed, without --truncate
+        result = app.test_cli_runner().invoke(
+            args=["seed-encounters", "--patients", "10", "--seed", "1"]
+        )
+
+        assert result.exit_code == 0, result.output
+        after = {
+            (e.uuid, e.patient_uuid, e.epr_encounter_id)
+            for e in db.session.query(Encounter)
+        }
+        assert before < after
+        # New patients, with EPR ids that don't collide
+        assert not {e[1] for e in after - before} & {e[1] for e in before}
+        epr_ids = [e[2] for e in after if e[2] is not None]
+        assert len(epr_ids) == len(set(epr_ids))
@@ -0,0 +1,141 @@
+from typing import Callable, ContextManager, Dict, Generator
+
+import pytest
+from flask_batteries_included.sqldb import db
+from mock import Mock
+from pytest_mock import MockFixture
+from sqlalchemy.orm import Session
+
+from dhos_encounters_api.blueprint_api import controller, publish
+from dhos_encounters_api.blueprint_development import reset_database
+from dhos_encounters_api.models.encounter import Encounter
+from dhos_encounters_api.models.encounter_closure import EncounterClosure
+from dhos_encounters_api.models.open_encounter_by_location import (
+    OpenEncounterByLocation,
+)
+
+
+@pytest.mark.usefixtures("app", "jwt_clinician")
+class TestUpsertEncounter:
+    @pytest.fixture(autouse=True)
+    def existing(
+        self, encounter_factory: Callable, make_encounter: Callable[..., Dict]
+    ) -> Generator[None, None, None]:
+        encounter_factory(uuid="E-EPR1", **make_encounter("EPR1"))
+        db.session.expire_all()
+        yield
+        reset_database()
+
+    @pytest.fixture
+    def mock_publish_update(self, mocker: MockFixture) -> Mock:
+        return mocker.patch.object(publish, "publish_encounter_update")
+
+    @pytest.fixture
+    def make_encounter(self, dh_product_uuid: str) -> Callable[..., Dict]:
+        def make(epr_encounter_id: str, **kwargs: str) -> Dict:
+            return {
+                "epr_encounter_id": epr_encounter_id,
+                "patient_uuid": "P1",
+                "patient_record_uuid": "R1",
+                "location_uuid": "L1",
+                "dh_product_uuid": dh_product_uuid,
+                "encounter_type": "INPATIENT",
+                "score_system": "news2",
+                "admitted_at": "2020-01-01T00:00:00.000Z",
+                **kwargs,
+            }
+
+        return make
+
+    def test_creates_missing_encounter(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_update: Mock,
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            result = controller.upsert_encounter(make_encounter("EPR2"))
+
+        assert result["uuid"] != "E-EPR1"
+        assert result["epr_encounter_id"] == "EPR2"
+        assert result["spo2_scale"] == 1
+        assert result["location_history"] == []
+        mock_publish_update.assert_called_once_with(result)
+        # INSERT ... ON CONFLICT encounter, INSERT open encounter projection, reload,
+        # refresh latest encounter projection
+        assert ctr.count == 4
+        open_encounter = OpenEncounterByLocation.query.get(result["uuid"])
+        assert open_encounter.location_uuid == "L1"
+
+    def test_updates_existing_encounter(
+        self, make_encounter: Callable[..., Dict], mock_publish_update: Mock
+    ) -> None:
+        result = controller.upsert_encounter(make_encounter("EPR1", location_uuid="L2"))
+
+        assert result["uuid"] == "E-EPR1"
+        assert result["location_uuid"] == "L2"
+        assert [h["location_uuid"] for h in result["location_history"]] == ["L1"]
+        mock_publish_update.assert_called_once_with(result)
+        assert Encounter.query.filter_by(epr_encounter_id="EPR1").count() == 1
+        open_encounter = OpenEncounterByLocation.query.get("E-EPR1")
+        assert open_encounter.location_uuid == "L2"
+
+    def test_unchanged_encounter_is_not_published(
+        self, make_encounter: Callable[..., Dict], mock_publish_update: Mock
+    ) -> None:
+        result = controller.upsert_encounter(make_encounter("EPR1"))
+
+        assert result["uuid"] == "E-EPR1"
+        mock_publish_update.assert_not_called()
+
+    def test_deleted_encounter_is_not_updated(
+        self, make_encounter: Callable[..., Dict], mock_publish_update: Mock
+    ) -> None:
+        controller.upsert_encounter(
+            make_encounter("EPR1", deleted_at="2020-01-02T00:00:00.000Z")
+        )
+        assert OpenEncounterByLocation.query.get("E-EPR1") is None
+
+        result = controller.upsert_encounter(make_encounter("EPR1"))
+
+        assert result["uuid"] != "E-EPR1"
+        assert result["deleted_at"] is None
+        assert Encounter.query.filter_by(epr_encounter_id="EPR1").count() == 2
+
+    def test_creates_deleted_encounter(
+        self, make_encounter: Callable[..., Dict], mock_publish_update: Mock
+    ) -> None:
+        result = controller.upsert_encounter(
+            make_encounter("EPR2", deleted_at="2020-01-02T00:00:00.000Z")
+        )
+
+        assert result["deleted_at"] is not None
+        assert OpenEncounterByLocation.query.get(result["uuid"]) is None
+
+    def test_creates_child_encounter(
+        self, make_encounter: Callable[..., Dict], mock_publish_update: Mock
+    ) -> None:
+        result = controller.upsert_encounter(
+            make_encounter("EPR2", child_of_encounter_uuid="E-EPR1")
+        )
+
+        assert result["child_of_encounter_uuid"] == "E-EPR1"
+        closure = EncounterClosure.query.filter_by(descendant_uuid=result["uuid"])
+        assert [(c.ancestor_uuid, c.depth) for c in closure] == [("E-EPR1", 1)]
+        assert OpenEncounterByLocation.query.get(result["uuid"]) is None
+
+    @pytest.mark.parametrize("jwt_extra_claims", [{"can_edit_ews": False}])
+    def test_create_checks_spo2_permission(
+        self,
+        make_encounter: Callable[..., Dict],
+        mock_publish_update: Mock,
+        statement_counter: Callable[[Session], ContextManager],
+    ) -> None:
+        with statement_counter(db.session) as ctr:
+            with pytest.raises(PermissionError):
+                controller.upsert_encounter(make_encounter("EPR2", spo2_scale=2))
+
+        # Rejected before the upsert statement runs
+        assert ctr.count == 0
+        assert Encounter.query.filter_by(epr_encounter_id="EPR2").count() == 0
+        mock_publish_update.assert_not_called()